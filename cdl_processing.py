@@ -1,30 +1,147 @@
+# Combine the yearly CDL class counts of each NLDAS cell (cdl<year>_clean.csv, one column per CDL class) into a long
+# table by GCAM land category. The years are read and transformed in parallel worker processes and concatenated once, and
+# CDL classes are assigned to GCAM categories by indexing arrays of the lookup table with the class ids. Most cells only
+# contain a few of the ~255 CDL classes, so only the non-zero (NLDAS_ID, class, value) entries are melted into rows. The
+# GCAM categories with zero area in a cell are added back when aggregating, so that the table has a row for every cell
+# and category as wmabm_data_process_HESS.py expects (--drop-zeros leaves them out).
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
 pd.set_option('display.expand_frame_repr', False)
 
-#cdl_lookup = pd.read_csv('//PNL/Users/YOON644/Projects/wm abm data/nldas cdl/cdl_gcam_lookup_v2.csv')
-cdl_lookup = pd.read_csv('data/cdl_gcam_lookup_v3_notavailcorr.csv')
+from wmabm_cache import CACHE_DIR, read_quickstats_cached
+from wmabm_instrument import RunReport
+
+CDL_DIR = '//PNL/Users/YOON644/Projects/wm abm data/nldas cdl/'
+YEARS = list(range(2008, 2018))
+
+# Columns and rows of the NASS Quick Stats crops dump used here: state survey estimates of crop areas
+NASS_PATH = '/Projects/wm abm data/nass database/qs.crops_20190123.txt'
+NASS_COLUMNS = ['SOURCE_DESC', 'COMMODITY_DESC', 'CLASS_DESC', 'PRODN_PRACTICE_DESC', 'UTIL_PRACTICE_DESC',
+                'STATISTICCAT_DESC', 'UNIT_DESC', 'SHORT_DESC', 'DOMAIN_DESC', 'AGG_LEVEL_DESC', 'STATE_ALPHA',
+                'STATE_NAME', 'YEAR', 'FREQ_DESC', 'REFERENCE_PERIOD_DESC', 'VALUE']
+NASS_FILTERS = {'SOURCE_DESC': ['SURVEY'], 'AGG_LEVEL_DESC': ['STATE'], 'FREQ_DESC': ['ANNUAL'],
+                'STATISTICCAT_DESC': ['AREA PLANTED', 'AREA HARVESTED', 'AREA BEARING', 'AREA IN PRODUCTION']}
+
+
+def lookup_arrays(cdl_lookup):
+    # Each column of the CDL -> GCAM lookup table as an array indexed by CDL class id (NaN for ids not in the table)
+    cdl_lookup = cdl_lookup.drop_duplicates('CDL_id')
+    ids = cdl_lookup['CDL_id'].to_numpy(dtype=int)
+    arrays = {}
+    for col in cdl_lookup.columns:
+        values = cdl_lookup[col].to_numpy()
+        array = np.full(ids.max() + 1, np.nan, dtype=object if values.dtype == object else float)
+        array[ids] = values
+        arrays[col] = array
+    return arrays
+
+
+def lookup_classes(variable, lookup):
+    # Lookup table columns of each CDL class id in variable, as the columns of a left merge with the lookup table
+    in_range = (variable >= 0) & (variable < len(lookup['CDL_id']))
+    pos = np.where(in_range, variable, 0)
+    found = in_range & pd.notnull(lookup['CDL_id'][pos])
+    return {col: np.where(found, array[pos], np.nan) for col, array in lookup.items()}
+
+
+def class_categories(class_ids, lookup, year):
+    # GCAM category of the CDL classes of one year, with the first class id (variable, in column order) and first
+    # CDL_id / GCAM_id of each category, as taken by the 'first' aggregation over a dense melt of all the classes
+    classes = pd.DataFrame({'variable': class_ids, **lookup_classes(class_ids, lookup)})
+    classes['GCAM_name'] = classes['GCAM_name'].fillna('NotAvailable')
+    categories = classes.groupby('GCAM_name', as_index=False).aggregate({'variable': 'first', 'CDL_id': 'first',
+                                                                          'GCAM_id': 'first'})
+    categories['year'] = year
+    return categories
+
+
+def read_cdl_year(year, lookup, cdl_dir=CDL_DIR, sparse=True):
+    # Long table (NLDAS_ID, variable, value, year, lookup columns) of one year of CDL class counts, in the row order of
+    # pd.melt followed by a left merge with the lookup table. With sparse=True only the non-zero counts are kept (read
+    # from the wide array with np.nonzero). Returns the table, the cell ids and GCAM categories of the year (see
+    # class_categories), and the run report record.
+    report = RunReport()
+    with report.stage('cdl ' + str(year)) as record:
+        data = pd.read_csv(cdl_dir + 'cdl' + str(year) + '_clean.csv')
+        record['rows_in'] = len(data)
+        classes = data.columns.drop('NLDAS_ID')
+        class_ids = classes.astype(int).to_numpy()
+        cells = data['NLDAS_ID'].to_numpy()
+
+        values = data[classes].to_numpy().T  # class x cell, so that entries are taken class by class as in pd.melt
+        del data
+        if sparse:
+            column, cell = np.nonzero(values)
+        else:
+            column, cell = np.divmod(np.arange(values.size), len(cells))
+        variable = class_ids[column]
+        long_data = pd.DataFrame({'NLDAS_ID': cells[cell], 'variable': variable, 'value': values[column, cell],
+                                  'year': year, **lookup_classes(variable, lookup)})
+        record['rows_out'] = len(long_data)
+    return long_data, cells, class_categories(class_ids, lookup, year), report.stages[0]
+
+
+def aggregate_categories(alldata, cells, categories, keep_zeros=True):
+    # Total value by NLDAS_ID, GCAM_name, and year, with the first variable / CDL_id / GCAM_id of each category. With
+    # keep_zeros=True (default) every cell of a year has a row for every category of the year, as when all classes are
+    # melted and as assumed by wmabm_data_process_HESS.py (available land is value - urban - rock - notavail of each
+    # cell). keep_zeros=False drops the categories with zero area.
+    value = alldata.groupby(['NLDAS_ID', 'GCAM_name', 'year'])['value'].sum()
+    if keep_zeros:
+        full = pd.concat([pd.merge(pd.DataFrame({'NLDAS_ID': year_cells}), year_categories[['GCAM_name', 'year']],
+                                   how='cross') for year_cells, year_categories in zip(cells, categories)])
+        value = value.reindex(pd.MultiIndex.from_frame(full), fill_value=0).sort_index()
+    alldata_new = pd.merge(value.reset_index(), pd.concat(categories), how='left', on=['GCAM_name', 'year'])
+    return alldata_new[['NLDAS_ID', 'GCAM_name', 'year', 'variable', 'value', 'CDL_id', 'GCAM_id']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Combine yearly CDL class counts by NLDAS cell into GCAM categories')
+    parser.add_argument('--cdl-dir', default=CDL_DIR, help='directory of the cdl<year>_clean.csv files')
+    parser.add_argument('--years', nargs='+', type=int, default=YEARS, help='CDL years to combine')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes reading the yearly CDL files')
+    parser.add_argument('--nass-path', default=NASS_PATH, help='NASS Quick Stats crops dump (tab separated)')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='directory for the filtered NASS table')
+    parser.add_argument('--drop-zeros', action='store_true',
+                        help='leave out the GCAM categories with zero area of each cell (not readable by wmabm_data_process_HESS.py)')
+    args = parser.parse_args()
+
+    report = RunReport()  # timing, memory, and row counts of each year, written to cdl_processing_report.json / .csv
+
+    #cdl_lookup = pd.read_csv('//PNL/Users/YOON644/Projects/wm abm data/nldas cdl/cdl_gcam_lookup_v2.csv')
+    cdl_lookup = pd.read_csv('data/cdl_gcam_lookup_v3_notavailcorr.csv')
+    lookup = lookup_arrays(cdl_lookup)
 
-for year in range(2008,2018):
-    name = 'cdl' + str(year) + '_clean.csv'
-    data = pd.read_csv('//PNL/Users/YOON644/Projects/wm abm data/nldas cdl/' + name)
-    data = pd.melt(data, id_vars=['NLDAS_ID'])
-    data['variable'] = data['variable'].astype(int)
-    data['year'] = year
-    data = pd.merge(data, cdl_lookup, how='left',left_on='variable', right_on='CDL_id')
-    if year == 2008:
-        alldata = data
-    else:
-        alldata = alldata.append(data)
+    # Read the years in parallel (results are returned in year order) and combine them once
+    with report.stage('read years') as record:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            results = list(executor.map(read_cdl_year, args.years, [lookup] * len(args.years), [args.cdl_dir] * len(args.years)))
+        report.stages.extend(year_record for _, _, _, year_record in results)
+        alldata = pd.concat([data for data, _, _, _ in results], ignore_index=True)
+        cells = [year_cells for _, year_cells, _, _ in results]
+        categories = [year_categories for _, _, year_categories, _ in results]
+        del results
+        record['rows_out'] = len(alldata)
 
-alldata['GCAM_name'] = alldata['GCAM_name'].fillna('NotAvailable') # fill nans (out of domain) with "NotAvailable" category
+    with report.stage('aggregate', [alldata]) as record:
+        alldata['GCAM_name'] = alldata['GCAM_name'].fillna('NotAvailable') # fill nans (out of domain) with "NotAvailable" category
 
-aggregation_functions = {'variable': 'first', 'value': 'sum', 'CDL_id': 'first', 'GCAM_id': 'first'}
-alldata_new = alldata.groupby(['NLDAS_ID','GCAM_name','year'], as_index=False).aggregate(aggregation_functions)
+        alldata_new = aggregate_categories(alldata, cells, categories, keep_zeros=not args.drop_zeros)
+        record['rows_out'] = len(alldata_new)
 
-nass_data = pd.read_csv('/Projects/wm abm data/nass database/qs.crops_20190123.txt', sep='\t')
+    # Only the needed columns and rows of the multi-GB dump, streamed once and then read from the cache
+    with report.stage('nass') as record:
+        nass_data = read_quickstats_cached(args.nass_path, NASS_COLUMNS, dict(NASS_FILTERS, YEAR=args.years),
+                                           cache_dir=args.cache_dir)
+        record['rows_out'] = len(nass_data)
 
-pivot = pd.pivot_table(alldata, index = 'year',values='value',columns='GCAM_name',aggfunc=np.sum)
+    # Yearly totals by category (the zero rows of the categories of each year keep categories with no area at 0)
+    pivot = pd.pivot_table(pd.concat([alldata_new, pd.concat(categories).assign(value=0)]), index = 'year',values='value',columns='GCAM_name',aggfunc=np.sum)
 
-pivot_melt = pd.melt(pivot, 'year', var_name=)
+    pivot_melt = pd.melt(pivot.reset_index(), 'year', var_name='GCAM_name', value_name='value')
 
-d = pd.melt(df, 'Country Name', var_name='Date', value_name='GDPperCapGrowth%')
\ No newline at end of file
+    report.write('cdl_processing_report')
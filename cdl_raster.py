@@ -0,0 +1,136 @@
+# Aggregate the 30 m Cropland Data Layer rasters to the 1/8 degree NLDAS grid, in place of the GIS pre-processing that
+# produced the CDL table read by wmabm_data_process_HESS.py (all_nldas_cdl_data_v3.txt). Each yearly GeoTIFF is read in
+# square tiles by worker processes. The pixel centers of a tile are projected to longitude / latitude to find their
+# NLDAS cell, and the pixels of each (cell, class) pair are counted at once with np.bincount. The counts of all tiles are
+# summed, converted to areas (sq ft), and assigned to GCAM categories as in cdl_processing.py. Requires rasterio and
+# pyproj, which are only imported when a raster is read.
+#
+# Usage: python cdl_raster.py --cdl-path 'cdl/{year}_30m_cdls.tif' --years 2008 2009 --workers 8
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cdl_processing import CDL_DIR, YEARS, aggregate_categories, class_categories, lookup_arrays, lookup_classes
+from wmabm_grid import nldas_cell_id
+from wmabm_instrument import RunReport
+
+CDL_PATH = CDL_DIR + '{year}_30m_cdls.tif'
+CDL_CLASSES = 256  # CDL class ids are 8 bit
+SQFT_PER_SQM = 10.7639104
+TILE_SIZE = 4096  # pixels per side of the tiles read by the workers
+STRIP_ROWS = 512  # rows of a tile projected at once, to bound the memory of the coordinate arrays
+
+
+def raster_tiles(path, tile_size=TILE_SIZE):
+    # (row_off, col_off, height, width) of the tiles covering the raster, the pixel area in sq ft, and the nodata value.
+    # The raster must be in an equal-area projection (as the CDL, in CONUS Albers) so that all pixels have the same area.
+    import rasterio
+
+    with rasterio.open(path) as src:
+        if not src.crs.is_projected:
+            raise ValueError(path + ' is not in a projected coordinate system')
+        transform = src.transform
+        pixel_area = abs(transform.a * transform.e - transform.b * transform.d) * src.crs.linear_units_factor[1] ** 2
+        tiles = [(row, col, min(tile_size, src.height - row), min(tile_size, src.width - col))
+                 for row in range(0, src.height, tile_size) for col in range(0, src.width, tile_size)]
+        return tiles, pixel_area * SQFT_PER_SQM, src.nodata
+
+
+def count_tile(path, tile, strip_rows=STRIP_ROWS):
+    # NLDAS_ID, CDL class, and pixel count of the (cell, class) pairs present in one tile of the raster. Pixels outside
+    # of the NLDAS grid and nodata pixels are not counted.
+    import rasterio
+    from pyproj import Transformer
+    from rasterio.windows import Window
+
+    row_off, col_off, height, width = tile
+    with rasterio.open(path) as src:
+        classes = src.read(1, window=Window(col_off, row_off, width, height))
+        transformer = Transformer.from_crs(src.crs.to_wkt(), 'EPSG:4326', always_xy=True)
+        a, b, c, d, e, f = src.transform[:6]
+        nodata = src.nodata
+
+    cells = np.zeros(classes.shape, dtype=np.int64)
+    col = col_off + np.arange(width) + 0.5
+    for start in range(0, height, strip_rows):
+        row = row_off + np.arange(start, min(start + strip_rows, height))[:, None] + 0.5
+        lon, lat = transformer.transform(a * col + b * row + c, d * col + e * row + f)
+        cells[start:start + len(row)] = nldas_cell_id(lon, lat)
+
+    counted = cells > 0
+    if nodata is not None:
+        counted &= classes != nodata
+    cells = cells[counted]
+    if not len(cells):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # A tile only spans a few rows of the NLDAS grid, so keys are counted relative to its first cell
+    first_cell = cells.min()
+    keys = (cells - first_cell) * CDL_CLASSES + classes[counted].astype(np.int64)
+    counts = np.bincount(keys)
+    key = np.nonzero(counts)[0]
+    cell, variable = np.divmod(key, CDL_CLASSES)
+    return cell + first_cell, variable, counts[key]
+
+
+def count_cdl_year(path, workers=4, tile_size=TILE_SIZE):
+    # NLDAS_ID, CDL class, and area (sq ft) of the (cell, class) pairs of one CDL raster, sorted by cell and class
+    tiles, pixel_area, _ = raster_tiles(path, tile_size=tile_size)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(count_tile, [path] * len(tiles), tiles))
+    cell = np.concatenate([tile_cell for tile_cell, _, _ in results])
+    variable = np.concatenate([tile_variable for _, tile_variable, _ in results])
+    count = np.concatenate([tile_count for _, _, tile_count in results])
+
+    # Cells on the edges of tiles are counted by several tiles
+    key, inverse = np.unique(cell * CDL_CLASSES + variable, return_inverse=True)
+    count = np.bincount(inverse.ravel(), weights=count)
+    cell, variable = np.divmod(key, CDL_CLASSES)
+    return cell, variable, count * pixel_area
+
+
+def aggregate_cdl_rasters(paths, years, lookup, workers=4, tile_size=TILE_SIZE, keep_zeros=True, report=None):
+    # Table of the CDL area of each NLDAS cell, GCAM category, and year, with the columns of all_nldas_cdl_data_v3.txt.
+    # As in that table, every cell with CDL pixels has a row for every GCAM category (zero if absent), unless keep_zeros
+    # is False (see cdl_processing.aggregate_categories).
+    report = report if report is not None else RunReport()
+    alldata, cells, categories = [], [], []
+    for path, year in zip(paths, years):
+        with report.stage('cdl ' + str(year)) as record:
+            cell, variable, value = count_cdl_year(path, workers=workers, tile_size=tile_size)
+            alldata.append(pd.DataFrame({'NLDAS_ID': cell, 'variable': variable, 'value': value, 'year': year,
+                                         **lookup_classes(variable, lookup)}))
+            cells.append(np.unique(cell))
+            categories.append(class_categories(np.arange(CDL_CLASSES), lookup, year))
+            record['rows_out'] = len(alldata[-1])
+
+    with report.stage('aggregate', alldata) as record:
+        alldata = pd.concat(alldata, ignore_index=True)
+        alldata['GCAM_name'] = alldata['GCAM_name'].fillna('NotAvailable')
+        alldata_new = aggregate_categories(alldata, cells, categories, keep_zeros=keep_zeros)
+        record['rows_out'] = len(alldata_new)
+    return alldata_new
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aggregate CDL rasters to GCAM categories on the NLDAS grid')
+    parser.add_argument('--cdl-path', default=CDL_PATH, help='CDL GeoTIFF of each year, with {year} in place of the year')
+    parser.add_argument('--years', nargs='+', type=int, default=YEARS, help='CDL years to aggregate')
+    parser.add_argument('--lookup', default='data/cdl_gcam_lookup_v3_notavailcorr.csv', help='CDL -> GCAM lookup table')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes counting the raster tiles')
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE, help='pixels per side of the raster tiles')
+    parser.add_argument('--drop-zeros', action='store_true',
+                        help='leave out the GCAM categories with zero area of each cell (not readable by wmabm_data_process_HESS.py)')
+    parser.add_argument('--output', default='all_nldas_cdl_data_v3.txt', help='output table (CSV)')
+    args = parser.parse_args()
+
+    report = RunReport()  # timing, memory, and row counts of each year, written to cdl_raster_report.json / .csv
+    lookup = lookup_arrays(pd.read_csv(args.lookup))
+    alldata_new = aggregate_cdl_rasters([args.cdl_path.format(year=year) for year in args.years], args.years, lookup,
+                                        workers=args.workers, tile_size=args.tile_size, keep_zeros=not args.drop_zeros,
+                                        report=report)
+    alldata_new.to_csv(args.output, index=False)
+    report.write('cdl_raster_report')
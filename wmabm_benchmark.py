@@ -0,0 +1,157 @@
+# Synthetic benchmark of wmabm_data_process_HESS.py. The NLDAS / CDL / Siebert inputs of Step 2 are not distributed with
+# this repository, so this script writes schema-faithful stand-ins for them on a configurable grid (from a single-state
+# slice up to the full 464 x 224 NLDAS grid and a 4x finer grid), runs the processing script on them in a separate
+# process, and collects its run report (wall and CPU time, peak memory, and row counts of each stage, see
+# wmabm_instrument.py). The USDA workbooks and the water source table under data/ are copied as they are.
+#
+# Usage: python wmabm_benchmark.py --grids state conus fine --workdir benchmark
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# Grid sizes as (columns, rows, number of states, cell area in sq ft). The 'state' grid is the tile of a single state in
+# the 'conus' layout and 'fine' has four times as many (and four times smaller) cells as the 1/8 degree NLDAS grid.
+CELL_AREA_SQFT = 1.6e9  # area of a 1/8 degree cell, roughly
+GRIDS = {'state': (58, 37, 1, CELL_AREA_SQFT), 'conus': (464, 224, 48, CELL_AREA_SQFT),
+         'fine': (928, 448, 48, CELL_AREA_SQFT / 4)}
+
+# The 48 conterminous states, laid out on the grid as 8 x 6 tiles
+STATES = {'AL': 'Alabama', 'AZ': 'Arizona', 'AR': 'Arkansas', 'CA': 'California', 'CO': 'Colorado', 'CT': 'Connecticut',
+          'DE': 'Delaware', 'FL': 'Florida', 'GA': 'Georgia', 'ID': 'Idaho', 'IL': 'Illinois', 'IN': 'Indiana', 'IA': 'Iowa',
+          'KS': 'Kansas', 'KY': 'Kentucky', 'LA': 'Louisiana', 'ME': 'Maine', 'MD': 'Maryland', 'MA': 'Massachusetts',
+          'MI': 'Michigan', 'MN': 'Minnesota', 'MS': 'Mississippi', 'MO': 'Missouri', 'MT': 'Montana', 'NE': 'Nebraska',
+          'NV': 'Nevada', 'NH': 'New Hampshire', 'NJ': 'New Jersey', 'NM': 'New Mexico', 'NY': 'New York',
+          'NC': 'North Carolina', 'ND': 'North Dakota', 'OH': 'Ohio', 'OK': 'Oklahoma', 'OR': 'Oregon', 'PA': 'Pennsylvania',
+          'RI': 'Rhode Island', 'SC': 'South Carolina', 'SD': 'South Dakota', 'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah',
+          'VT': 'Vermont', 'VA': 'Virginia', 'WA': 'Washington', 'WV': 'West Virginia', 'WI': 'Wisconsin', 'WY': 'Wyoming'}
+ERS_REGIONS = ['Heartland', 'Northern Crescent', 'Northern Great Plains', 'Prairie Gateway', 'Eastern Uplands',
+               'Southern Seaboard', 'Fruitful Rim', 'Basin and Range', 'Mississippi Portal']
+
+# GCAM land categories of the CDL table with their GCAM_id, and the share of cells in which each one is present
+GCAM_CATEGORIES = {'Corn': (1, 0.5), 'Wheat': (2, 0.4), 'Rice': (3, 0.05), 'Root_Tuber': (4, 0.1), 'OilCrop': (5, 0.4),
+                   'SugarCrop': (6, 0.05), 'OtherGrain': (7, 0.2), 'FiberCrop': (8, 0.1), 'FodderGrass': (9, 0.5),
+                   'FodderHerb': (10, 0.3), 'MiscCrop': (11, 0.4), 'Forest': (12, 0.6), 'Grassland': (13, 0.6),
+                   'Shrubland': (14, 0.3), 'Pasture': (15, 0.5), 'Wetland': (16, 0.3), 'UrbanLand': (17, 0.7),
+                   'RockIceDesert': (18, 0.2), 'NotAvailable': (19, 0.9)}
+YEARS = list(range(2008, 2018))
+STAGE_STEPS = {'nir': 'Step 3', 'irrigation': 'Step 3', 'water_perc': 'Step 3', 'cdl_states': 'Step 3', 'cdl_states_total': 'Step 3',
+               'budget_table_lookup': 'Step 3', 'cdl_states_all': 'Step 5', 'cdl_states_all_replace': 'Step X',
+               'compact_cdl_states': 'Step 3', 'compact_cdl_states_all': 'Step 5', 'redistribution_report': 'Step X',
+               'siebert_scaling': 'Step 6', 'scenarios': 'Steps 6-8', 'monte_carlo': 'Steps 6-7', 'cdl_states_irr': 'Step 6', 'cdl_states_cost': 'Step 7',
+               'export_outputs': 'Step 8'}
+
+
+def make_inputs(nx, ny, n_states, cell_area=CELL_AREA_SQFT, years=YEARS, seed=0):
+    # Synthetic stand-ins for the CDL, Siebert, NLDAS lookup, water cost, and historical supply tables on an nx x ny grid
+    # (NLDAS_ID numbered row by row from 1). States are rectangular tiles of the grid, each split into two ERS regions.
+    rng = np.random.default_rng(seed)
+    n_cells = nx * ny
+    nldas_id = np.arange(1, n_cells + 1)
+    x = np.tile(np.arange(nx), ny)
+    y = np.repeat(np.arange(ny), nx)
+    tiles_x, tiles_y = (8, 6) if n_states > 1 else (1, 1)
+    tile = (y * tiles_y // ny) * tiles_x + x * tiles_x // nx
+    state_abbr = np.array(list(STATES))[tile % n_states]
+    state_regions = rng.choice(len(ERS_REGIONS), (len(STATES), 2))
+    region = state_regions[tile % n_states, ((x * tiles_x * 2 // nx) % 2)]
+    nldas_lookup = pd.DataFrame({'NLDAS_ID': nldas_id, 'State': state_abbr,
+                                 'State_Name': [STATES[s] for s in state_abbr],
+                                 'ERS_region': np.array(ERS_REGIONS)[region]})
+
+    # CDL areas (sq ft) of the categories present in each cell, split by a random share of the cell area per year. As in
+    # the real CDL table, every cell has a row for every category, with zero area for the categories not present.
+    names = np.array(list(GCAM_CATEGORIES))
+    gcam_id = np.array([GCAM_CATEGORIES[n][0] for n in names])
+    present = rng.random((n_cells, len(names))) < np.array([GCAM_CATEGORIES[n][1] for n in names])
+    present[~present.any(axis=1), -1] = True  # at least one category (NotAvailable) per cell
+    cell, category = np.divmod(np.arange(present.size), len(names))
+    cdl = []
+    for year in years:
+        weight = np.where(present.ravel(), rng.gamma(0.8, 1, present.size), 0)
+        weight_sum = np.bincount(cell, weights=weight, minlength=n_cells)
+        cdl.append(pd.DataFrame({'NLDAS_ID': nldas_id[cell], 'GCAM_name': names[category], 'year': year,
+                                 'variable': gcam_id[category], 'value': np.round(cell_area * weight / weight_sum[cell]),
+                                 'CDL_id': gcam_id[category], 'GCAM_id': gcam_id[category]}))
+    cdl = pd.concat(cdl, ignore_index=True)
+
+    aei_pct = np.where(rng.random(n_cells) < 0.3, 0, rng.uniform(0, 100, n_cells)).round(2)
+    aeigw_pct = rng.uniform(0, 100, n_cells).round(2)
+    siebert = pd.DataFrame({'NLDAS_ID': nldas_id, 'aei_pct': aei_pct, 'aeigw_pct': aeigw_pct, 'aeisw_pct': 100 - aeigw_pct})
+
+    state_names = list(STATES.values())
+    water_cost = pd.DataFrame({'State': state_names, 'gw_cost_est_$_acft': rng.uniform(20, 200, len(state_names)).round(2),
+                               'sw_cost_est_$_acft': rng.uniform(5, 150, len(state_names)).round(2)})
+    hist_supply = pd.DataFrame({'NLDAS_ID': nldas_id, 'WRM_SUPPLY_acreft': rng.uniform(0, 1e4, n_cells)})
+    return {'cdl': cdl, 'siebert': siebert, 'nldas_lookup': nldas_lookup, 'water_cost': water_cost,
+            'hist_supply': hist_supply}
+
+
+def write_inputs(inputs, data_dir, source_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')):
+    # Write the synthetic tables under the file names read by wmabm_data_process_HESS.py, and copy the USDA workbooks
+    # and the water source table from source_dir
+    os.makedirs(data_dir, exist_ok=True)
+    inputs['cdl'].to_csv(os.path.join(data_dir, 'all_nldas_cdl_data_v3.txt'), index=False)
+    inputs['siebert'].to_csv(os.path.join(data_dir, 'siebert_irrigation.txt'), index=False)
+    inputs['nldas_lookup'].to_csv(os.path.join(data_dir, 'nldas_states_counties_regions.csv'), index=False)
+    inputs['water_cost'].to_csv(os.path.join(data_dir, 'water_costs_rev20220309.csv'), index=False)
+    inputs['hist_supply'].to_csv(os.path.join(data_dir, 'abm_hist_supply_avail_usda.csv'), index=False)
+    for name in ['usda farm budget summary (machine readable).xlsx', 'usda irrigation summary.xlsx',
+                 'usda irrigation water requirement.xlsx', 'water_proportions.csv']:
+        shutil.copy(os.path.join(source_dir, name), os.path.join(data_dir, name))
+
+
+def run_benchmark(grids, workdir='benchmark', years=YEARS, seed=0, workers=1, trace_memory=False):
+    # Generate the inputs of each grid and run the processing script on them, one process per grid so that the peak
+    # memory of each run is measured separately. Returns the run report of each grid (one row per grid and stage, see
+    # wmabm_instrument.RunReport).
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wmabm_data_process_HESS.py')
+    results = []
+    for grid in grids:
+        nx, ny, n_states, cell_area = GRIDS[grid]
+        run_dir = os.path.abspath(os.path.join(workdir, grid))
+        start = time.perf_counter()
+        inputs = make_inputs(nx, ny, n_states, cell_area=cell_area, years=years, seed=seed)
+        n_rows = len(inputs['cdl'])
+        write_inputs(inputs, os.path.join(run_dir, 'data'))
+        del inputs
+        print(grid + ': ' + str(nx * ny) + ' cells, ' + str(n_rows) + ' CDL rows, generated in ' +
+              str(round(time.perf_counter() - start, 1)) + ' s')
+
+        command = [sys.executable, script, '--no-cache', '--workers', str(workers), '--report', 'run_report']
+        if trace_memory:
+            command.append('--trace-memory')
+        result = subprocess.run(command, cwd=run_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise RuntimeError('the ' + grid + ' run failed (stages run so far in ' + os.path.join(run_dir, 'run_report.csv') +
+                               '):\n' + result.stderr[-2000:])
+        records = pd.read_csv(os.path.join(run_dir, 'run_report.csv'))
+        records.insert(0, 'grid', grid)
+        records.insert(1, 'cells', nx * ny)
+        records.insert(2, 'cdl_rows', n_rows)
+        records.insert(4, 'step', records['stage'].str.replace(r'_\d{4}$', '', regex=True).map(STAGE_STEPS).fillna(''))
+        print(records[['stage', 'step', 'wall_s', 'cpu_s', 'peak_traced_mb', 'peak_rss_mb']].to_string(index=False))
+        results.append(records)
+    return pd.concat(results, ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark wmabm_data_process_HESS.py on synthetic NLDAS-scale inputs')
+    parser.add_argument('--grids', nargs='+', choices=list(GRIDS), default=['state', 'conus'], help='grid sizes to run')
+    parser.add_argument('--workdir', default='benchmark', help='directory for the synthetic inputs and the outputs')
+    parser.add_argument('--years', nargs='+', type=int, default=YEARS, help='CDL years to generate')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic inputs')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for the redistribution of Step X')
+    parser.add_argument('--results', default='benchmark_results.csv', help='CSV file for the timings (in workdir)')
+    parser.add_argument('--trace-memory', action='store_true', help='also trace the peak memory of each stage (slower)')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.grids, workdir=args.workdir, years=args.years, seed=args.seed, workers=args.workers,
+                            trace_memory=args.trace_memory)
+    results.to_csv(os.path.join(args.workdir, args.results), index=False)
@@ -0,0 +1,300 @@
+# Content-addressed Parquet checkpoints for the staged data processing pipeline (see wmabm_data_process_HESS.py).
+# Each stage output is stored as <cache_dir>/<stage>-<key>.parquet, where the key is a hash of the stage code (with the
+# functions of this package it calls), its input tables, and its parameters. On a rerun, stages whose key is already in
+# the cache are read back from disk instead of being recomputed. The slow-to-parse USDA Excel workbooks are also
+# converted once to Parquet (read_excel_cached) and reused while the workbook is unchanged, and so are the filtered
+# columns of the NASS Quick Stats dump (read_quickstats_cached). Input files are wrapped in InputFile objects, which
+# are keyed by the sha256 of the file and only read when a stage that uses them has to run: after a change to one input
+# file, only the stages downstream of it are recomputed and the other input files are not even parsed.
+
+import hashlib
+import inspect
+import json
+import os
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = 'cache'
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEXT_SUFFIX = '::text'  # suffix of the companion column holding the string entries of a mixed number/string column
+INT_SUFFIX = '::int'  # suffix of the companion column marking the integer entries of a mixed column
+EXCEL_CACHE_FORMAT = 2  # version of the stored workbook layout, part of the file name so older copies are not read
+
+
+class InputFile:
+    # An input table read from path with reader(path, **kwargs) on first use. Stage keys use the sha256 of the file
+    # (file_digest) instead of the table contents, so cached stages never need to read it. cache_dir is also passed to
+    # readers that keep their own copy of the file (read_excel_cached, read_quickstats_cached).
+    def __init__(self, path, reader=pd.read_csv, cache_dir=CACHE_DIR, **kwargs):
+        self.path = path
+        self.reader = reader
+        self.cache_dir = cache_dir
+        self.kwargs = kwargs
+        self.table = None
+
+    def digest(self):
+        return file_digest(self.path, self.cache_dir)
+
+    def load(self):
+        if self.table is None:
+            kwargs = dict(self.kwargs)
+            if 'cache_dir' in inspect.signature(self.reader).parameters:
+                kwargs.setdefault('cache_dir', self.cache_dir)
+            self.table = self.reader(self.path, **kwargs)
+        return self.table
+
+
+def hash_frame(df):
+    # Hash the column names, dtypes, index, and values of a dataframe
+    h = hashlib.sha256()
+    h.update(json.dumps([str(c) for c in df.columns]).encode())
+    h.update(json.dumps([str(t) for t in df.dtypes]).encode())
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
+
+def code_names(code):
+    # Global names used by a code object and by the functions, lambdas, and comprehensions defined in it
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= code_names(const)
+    return names
+
+
+def in_package(obj):
+    # Whether a function or class is defined in a module of this directory (wmabm_tables.py, wmabm_grid.py, ...)
+    try:
+        source_file = inspect.getsourcefile(obj)
+    except TypeError:  # built-in
+        return False
+    return source_file is not None and os.path.dirname(os.path.abspath(source_file)) == PACKAGE_DIR
+
+
+def code_sources(func, sources=None):
+    # Source code of a stage function and of every function and class of this package it uses, directly or through
+    # other functions (e.g., the wmabm_tables kernels called by a stage), by qualified name
+    sources = {} if sources is None else sources
+    key = func.__module__ + '.' + func.__qualname__
+    if key in sources:
+        return sources
+    try:
+        sources[key] = inspect.getsource(func)
+    except OSError:  # source unavailable (e.g., interactive session), fall back to the compiled bytecode
+        sources[key] = func.__code__.co_code.hex() + repr(func.__code__.co_consts)
+    functions = [func] if inspect.isfunction(func) else [f for f in vars(func).values() if inspect.isfunction(f)]
+    for function in functions:
+        for name in sorted(code_names(function.__code__)):
+            obj = function.__globals__.get(name)
+            if (inspect.isfunction(obj) or inspect.isclass(obj)) and in_package(obj):
+                code_sources(obj, sources)
+    return sources
+
+
+def stage_key(name, func, inputs, params=None):
+    # Build the cache key for a stage from its name, source code (including the helpers it uses, see code_sources),
+    # input tables, and parameters
+    h = hashlib.sha256()
+    h.update(name.encode())
+    for key, source in sorted(code_sources(func).items()):
+        h.update(key.encode())
+        h.update(source.encode())
+    for input_name in sorted(inputs):
+        h.update(input_name.encode())
+        if isinstance(inputs[input_name], InputFile):
+            h.update(inputs[input_name].digest().encode())
+        else:
+            h.update(hash_frame(inputs[input_name]).encode())
+    h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:16]
+
+
+def parquet_safe(df):
+    # Parquet columns must hold a single type. USDA columns can mix numbers with leftover code strings ('(D)', 'NA',
+    # ...), so object columns are converted to numeric where every value parses, and to strings otherwise (nulls kept)
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        converted = pd.to_numeric(df[col], errors='coerce')
+        if converted.notna().sum() == df[col].notna().sum():
+            df[col] = converted
+        else:
+            df[col] = df[col].where(df[col].isnull(), df[col].astype(str))
+    return df
+
+
+def file_sha256(path):
+    # Hash the contents of a file in 1 MB blocks
+    h = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_digest(path, cache_dir=CACHE_DIR):
+    # sha256 of a file, remembered in <cache_dir>/inputs/file_digests.json by path, size, and mtime so that unchanged
+    # (possibly multi-GB) input files are not reread on every run
+    if cache_dir is None:
+        return file_sha256(path)
+    stat = os.stat(path)
+    digests_path = os.path.join(cache_dir, 'inputs', 'file_digests.json')
+    digests = {}
+    if os.path.exists(digests_path):
+        with open(digests_path) as handle:
+            digests = json.load(handle)
+    entry = digests.get(os.path.abspath(path))
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return entry['sha256']
+    digest = file_sha256(path)
+    digests[os.path.abspath(path)] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest}
+    os.makedirs(os.path.dirname(digests_path), exist_ok=True)
+    with open(digests_path + '.tmp', 'w') as handle:
+        json.dump(digests, handle, indent=1)
+    os.replace(digests_path + '.tmp', digests_path)
+    return digest
+
+
+def split_mixed(df):
+    # USDA survey columns mix numbers with code strings ('(D)', '-', 'NA', ...). To store them with a single type per
+    # column, keep the numbers in the original column (float64), move the strings to a <col>::text companion column, and
+    # mark the integer entries in a <col>::int column so that they are returned as int (5, not 5.0) as by pd.read_excel
+    df = df.copy()
+    mixed = []
+    for col in df.columns[df.dtypes == object]:
+        is_text = df[col].map(lambda v: isinstance(v, str)).astype(bool)
+        if is_text.all():
+            continue
+        is_int = df[col].map(lambda v: isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)))
+        df[col + TEXT_SUFFIX] = df[col].where(is_text)
+        df[col + INT_SUFFIX] = is_int.astype(bool)
+        df[col] = pd.to_numeric(df[col].where(~is_text), errors='coerce')
+        mixed.append(col)
+    return df, mixed
+
+
+def join_mixed(df, mixed):
+    # Inverse of split_mixed: rebuild the object columns holding numbers (int and float) and strings
+    for col in mixed:
+        values = df[col].astype(object)
+        is_int = df[col + INT_SUFFIX].to_numpy(dtype=bool)
+        values[is_int] = np.array([int(v) for v in df[col].to_numpy()[is_int]], dtype=object)
+        text = df[col + TEXT_SUFFIX]
+        values[text.notnull()] = text[text.notnull()]
+        df[col] = values
+        df = df.drop(columns=[col + TEXT_SUFFIX, col + INT_SUFFIX])
+    return df
+
+
+def read_excel_cached(path, cache_dir=CACHE_DIR, **kwargs):
+    # Drop-in replacement for pd.read_excel. The workbook is parsed once and stored as Parquet under
+    # <cache_dir>/inputs, together with a small json file recording the workbook mtime and sha256. The Parquet copy is
+    # reused as long as the workbook is unchanged (a new mtime with the same contents only refreshes the json file).
+    if cache_dir is None:
+        return pd.read_excel(path, **kwargs)
+
+    args_key = hashlib.sha256(json.dumps([EXCEL_CACHE_FORMAT, kwargs], sort_keys=True, default=str).encode()).hexdigest()[:8]
+    base = os.path.join(cache_dir, 'inputs', os.path.splitext(os.path.basename(path))[0] + '-' + args_key)
+    data_path = base + '.parquet'
+    meta_path = base + '.json'
+    mtime = os.path.getmtime(path)
+
+    if os.path.exists(data_path) and os.path.exists(meta_path):
+        with open(meta_path) as handle:
+            meta = json.load(handle)
+        if meta['mtime'] != mtime and meta['sha256'] == file_sha256(path):
+            meta['mtime'] = mtime
+            with open(meta_path, 'w') as handle:
+                json.dump(meta, handle)
+        if meta['mtime'] == mtime:
+            return join_mixed(pd.read_parquet(data_path), meta['mixed'])
+
+    print('parsing ' + path)
+    data, mixed = split_mixed(pd.read_excel(path, **kwargs))
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    data.to_parquet(data_path + '.tmp')
+    os.replace(data_path + '.tmp', data_path)
+    with open(meta_path, 'w') as handle:
+        json.dump({'source': path, 'mtime': mtime, 'sha256': file_sha256(path), 'mixed': mixed}, handle)
+    return join_mixed(data, mixed)
+
+
+def read_quickstats_cached(path, columns, filters=None, cache_dir=CACHE_DIR, chunksize=1000000):
+    # Read the given columns of a tab-separated NASS Quick Stats dump (qs.*.txt), keeping the rows whose value in each
+    # column of filters (dict of column -> allowed values) is one of the allowed values. The dump is streamed in chunks of
+    # chunksize rows, so memory use depends on the rows kept rather than on the size of the file. As in read_excel_cached,
+    # the result is stored as Parquet under <cache_dir>/inputs (one file per set of columns and filters) and reused while
+    # the dump is unchanged. Values are read as strings and columns where every value is a number are made numeric.
+    filters = {col: sorted(str(v) for v in values) for col, values in (filters or {}).items()}
+    columns = list(dict.fromkeys(list(columns) + list(filters)))
+    if cache_dir is not None:
+        query_key = hashlib.sha256(json.dumps([columns, filters]).encode()).hexdigest()[:8]
+        base = os.path.join(cache_dir, 'inputs', os.path.splitext(os.path.basename(path))[0] + '-' + query_key)
+        data_path = base + '.parquet'
+        meta_path = base + '.json'
+        mtime = os.path.getmtime(path)
+
+        if os.path.exists(data_path) and os.path.exists(meta_path):
+            with open(meta_path) as handle:
+                meta = json.load(handle)
+            if meta['mtime'] != mtime and meta['sha256'] == file_sha256(path):
+                meta['mtime'] = mtime
+                with open(meta_path, 'w') as handle:
+                    json.dump(meta, handle)
+            if meta['mtime'] == mtime:
+                return pd.read_parquet(data_path)
+
+    print('streaming ' + path)
+    chunks = []
+    for chunk in pd.read_csv(path, sep='\t', usecols=columns, dtype=str, chunksize=chunksize):
+        keep = pd.Series(True, index=chunk.index)
+        for col, values in filters.items():
+            keep &= chunk[col].isin(values)
+        chunks.append(chunk.loc[keep, columns])
+    data = pd.concat(chunks, ignore_index=True)
+    for col in data.columns:
+        converted = pd.to_numeric(data[col], errors='coerce')
+        if converted.notna().sum() == data[col].notna().sum():
+            data[col] = converted
+    if cache_dir is None:
+        return data
+
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    data.to_parquet(data_path + '.tmp')
+    os.replace(data_path + '.tmp', data_path)
+    with open(meta_path, 'w') as handle:
+        json.dump({'source': path, 'mtime': mtime, 'sha256': file_sha256(path), 'columns': columns, 'filters': filters},
+                  handle)
+    return pd.read_parquet(data_path)
+
+
+def run_stage(name, func, inputs, params=None, cache_dir=CACHE_DIR, report=None):
+    # Return the output of func(**inputs, **params), reading it from the cache if this exact stage has already run.
+    # InputFile inputs are only read when the stage runs. Set cache_dir to None to always recompute without touching the
+    # cache. If report (a wmabm_instrument.RunReport) is given, the stage is measured and recorded in it.
+    params = params or {}
+
+    def load_inputs():
+        return {input_name: table.load() if isinstance(table, InputFile) else table for input_name, table in inputs.items()}
+
+    with report.stage(name, inputs) if report is not None else nullcontext({}) as record:
+        if cache_dir is None:
+            result = func(**load_inputs(), **params)
+            record['cached'] = False
+        else:
+            key = stage_key(name, func, inputs, params)
+            path = os.path.join(cache_dir, name + '-' + key + '.parquet')
+            record['cached'] = os.path.exists(path)
+            if record['cached']:
+                print('stage ' + name + ': cached (' + key + ')')
+            else:
+                print('stage ' + name + ': running (' + key + ')')
+                output = parquet_safe(func(**load_inputs(), **params))
+                os.makedirs(cache_dir, exist_ok=True)
+                temp_path = path + '.tmp'
+                output.to_parquet(temp_path)
+                os.replace(temp_path, path)  # write then rename so an interrupted run never leaves a partial checkpoint
+            result = pd.read_parquet(path)  # read back so a fresh run and a cached run hand identical dtypes downstream
+        record['rows_out'] = len(result)
+    return result
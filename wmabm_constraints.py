@@ -0,0 +1,31 @@
+# Array-backed calibration constraint files for MOSART-WM-ABM. Step 8 of wmabm_data_process_HESS.py pickles each
+# constraint (gw / sw calibration water constraints, max_land_constr) as a dict of {position: value}, with one boxed
+# Python float per NLDAS cell. The same values are also written as a .npy structured array (fields NLDAS_ID and value)
+# sorted by NLDAS_ID, which can be memory-mapped without creating per-element Python objects. Only numpy is needed to
+# read them, so this module can be copied to the ABM as it is.
+
+import numpy as np
+
+CONSTRAINT_DTYPE = np.dtype([('NLDAS_ID', '<i8'), ('value', '<f8')])
+
+
+def write_constraint_array(path, nldas_id, values):
+    # Write the constraint values of the cells in nldas_id (sorted, unique) to path (.npy). The position of a cell in
+    # the file is its key in the pickled dict.
+    nldas_id = np.asarray(nldas_id)
+    if len(nldas_id) > 1 and not (np.diff(nldas_id) > 0).all():
+        raise ValueError('NLDAS_ID must be sorted and unique')
+    constraint = np.empty(len(nldas_id), dtype=CONSTRAINT_DTYPE)
+    constraint['NLDAS_ID'] = nldas_id
+    constraint['value'] = values
+    np.save(path, constraint)
+
+
+def load_constraint_array(path, mmap=True):
+    # Structured array (NLDAS_ID, value) of a constraint file, memory-mapped read-only unless mmap is False
+    return np.load(path, mmap_mode='r' if mmap else None)
+
+
+def load_constraint_dict(path):
+    # Constraint file as the {position: value} dict of the pickled constraint files
+    return dict(enumerate(load_constraint_array(path, mmap=False)['value'].tolist()))
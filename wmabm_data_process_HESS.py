@@ -5,233 +5,188 @@
 # crop prices and costs, and other data at 1/8 degree resolution (following the NLDAS grid). The resuting
 # data table serves as an input to the the parameterization of PMP agents for integration into MOSART-WM-ABM
 
+# The script is organized into named stages (one per "Step" section below). Each stage persists its output as a Parquet
+# checkpoint keyed by a hash of its code, input tables, and parameters (see wmabm_cache.py), so that a rerun only
+# executes the stages whose inputs have changed. Input files are only read when a stage that uses them has to run, so
+# after updating a single input (e.g., the water cost table) only the stages downstream of it are recomputed.
+
 #### Step 1 - Import Modules
 
+import argparse
+import os
+import pickle
+
 import pandas as pd
 import numpy as np
-import math
+
+from wmabm_cache import CACHE_DIR, InputFile, read_excel_cached, run_stage
+from wmabm_constraints import write_constraint_array
+from wmabm_grid import CellTable, write_nldas_netcdf
+from wmabm_instrument import RunReport, memory_mb, output_drift
+from wmabm_tables import (AREA_COLUMNS, CODE_D, CODE_DASH, CODE_EMPTY, CODE_NA, CODE_NA_PAREN, CODE_NULL, CODE_SUFFIX, CODE_VALUE, CODE_Z,
+                          apply_scaling_factors, area_shares, code_columns, coded_lookup, compact_dtypes,
+                          fill_unmatched_codes, floor_nir,
+                          impute_water_source_shares, irrigation_costs, normalize_sentinels, redistribute_lp,
+                          redistribute_parallel, redistribute_proportional, resolve_budget_items, siebert_scaling_factors)
 pd.set_option('display.expand_frame_repr', False)  # Modifies pandas settings to display all columns of dataframes
 
 #### Step 2 - Load External Data Tables
 
-# Load CDL observed crop data as a pandas dataframe. CDL data has been aggregated to 1/8 degree resolution and assigned
-# to GCAM crop categories as a pre-processing step in GIS.
-cdl = pd.read_csv('data/all_nldas_cdl_data_v3.txt')
+def load_inputs(cache_dir=CACHE_DIR):
+    # The input tables, as InputFile objects that read the file on first use (stages that are cached never read them)
+
+    # Load CDL observed crop data as a pandas dataframe. CDL data has been aggregated to 1/8 degree resolution and assigned
+    # to GCAM crop categories as a pre-processing step in GIS.
+    cdl = InputFile('data/all_nldas_cdl_data_v3.txt', cache_dir=cache_dir)
 
-#cdl_states = pd.read_csv('cdl_regions_join.csv')
+    #cdl_states = pd.read_csv('cdl_regions_join.csv')
 
-# Load USDA Farm Budget data (uses USDA crop categories at USDA agricultural regions as spatial unit)
-budget = pd.read_excel('data/usda farm budget summary (machine readable).xlsx')
+    # Load USDA Farm Budget data (uses USDA crop categories at USDA agricultural regions as spatial unit). The three USDA
+    # workbooks are parsed once and then read from a Parquet copy while unchanged (see wmabm_cache.read_excel_cached)
+    budget = InputFile('data/usda farm budget summary (machine readable).xlsx', read_excel_cached, cache_dir=cache_dir)
 
-# Load USDA Irrigation Survey data (uses USDA crop categories and States as spatial unit)
-irrigation = pd.read_excel('data/usda irrigation summary.xlsx')
+    # Load USDA Irrigation Survey data (uses USDA crop categories and States as spatial unit)
+    irrigation = InputFile('data/usda irrigation summary.xlsx', read_excel_cached, cache_dir=cache_dir)
 
-# Load siebert irrigation data
-siebert = pd.read_csv('data/siebert_irrigation.txt')
+    # Load siebert irrigation data
+    siebert = InputFile('data/siebert_irrigation.txt', cache_dir=cache_dir)
 
-# Load USDA Irrigation Water Requirement data (uses USDA crop categories and States as spatial unit)
-nir = pd.read_excel('data/usda irrigation water requirement.xlsx')
+    # Load USDA Irrigation Water Requirement data (uses USDA crop categories and States as spatial unit)
+    nir = InputFile('data/usda irrigation water requirement.xlsx', read_excel_cached, cache_dir=cache_dir)
 
-#nldas_states = pd.read_csv('../../wm abm data/nldas pmp inputs/nldas_states_lookup.txt')
+    #nldas_states = pd.read_csv('../../wm abm data/nldas pmp inputs/nldas_states_lookup.txt')
 
-# Load lookup table that geographically associates NLDAS cells, states, and USDA agricultural regions. The table was
-# pre-processed by spatial joining shapefiles in GIS
-nldas_lookup = pd.read_csv('data/nldas_states_counties_regions.csv')
+    # Load lookup table that geographically associates NLDAS cells, states, and USDA agricultural regions. The table was
+    # pre-processed by spatial joining shapefiles in GIS
+    nldas_lookup = InputFile('data/nldas_states_counties_regions.csv', cache_dir=cache_dir)
 
-# Load USDA Irrigation data on irrigation water by source (groundwater, surface water, off-farm surface water).
-# The data is provided at State level.
-water_perc = pd.read_csv('data/water_proportions.csv')
+    # Load USDA Irrigation data on irrigation water by source (groundwater, surface water, off-farm surface water).
+    # The data is provided at State level.
+    water_perc = InputFile('data/water_proportions.csv', cache_dir=cache_dir)
 
-# Load USDA Irrigation data on groundwater costs and surface water costs (at State level)
-# water_cost = pd.read_csv('data/water_costs.csv')
-water_cost = pd.read_csv('data/water_costs_rev20220309.csv')
+    # Load USDA Irrigation data on groundwater costs and surface water costs (at State level)
+    # water_cost = pd.read_csv('data/water_costs.csv')
+    water_cost = InputFile('data/water_costs_rev20220309.csv', cache_dir=cache_dir)
+
+    return {'cdl': cdl, 'budget': budget, 'irrigation': irrigation, 'siebert': siebert, 'nir': nir,
+            'nldas_lookup': nldas_lookup, 'water_perc': water_perc, 'water_cost': water_cost}
 
 #### Step 3 - Conduct Additional Processing of External Data
 
-# For each State, convert irrigation water totals into percents of irrigation water coming from each source
-# (groundwater, surface water, or off-farm surface water). For 'D' (no information / did not report) values,
-# assume countrywide averages.
-for index, row in water_perc.iterrows():
-    sum_perc = 0
-    total = row['Total']
-    if row['Groundwater'] == 'D':
-        sum_perc += water_perc[(water_perc['State'] == 'United States')]['Groundwater'].astype('float') / \
-                    water_perc[(water_perc['State'] == 'United States')]['Total'].astype('float')
-    else:
-        total -= float(row['Groundwater'])
-    if row['SW (Farm)'] == 'D':
-        sum_perc += water_perc[(water_perc['State'] == 'United States')]['SW (Farm)'].astype('float') / \
-                    water_perc[(water_perc['State'] == 'United States')]['Total'].astype('float')
-    else:
-        total -= float(row['SW (Farm)'])
-    if row['SW (off-farm)'] == 'D':
-        sum_perc += water_perc[(water_perc['State'] == 'United States')]['SW (off-farm)'].astype('float') / \
-                    water_perc[(water_perc['State'] == 'United States')]['Total'].astype('float')
-    else:
-        total -= float(row['SW (off-farm)'])
+def process_water_perc(water_perc, water_cost):
+    # For each State, convert irrigation water totals into percents of irrigation water coming from each source
+    # (groundwater, surface water, or off-farm surface water). For 'D' (no information / did not report) values,
+    # assume countrywide averages (all states and sources are filled in one pass, see
+    # wmabm_tables.impute_water_source_shares).
+    water_perc = impute_water_source_shares(water_perc, sources=['Groundwater', 'SW (Farm)', 'SW (off-farm)'],
+                                            total='Total', geography='State', national='United States', code='D')
+
+    water_perc['SW Total'] = water_perc['SW (off-farm)'] + water_perc['SW (Farm)']
+
+    # Merge irrigation water costs and irrigation water source tables
+    # water_perc = pd.merge(water_perc, water_cost,on='State',how='left')
+    water_perc = pd.merge(water_perc, water_cost[['State','gw_cost_est_$_acft','sw_cost_est_$_acft']],on='State',how='left')
+
+    # Calculate adjusted cost for all surface water sources assuming that on-farm surface water is free (do USDA SW costs
+    # include pumping costs?)
+    # water_perc['SW cost adj'] = (water_perc['SW (off-farm)'] / (water_perc['SW (Farm)'] + water_perc['SW (off-farm)'])) * water_perc['SW cost']
+
+    return water_perc
+
+
+def join_cdl_states(cdl, nldas_lookup):
+    # Merge CDL data with associated geographies (USDA Agricultural Regions and States)
+    # (gathered by NLDAS_ID from the lookup table, see wmabm_grid.CellTable)
+    cdl_states = CellTable(nldas_lookup).join(cdl, ['ERS_region','State','State_Name'])
+    return cdl_states
+
+
+def calc_cdl_states_total(cdl_states, year=2010):
+    # Calculate total available arable land for each NLDAS cell using CDL (using the data of the given year). Assumes that
+    # GCAM categories 'NotAvailable', 'RockIceDesert', and 'UrbanLand' are not available for agricultural use
+    cdl_states_select_year = cdl_states[(cdl_states['year'] == year)]
+    aggregation_functions = {'value': 'sum'}
+
+    cdl_states_total = cdl_states_select_year.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
+
+    # Area of each unavailable category in the cell (first row of the cell, gathered by NLDAS_ID)
+    for name, gcam_name in [('notavail', 'NotAvailable'), ('rock', 'RockIceDesert'), ('urban', 'UrbanLand')]:
+        category = cdl_states_select_year[(cdl_states_select_year['GCAM_name']) == gcam_name]
+        category = category.rename(columns={"value": name})
+        cdl_states_total[name] = CellTable(category, duplicates='first').gather(cdl_states_total['NLDAS_ID'], [name])[name]
+    cdl_states_total = cdl_states_total.set_index('NLDAS_ID')
+
+    cdl_states_total['avail'] = cdl_states_total['value'] - cdl_states_total['urban'] - cdl_states_total['rock'] - cdl_states_total['notavail']
+
+    cdl_states_total = cdl_states_total[~cdl_states_total.index.duplicated(keep='first')]
+    return cdl_states_total
+
+
+def build_budget_table_lookup(budget, year=2010):
+    # Extract required data from USDA budget dataframe
+
+    # Create new budget table to load data into from source budget table
+    cols = ['crop', 'region', 'total costs', 'irr water costs', 'yield', 'price', 'opplabor', 'oppland']
+    items = ['Total, costs listed','Purchased irrigation water','Yield','Price','Opportunity cost of unpaid labor','Opportunity cost of land']
+
+    # For each crop and USDA ag region, extract relevant information from the source budget table for the year. If data
+    # for the year is missing, use the most recent year available for the region. If data is missing for the region,
+    # assume United States averages. If United States averages are missing, fill in value with a temporary '99999' value.
+    # All crop/region/item combinations are resolved in one pass over an index of the budget table
+    # (see wmabm_tables.resolve_budget_items). Beets report 'Season-average price' instead of 'Price'.
+    budget_table_lookup = resolve_budget_items(budget, items, cols, base_year=year,
+                                               substitutions={('Beets', 'Price'): 'Season-average price'})
+
+    # Add in Potato budget data from University of Idaho Survey (2010 southwestern idaho irrigated russet burbank commercial
+    # potatos: with fumigation and non storage)
+    budget_table_lookup.loc[-1] = ['Potato', 'U.S. total', 2190, 119.05, 515, 7, 0, 0] ##### added from university of idaho survey
+    # Add in Sorghum Hay budget data from Ibendahl 2019 report (South Central Kansas)
+    budget_table_lookup.loc[-2] = ['Sorghum Hay', 'U.S. total', 314.26, 0, 10.90, 24.55, 0, 0] #### added from Ibendahl 2019 report (South Central Kansas)
+    return budget_table_lookup
+
+
+def supplement_usda_tables(nir, irrigation):
+    nir = nir.copy()
+    irrigation = irrigation.copy()
+
+    # Add in additional irrigation, NIR, and budget data for missing crops from various sources (note: assumes local/state
+    # sources apply to entire U.S.) PDFs can be found in report folders.
+
+    # Add Potato NIR from Western Ag Research doc (table 3), assumed to apply across United States
+    nir.loc[-1] = ['United States (2013)', 'Potato', 1.67]
+    # Add in Sugarbeet NIR from Idaho data (table 2 and 3), assumed to apply across United States
+    nir.loc[-2] = ['United States (2013)', 'Sugarbeet', 4.52] ##### added from idaho data (table 2 and table 3)
+    # Add in Sugarbeet irrigated area and yield data from Western Ag Research doc (table 3), and USDA documentation
+    # assume zero non-irrigated area
+    #irrigation.loc[-1] = ['United States (2013)', 'Potato', 'NA', 414, 'cwt/acre', 'NA', 'NA', 'NA']
+    irrigation.loc[-2] = ['United States (2013)', 'Sugarbeet', 1113000, 34.5, 'ton/acre', 0, 'NA', 'NA']
+    return nir, irrigation
+
+
+# USDA survey columns holding numbers mixed with sentinel strings ('-', '(Z)', '(D)', '(NA)', 'NA', '')
+nir_keys = ['Irrigation (acre-ft/acre)']
+area_keys = ['Area Irrigated (Acres)', 'Area Non-Irrigated (Acres)']
+yield_keys = ['Yield Irrigated', 'Yield Non-Irrigated']
+
+
+def normalize_usda_tables(nir, irrigation):
+    # Convert the USDA survey columns to float values plus a uint8 code column recording the sentinel present in each
+    # entry (one pass per column at load time, see wmabm_tables.normalize_sentinels). The imputation rules in Step 5
+    # work on these codes.
+    nir = normalize_sentinels(nir, nir_keys)
+    irrigation = normalize_sentinels(irrigation, area_keys + yield_keys)
+    return nir, irrigation
+
+
+def prepare_nir(nir, irrigation):
+    # Supplemented and normalized NIR table (stage output)
+    return normalize_usda_tables(*supplement_usda_tables(nir, irrigation))[0]
+
+
+def prepare_irrigation(nir, irrigation):
+    # Supplemented and normalized irrigation survey table (stage output)
+    return normalize_usda_tables(*supplement_usda_tables(nir, irrigation))[1]
 
-    if row['Groundwater'] == 'D':
-        perc = water_perc[(water_perc['State'] == 'United States')]['Groundwater'].astype('float') / \
-               water_perc[(water_perc['State'] == 'United States')]['Total'].astype('float') / sum_perc
-        new_value = perc * total / row['Total']
-        new_value = new_value.values[0]
-    else:
-        new_value = float(row['Groundwater']) / row['Total']
-    water_perc.set_value(index, 'Groundwater', new_value)
-    if row['SW (Farm)'] == 'D':
-        perc = water_perc[(water_perc['State'] == 'United States')]['SW (Farm)'].astype('float') / \
-               water_perc[(water_perc['State'] == 'United States')]['Total'].astype('float') / sum_perc
-        new_value = perc * total / row['Total']
-        new_value = new_value.values[0]
-    else:
-        new_value = float(row['SW (Farm)']) / row['Total']
-    water_perc.set_value(index, 'SW (Farm)', new_value)
-    if row['SW (off-farm)'] == 'D':
-        perc = water_perc[(water_perc['State'] == 'United States')]['SW (off-farm)'].astype('float') / \
-               water_perc[(water_perc['State'] == 'United States')]['Total'].astype('float') / sum_perc
-        new_value = perc * total / row['Total']
-        new_value = new_value.values[0]
-    else:
-        new_value = float(row['SW (off-farm)']) / row['Total']
-    water_perc.set_value(index, 'SW (off-farm)', new_value)
-
-water_perc['SW Total'] = water_perc['SW (off-farm)'] + water_perc['SW (Farm)']
-
-# Merge irrigation water costs and irrigation water source tables
-# water_perc = pd.merge(water_perc, water_cost,on='State',how='left')
-water_perc = pd.merge(water_perc, water_cost[['State','gw_cost_est_$_acft','sw_cost_est_$_acft']],on='State',how='left')
-
-# Calculate adjusted cost for all surface water sources assuming that on-farm surface water is free (do USDA SW costs
-# include pumping costs?)
-# water_perc['SW cost adj'] = (water_perc['SW (off-farm)'] / (water_perc['SW (Farm)'] + water_perc['SW (off-farm)'])) * water_perc['SW cost']
-
-# Merge CDL data with associated geographies (USDA Agricultural Regions and States)
-cdl_states = pd.merge(cdl, nldas_lookup[['NLDAS_ID','ERS_region','State','State_Name']],on='NLDAS_ID',how='left')
-
-# Calculate total available arable land for each NLDAS cell using CDL (using year 2010 data). Assumes that
-# GCAM categories 'NotAvailable', 'RockIceDesert', and 'UrbanLand' are not available for agricultural use
-cdl_states_select_year = cdl_states[(cdl_states['year'] == 2010)]
-aggregation_functions = {'value': 'sum'}
-
-cdl_states_total = cdl_states_select_year.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
-cdl_states_total = cdl_states_total.set_index('NLDAS_ID')
-
-notavail = cdl_states_select_year[(cdl_states_select_year['GCAM_name']) == 'NotAvailable'].set_index('NLDAS_ID')
-notavail = notavail.rename(columns={"value": "notavail"})
-
-rock = cdl_states_select_year[(cdl_states_select_year['GCAM_name']) == 'RockIceDesert'].set_index('NLDAS_ID')
-rock = rock.rename(columns={"value": "rock"})
-
-urban = cdl_states_select_year[(cdl_states_select_year['GCAM_name']) == 'UrbanLand'].set_index('NLDAS_ID')
-urban = urban.rename(columns={"value": "urban"})
-
-cdl_states_total = pd.merge(cdl_states_total, notavail[['notavail']],left_index=True,right_index=True,how='left')
-cdl_states_total = pd.merge(cdl_states_total, rock[['rock']],left_index=True,right_index=True,how='left')
-cdl_states_total = pd.merge(cdl_states_total, urban[['urban']],left_index=True,right_index=True,how='left')
-
-cdl_states_total['avail'] = cdl_states_total['value'] - cdl_states_total['urban'] - cdl_states_total['rock'] - cdl_states_total['notavail']
-
-cdl_states_total = cdl_states_total[~cdl_states_total.index.duplicated(keep='first')]
-
-# Extract required data from USDA budget dataframe
-
-# Create new budget table to load data into from source budget table
-cols = ['crop', 'region', 'total costs', 'irr water costs', 'yield', 'price', 'opplabor', 'oppland']
-items = ['Total, costs listed','Purchased irrigation water','Yield','Price','Opportunity cost of unpaid labor','Opportunity cost of land']
-budget_table_lookup = pd.DataFrame(columns=cols)
-
-# For each crop and USDA ag region, loop through the source budget table and extract relevant information for year 2010.
-# If data is missing for any specific item, assume United States averages. If United States averages are missing,
-# fill in value with a temporary '99999' value
-for crop in budget.Commodity.unique():
-    for region in budget.Region.unique():
-        item_list = [crop, region]
-        for i in items:
-            if crop == 'Beets' and i == 'Price':
-                i = 'Season-average price'
-            try:
-                item_value = budget[(budget['Commodity'] == crop) & (budget['Region'] == region) & (budget['Year'] == 2010)
-                       & (budget['Item'] == i)].Value.values[0] ##### Total costs
-            except IndexError:
-
-                try:
-                    year_max = total_cost = budget[(budget['Commodity'] == crop) & (budget['Region'] == region)].Year.max()
-                    item_value = budget[(budget['Commodity'] == crop) & (budget['Region'] == region) & (budget['Year'] == year_max)
-                       & (budget['Item'] == i)].Value.values[0] ##### Total costs
-                except IndexError:
-                    try:
-                        item_value = \
-                        budget[(budget['Commodity'] == crop) & (budget['Region'] == 'U.S. total') & (budget['Year'] == 2010)
-                               & (budget['Item'] == i)].Value.values[0]  ##### Total costs
-                    except IndexError:
-                        try:
-                            year_max = total_cost = budget[(budget['Commodity'] == crop) & (budget['Region'] == 'U.S. total')].Year.max()
-                            item_value = \
-                            budget[(budget['Commodity'] == crop) & (budget['Region'] == 'U.S. total') & (budget['Year'] == year_max)
-                                   & (budget['Item'] == i)].Value.values[0]  ##### Total costs
-                        except IndexError:
-                            item_value = 99999
-
-            item_list.append(item_value)
-
-            # try:
-            #     if crop == 'Beets': ##### for Beets, most recent available year of data is 2007
-            #         total_cost = budget[(budget['Commodity'] == crop) & (budget['Region'] == region) & (budget['Year'] == 2007)
-            #                             & (budget['Item'] == "Total, costs listed")].Value.values[0]  ##### Total costs
-            # except IndexError:
-            #     total_cost = 99999
-            #
-            # try:
-            #     irr_water_cost = budget[(budget['Commodity'] == crop) & (budget['Region'] == region) & (budget['Year'] == 2010)
-            #            & (budget['Item'] == "Purchased irrigation water")].Value.values[0] ##### Purchased irrigation water
-            # except IndexError:
-            #     irr_water_cost = 99999
-            #
-            # try:
-            #     yld = budget[(budget['Commodity'] == crop) & (budget['Region'] == region) & (budget['Year'] == 2010)
-            #            & (budget['Item'] == "Yield")].Value.values[0] ##### Yield
-            # except IndexError:
-            #     yld = 99999
-            #
-            # try:
-            #     price = budget[(budget['Commodity'] == crop) & (budget['Region'] == region) & (budget['Year'] == 2010)
-            #            & (budget['Item'] == "Price")].Value.values[0] ##### Yield
-            # except IndexError:
-            #     price = 99999
-            #
-            # try:
-            #     opplabor = budget[(budget['Commodity'] == crop) & (budget['Region'] == region) & (budget['Year'] == 2010)
-            #            & (budget['Item'] == "Opportunity cost of unpaid labor")].Value.values[0] ##### Opportunity cost of unpaid labor
-            # except IndexError:
-            #     opplabor = 99999
-            #
-            # try:
-            #     oppland = budget[(budget['Commodity'] == crop) & (budget['Region'] == region) & (budget['Year'] == 2010)
-            #            & (budget['Item'] == "Opportunity cost of land")].Value.values[0] ##### Opportunity cost of land
-            # except IndexError:
-            #     oppland = 99999
-
-        lst = [item_list]
-        table_append = pd.DataFrame(lst, columns=cols)
-        budget_table_lookup = budget_table_lookup.append(table_append, ignore_index=True)
-
-
-# Add in additional irrigation, NIR, and budget data for missing crops from various sources (note: assumes local/state
-# sources apply to entire U.S.) PDFs can be found in report folders.
-
-# Add Potato NIR from Western Ag Research doc (table 3), assumed to apply across United States
-nir.loc[-1] = ['United States (2013)', 'Potato', 1.67]
-# Add in Sugarbeet NIR from Idaho data (table 2 and 3), assumed to apply across United States
-nir.loc[-2] = ['United States (2013)', 'Sugarbeet', 4.52] ##### added from idaho data (table 2 and table 3)
-# Add in Sugarbeet irrigated area and yield data from Western Ag Research doc (table 3), and USDA documentation
-# assume zero non-irrigated area
-#irrigation.loc[-1] = ['United States (2013)', 'Potato', 'NA', 414, 'cwt/acre', 'NA', 'NA', 'NA']
-irrigation.loc[-2] = ['United States (2013)', 'Sugarbeet', 1113000, 34.5, 'ton/acre', 0, 'NA', 'NA']
-# Add in Potato budget data from University of Idaho Survey (2010 southwestern idaho irrigated russet burbank commercial
-# potatos: with fumigation and non storage)
-budget_table_lookup.loc[-1] = ['Potato', 'U.S. total', 2190, 119.05, 515, 7, 0, 0] ##### added from university of idaho survey
-# Add in Sorghum Hay budget data from Ibendahl 2019 report (South Central Kansas)
-budget_table_lookup.loc[-2] = ['Sorghum Hay', 'U.S. total', 314.26, 0, 10.90, 24.55, 0, 0] #### added from Ibendahl 2019 report (South Central Kansas)
 
 #### Step 4 - Define Crop Name Mappings between various tables (CDL/GCAM, USDA Irrigation, USDA NIR, USDA Budget)
 
@@ -267,190 +222,126 @@ usda_unassigned = {'Land in vegetables': ['Beans, dry edible', 'Peanuts for nuts
                    }
 
 #### Step 5 - Loop through crops and run table joins, calculations, etc.
-first = True
-# Initiate for loop for each GCAM crop category
-for key2, value in crop_name_map.items():
-
-
-    # Extract subset of data for crop from the CDL data table
-
-    cdl_states_select = cdl_states[(cdl_states['GCAM_name'] == value['gcam']) & (cdl_states['year'] == 2010)]
+def join_crop_tables(cdl_states, budget_table_lookup, nir, irrigation, siebert, year=2010, crop_name_map=crop_name_map,
+                     usda_unassigned=usda_unassigned):
+    # All GCAM crop categories are processed at once: the crop name mappings are expressed as mapping tables and joined
+    # against the CDL table, and every join and fill below runs once over the rows of all crops.
+    crop_map = pd.DataFrame.from_dict(crop_name_map, orient='index').add_prefix('map_')
+    crop_map['map_order'] = np.arange(len(crop_map))
+    unassigned_map = pd.DataFrame([(rep_crop, unassigned_crop) for rep_crop, unassigned_crops in usda_unassigned.items()
+                                   for unassigned_crop in unassigned_crops], columns=['map_irrigation', 'unassigned_crop'])
+    map_columns = list(crop_map.columns)
+
+    # Extract subset of data for the GCAM crops and year from the CDL data table, ordered by crop (in the order of
+    # crop_name_map)
+    cdl_states_select = cdl_states[(cdl_states['GCAM_name'].isin(crop_map['map_gcam'])) & (cdl_states['year'] == year)]
     cdl_states_select = cdl_states_select.drop_duplicates()
-
-    # Calculate cropped area by proportion at the state level (State cropped area / Total United States cropped area)
-    # and store results in new table (cdl_states_proportion)
-
-    cdl_states_select['cdl_perc'] = 0
-    cdl_states_proportion = pd.DataFrame(columns=['state','total_cdl'])
-    for state in cdl_states_select.State_Name.unique():
-        crop_sum = cdl_states_select[(cdl_states_select['State_Name'] == state)].value.sum()
-        if crop_sum != 0:
-            cdl_states_select.loc[cdl_states_select.State_Name == state, 'cdl_perc'] = cdl_states_select.value / crop_sum
-        lst = [[state, crop_sum]]
-        table_append = pd.DataFrame(lst, columns=['state','total_cdl'])
-        cdl_states_proportion = cdl_states_proportion.append(table_append, ignore_index=True)
-    cdl_states_proportion['state_perc'] = cdl_states_proportion['total_cdl'] / cdl_states_proportion.total_cdl.sum()
-
+    cdl_states_select = cdl_states_select.assign(row_order=np.arange(len(cdl_states_select)))
+    cdl_states_select = pd.merge(cdl_states_select, crop_map, left_on='GCAM_name', right_on='map_gcam', how='inner')
+    cdl_states_select = cdl_states_select.sort_values(['map_order', 'row_order'], kind='mergesort').drop(columns='row_order')
+    cdl_states_select = cdl_states_select.reset_index(drop=True)
+
+    # Calculate cropped area by proportion within each crop and state (cell cropped area / State cropped area) and at the
+    # state level (State cropped area / Total United States cropped area), see wmabm_tables.area_shares
+    shares = area_shares(cdl_states_select, value='value', crop='map_order', state='State_Name')
+    cdl_states_select['cdl_perc'] = shares['cdl_perc']
+    cdl_states_proportion = pd.DataFrame({'state': cdl_states_select['State_Name'], 'total_cdl': shares['total_cdl'],
+                                          'state_perc': shares['state_perc']})
 
     # Join budget table to CDL table
 
-    budget_table_lookup_select = budget_table_lookup[(budget_table_lookup['crop']==value['budget'])]
-    cdl_states_merge = pd.merge(cdl_states_select, budget_table_lookup_select[['region','total costs','irr water costs','yield','price','opplabor','oppland']],left_on='ERS_region',right_on='region',how='left')
+    budget_cols = ['total costs','irr water costs','yield','price','opplabor','oppland']
+    cdl_states_merge = pd.merge(cdl_states_select, budget_table_lookup[['crop','region'] + budget_cols],
+                                left_on=['map_budget','ERS_region'], right_on=['crop','region'], how='left').drop(columns='crop')
 
     # For CDL rows that are missing budget data after the join (99999, null values), replace with U.S. averages
-    cdl_states_merge['total costs'] = np.where(cdl_states_merge['total costs'] == 99999,
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['total costs'], cdl_states_merge['total costs'])
-    cdl_states_merge['total costs'] = np.where(cdl_states_merge['total costs'].isnull(),
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['total costs'], cdl_states_merge['total costs'])
-
-    cdl_states_merge['irr water costs'] = np.where(cdl_states_merge['irr water costs'] == 99999,
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['irr water costs'], cdl_states_merge['irr water costs'])
-    cdl_states_merge['irr water costs'] = np.where(cdl_states_merge['irr water costs'].isnull(),
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['irr water costs'], cdl_states_merge['irr water costs'])
-
-    cdl_states_merge['yield'] = np.where(cdl_states_merge['yield'] == 99999,
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['yield'], cdl_states_merge['yield'])
-    cdl_states_merge['yield'] = np.where(cdl_states_merge['yield'].isnull(),
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['yield'], cdl_states_merge['yield'])
+    budget_us = budget_table_lookup[(budget_table_lookup['region']=='U.S. total')].drop_duplicates('crop').set_index('crop')
+    for col in budget_cols:
+        budget_us_col = cdl_states_merge['map_budget'].map(budget_us[col])
+        cdl_states_merge[col] = np.where((cdl_states_merge[col] == 99999) | cdl_states_merge[col].isnull(),
+                                         budget_us_col, cdl_states_merge[col])
 
-    cdl_states_merge['price'] = np.where(cdl_states_merge['price'] == 99999,
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['price'], cdl_states_merge['price'])
-    cdl_states_merge['price'] = np.where(cdl_states_merge['price'].isnull(),
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['price'], cdl_states_merge['price'])
+    # Join NIR table to CDL table (NIR values were normalized to float values plus sentinel codes at load time, see
+    # wmabm_tables.normalize_sentinels)
 
-    cdl_states_merge['opplabor'] = np.where(cdl_states_merge['opplabor'] == 99999,
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['opplabor'], cdl_states_merge['opplabor'])
-    cdl_states_merge['opplabor'] = np.where(cdl_states_merge['opplabor'].isnull(),
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['opplabor'], cdl_states_merge['opplabor'])
-
-    cdl_states_merge['oppland'] = np.where(cdl_states_merge['oppland'] == 99999,
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['oppland'], cdl_states_merge['oppland'])
-    cdl_states_merge['oppland'] = np.where(cdl_states_merge['oppland'].isnull(),
-                                               budget_table_lookup_select[(budget_table_lookup_select['region']=='U.S. total')]['oppland'], cdl_states_merge['oppland'])
-
-    # Join NIR table to CDL table
-
-    nir_select = nir[(nir['Crop']==value['nir'])]
-    cdl_states_merge = pd.merge(cdl_states_merge, nir_select[['Geography','Irrigation (acre-ft/acre)']],left_on='State_Name',right_on='Geography',how='left')
+    cdl_states_merge = pd.merge(cdl_states_merge, nir[['Crop','Geography'] + code_columns(nir_keys)],
+                                left_on=['map_nir','State_Name'], right_on=['Crop','Geography'], how='left').drop(columns='Crop')
+    cdl_states_merge = fill_unmatched_codes(cdl_states_merge, nir_keys)
 
     # For CDL rows that are missing NIR values after the join, fill in with 0 or United States averages where appropriate
+    nir_value = cdl_states_merge['Irrigation (acre-ft/acre)'].to_numpy(dtype=float, copy=True)
+    nir_code = cdl_states_merge['Irrigation (acre-ft/acre)' + CODE_SUFFIX].to_numpy()
+    nir_us, _, _ = coded_lookup(nir, 'Irrigation (acre-ft/acre)', cdl_states_merge['map_nir'], 'United States (2013)')
 
     # Replace '-' entries with 0
-    # cdl_states_merge['Irrigation (acre-ft/acre)'] = np.where(cdl_states_merge['Irrigation (acre-ft/acre)'] == '-',
-    #                                           0, cdl_states_merge['Irrigation (acre-ft/acre)'])
     # !JY! -(dash values are supposed to be 0 per USDA, we replace with US averages)
-    cdl_states_merge['Irrigation (acre-ft/acre)'] = np.where(cdl_states_merge['Irrigation (acre-ft/acre)'] == '-',
-                                              pd.to_numeric(nir_select['Irrigation (acre-ft/acre)'], errors='coerce').min(), cdl_states_merge['Irrigation (acre-ft/acre)'])
-    # Replace '(D)' entries with US average (could not be reported to give away identify of farm)
-    cdl_states_merge['Irrigation (acre-ft/acre)'] = np.where(cdl_states_merge['Irrigation (acre-ft/acre)'] == '(D)',
-                                              nir_select[(nir_select['Geography']=='United States (2013)')]['Irrigation (acre-ft/acre)'], cdl_states_merge['Irrigation (acre-ft/acre)'])
-    # Replace '(NA)' entries with US average (could not be reported to give away identify of farm)
-    cdl_states_merge['Irrigation (acre-ft/acre)'] = np.where(cdl_states_merge['Irrigation (acre-ft/acre)'] == 'NA',
-                                              nir_select[(nir_select['Geography']=='United States (2013)')]['Irrigation (acre-ft/acre)'], cdl_states_merge['Irrigation (acre-ft/acre)'])
-    # Replace '' entries with US average (could not be reported to give away identify of farm)
-    cdl_states_merge['Irrigation (acre-ft/acre)'] = np.where(cdl_states_merge['Irrigation (acre-ft/acre)'] == '',
-                                              nir_select[(nir_select['Geography']=='United States (2013)')]['Irrigation (acre-ft/acre)'], cdl_states_merge['Irrigation (acre-ft/acre)'])
-    # Replace '' entries with US average (could not be reported to give away identify of farm)
-    cdl_states_merge['Irrigation (acre-ft/acre)'] = np.where(cdl_states_merge['Irrigation (acre-ft/acre)'].isnull(),
-                                              nir_select[(nir_select['Geography']=='United States (2013)')]['Irrigation (acre-ft/acre)'], cdl_states_merge['Irrigation (acre-ft/acre)'])
+    nir_min = cdl_states_merge['map_nir'].map(nir.groupby('Crop')['Irrigation (acre-ft/acre)'].min()).to_numpy(dtype=float)
+    nir_value = np.where(nir_code == CODE_DASH, nir_min, nir_value)
+    # Replace '(D)' (could not be reported to give away identify of farm), 'NA', '' and missing entries with US average
+    nir_fill_us = np.isin(nir_code, [CODE_D, CODE_NA, CODE_EMPTY, CODE_NULL]) | ((nir_code == CODE_DASH) & np.isnan(nir_min))
+    cdl_states_merge['Irrigation (acre-ft/acre)'] = np.where(nir_fill_us, nir_us, nir_value)
 
     # Join Irrigation table to CDL table
 
-    irrigation_select = irrigation[(irrigation['Crop']==value['irrigation'])]
-    cdl_states_merge = pd.merge(cdl_states_merge, irrigation_select[['Geography','Area Irrigated (Acres)','Yield Irrigated', 'Area Non-Irrigated (Acres)', 'Yield Non-Irrigated']],
-                                left_on='State_Name', right_on='Geography', how='left')
-    cdl_states_merge = pd.merge(cdl_states_merge, cdl_states_proportion, left_on='State_Name', right_on='state', how='left')
-
-    # For CDL rows that are missing Irrigation data after the join, fill in with 0 (where appropriate) or a large negative value. The large
-    # negative value will indicate that the irrigated and non-irrigated areas needs to be estimated
-    keys = ['Area Irrigated (Acres)', 'Area Non-Irrigated (Acres)']
-
-    for key in keys:
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '-', 0, cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '(Z)', 0, cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '', -99999999999, cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == 'NA', -99999999999, cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '(NA)', -99999999999, cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '(D)', -99999999999, cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key].isnull(), -99999999999, cdl_states_merge[key])
-
-    # If there are unassigned USDA crops associated with the current crop selected in the loop, add the irrigated and
-    # non-irrigated areas for the unassigned crop
-    if value['irrigation'] in usda_unassigned.keys():
-        for unassigned_crop in usda_unassigned[value['irrigation']]:
-            irrigation_select_unassigned = irrigation[(irrigation['Crop'] == unassigned_crop)]
-            for key in keys:
-                irrigation_select_unassigned[key] = np.where(irrigation_select_unassigned[key] == '-', 0, irrigation_select_unassigned[key])
-                irrigation_select_unassigned[key] = np.where(irrigation_select_unassigned[key] == '(Z)', 0, irrigation_select_unassigned[key])
-                irrigation_select_unassigned[key] = np.where(irrigation_select_unassigned[key] == '', -99999999999, irrigation_select_unassigned[key])
-                irrigation_select_unassigned[key] = np.where(irrigation_select_unassigned[key] == 'NA', -99999999999, irrigation_select_unassigned[key])
-                irrigation_select_unassigned[key] = np.where(irrigation_select_unassigned[key] == '(NA)', -99999999999, irrigation_select_unassigned[key])
-                irrigation_select_unassigned[key] = np.where(irrigation_select_unassigned[key] == '(D)', -99999999999, irrigation_select_unassigned[key])
-                irrigation_select_unassigned[key] = np.where(irrigation_select_unassigned[key].isnull(), -99999999999, irrigation_select_unassigned[key])
-            irrigation_select_unassigned['irrigated add'] = irrigation_select_unassigned['Area Irrigated (Acres)']
-            irrigation_select_unassigned['nonirrigated add'] = irrigation_select_unassigned['Area Non-Irrigated (Acres)']
-            cdl_states_merge = pd.merge(cdl_states_merge, irrigation_select_unassigned[['Geography','irrigated add','nonirrigated add']],
-                                left_on='State_Name', right_on='Geography', how='left')
-
-            cdl_states_merge['Area Irrigated (Acres)'] = cdl_states_merge['Area Irrigated (Acres)'] + cdl_states_merge['irrigated add']
-            cdl_states_merge['Area Non-Irrigated (Acres)'] = cdl_states_merge['Area Non-Irrigated (Acres)'] + cdl_states_merge['nonirrigated add']
-            cdl_states_merge = cdl_states_merge.drop(columns=['irrigated add', 'nonirrigated add', 'Geography'])
-
-            # cdl_states_merge.to_csv('test_' + unassigned_crop + '.csv') ####!!JY TEST TO SEE IF ADDITIONS WORKING PROPERLY
+    cdl_states_merge = pd.merge(cdl_states_merge, irrigation[['Crop','Geography'] + code_columns(area_keys + yield_keys)],
+                                left_on=['map_irrigation','State_Name'], right_on=['Crop','Geography'], how='left',
+                                suffixes=('_x', '_y')).drop(columns='Crop')
+    cdl_states_merge = fill_unmatched_codes(cdl_states_merge, area_keys + yield_keys)
+    cdl_states_merge = pd.concat([cdl_states_merge, cdl_states_proportion], axis=1)
+
+    # For CDL rows that are missing Irrigation data after the join, fill in with 0 ('-' and '(Z)' entries) or flag the
+    # area as unreported ('(D)', '(NA)', 'NA', '' and missing entries, code >= CODE_D). Unreported irrigated and
+    # non-irrigated areas are estimated below
+    area_value = {}
+    area_code = {}
+    for key in area_keys:
+        area_code[key] = cdl_states_merge[key + CODE_SUFFIX].to_numpy()
+        area_value[key] = np.where(area_code[key] < CODE_D, np.nan_to_num(cdl_states_merge[key].to_numpy(dtype=float)), 0)
+
+    # If there are unassigned USDA crops associated with a representative crop, add the irrigated and non-irrigated
+    # areas for the unassigned crops. States without a row for any of the unassigned crops leave the area undefined (nan).
+    unassigned = pd.merge(unassigned_map, irrigation[['Crop','Geography'] + code_columns(area_keys)],
+                          left_on='unassigned_crop', right_on='Crop', how='inner')
+    unassigned_add = unassigned[['map_irrigation', 'Geography']].assign(n_unassigned=1)
+    for key in area_keys:
+        add_code = unassigned[key + CODE_SUFFIX]
+        unassigned_add[key] = np.where(add_code < CODE_D, unassigned[key].fillna(0), 0)
+        unassigned_add[key + CODE_SUFFIX] = add_code
+    unassigned_add = unassigned_add.groupby(['map_irrigation', 'Geography'], as_index=False).agg(
+        {'n_unassigned': 'sum', **{key: 'sum' for key in area_keys}, **{key + CODE_SUFFIX: 'max' for key in area_keys}})
+    unassigned_merge = pd.merge(cdl_states_merge[['map_irrigation', 'State_Name']], unassigned_add,
+                                left_on=['map_irrigation', 'State_Name'], right_on=['map_irrigation', 'Geography'], how='left')
+    n_unassigned = cdl_states_merge['map_irrigation'].map(unassigned_map.groupby('map_irrigation').size()).fillna(0).to_numpy()
+    complete = unassigned_merge['n_unassigned'].fillna(0).to_numpy() == n_unassigned
+    for key in area_keys:
+        add_value = np.where(complete, unassigned_merge[key].fillna(0).to_numpy(dtype=float), np.nan)
+        area_value[key] = area_value[key] + add_value
+        add_code = unassigned_merge[key + CODE_SUFFIX].fillna(CODE_VALUE).to_numpy().astype(np.uint8)
+        area_code[key] = np.maximum(area_code[key], add_code)
 
     # If any representative crop/state is missing irrigated and non-irrigated area values (including any of the
-    # unassigned crops assigned to rep crop, we designate the areas as '(NA)' (!JY: is there a better way to implement
+    # unassigned crops assigned to rep crop, we designate the areas as unreported (!JY: is there a better way to implement
     # this that utilizes more of the data?)
-    cdl_states_merge['Area Irrigated (Acres)'] = np.where(cdl_states_merge['Area Irrigated (Acres)'] < 0, '(NA)', cdl_states_merge['Area Irrigated (Acres)'])
-    cdl_states_merge['Area Non-Irrigated (Acres)'] = np.where(cdl_states_merge['Area Non-Irrigated (Acres)'] < 0, '(NA)', cdl_states_merge['Area Non-Irrigated (Acres)'])
 
     # For CDL rows that are missing irrigated and non-irrigated areas at the state level, assume that the proportion of
     # CDL State Crop Area / CDL U.S. Total Crop Area is correct and calculate areas
-    for key in keys:
-
-        # Subtract areas for Alaska and Hawaii from United States totals (not included in CDL sums)
-        if irrigation_select[(irrigation_select['Geography'] == 'Alaska')].empty == False:
-            if irrigation_select[(irrigation_select['Geography'] == 'Alaska')][key].values[0] == '(D)' or \
-                    irrigation_select[(irrigation_select['Geography'] == 'Alaska')][key].values[0] == 'NA' or \
-                    irrigation_select[(irrigation_select['Geography'] == 'Alaska')][key].values[0] == '(NA)' or \
-                    irrigation_select[(irrigation_select['Geography'] == 'Alaska')][key].values[0] == '(Z)' or \
-                    irrigation_select[(irrigation_select['Geography'] == 'Alaska')][key].values[0] == '-' or \
-                    irrigation_select[(irrigation_select['Geography'] == 'Alaska')][key].values[0] == '':
-                irrigation_select.loc[irrigation_select['Geography'] == 'Alaska', key] = 0
-        else:
-            irrigation_select.loc[-3] = ['Alaska', value['irrigation'], 0, 0, 'ton/acre', 0, 0, 'NA']
-
-        if irrigation_select[(irrigation_select['Geography'] == 'Hawaii')].empty == False:
-            if irrigation_select[(irrigation_select['Geography'] == 'Hawaii')][key].values[0] == '(D)' or \
-                    irrigation_select[(irrigation_select['Geography'] == 'Hawaii')][key].values[0] == 'NA' or \
-                    irrigation_select[(irrigation_select['Geography'] == 'Hawaii')][key].values[0] == '(NA)' or \
-                    irrigation_select[(irrigation_select['Geography'] == 'Hawaii')][key].values[0] == '(Z)' or \
-                    irrigation_select[(irrigation_select['Geography'] == 'Hawaii')][key].values[0] == '-' or \
-                    irrigation_select[(irrigation_select['Geography'] == 'Hawaii')][key].values[0] == '':
-                irrigation_select.loc[irrigation_select['Geography'] == 'Hawaii', key] = 0
-        else:
-            irrigation_select.loc[-4] = ['Hawaii', value['irrigation'], 0, 0, 'ton/acre', 0, 0, 'NA']
-
-        united_states_adjusted = irrigation_select[(irrigation_select['Geography'] == 'United States (2013)')][key].values[0] - \
-                                 irrigation_select[(irrigation_select['Geography'] == 'Alaska')][key].values[0] - \
-                                 irrigation_select[(irrigation_select['Geography'] == 'Hawaii')][key].values[0]
+    for key in area_keys:
+
+        # Subtract areas for Alaska and Hawaii from United States totals (not included in CDL sums). Unreported
+        # or missing Alaska and Hawaii areas count as 0
+        united_states_adjusted, _, _ = coded_lookup(irrigation, key, cdl_states_merge['map_irrigation'], 'United States (2013)')
+        for state in ['Alaska', 'Hawaii']:
+            state_value, state_code, found = coded_lookup(irrigation, key, cdl_states_merge['map_irrigation'], state)
+            united_states_adjusted = united_states_adjusted - np.where(~found | ((state_code >= CODE_DASH) & (state_code <= CODE_EMPTY)), 0, state_value)
 
         # !JY: Need to check here if there are times when Alaska or Hawaii are NAN, causing the entire value to be NAN
-        if math.isnan(united_states_adjusted):
-            united_states_adjusted = 0
+        united_states_adjusted = np.nan_to_num(united_states_adjusted)
 
         # For any crop/state values that are missing irrigated or non-irrigated areas, calculate based on
         # CDL state / CDL U.S. total proportions
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '-', 0, cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '(Z)', 0, cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '(D)',
-                                         united_states_adjusted * cdl_states_merge['state_perc'], cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == 'NA',
-                                         united_states_adjusted * cdl_states_merge['state_perc'], cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '',
-                                         united_states_adjusted * cdl_states_merge['state_perc'], cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '(NA)',
-                                         united_states_adjusted * cdl_states_merge['state_perc'], cdl_states_merge[key])
+        unreported = (area_code[key] >= CODE_D) & ~np.isnan(area_value[key])
+        cdl_states_merge[key] = np.where(unreported, united_states_adjusted * cdl_states_merge['state_perc'], area_value[key])
+        cdl_states_merge[key + CODE_SUFFIX] = area_code[key]
 
     cdl_states_merge['Area Total (Acres)'] = cdl_states_merge['Area Irrigated (Acres)'] + cdl_states_merge['Area Non-Irrigated (Acres)']
 
@@ -459,323 +350,639 @@ for key2, value in crop_name_map.items():
     cdl_states_merge['area_nonirrigated'] = cdl_states_merge['cdl_perc'] * cdl_states_merge['Area Non-Irrigated (Acres)']
     cdl_states_merge['area_total'] = cdl_states_merge['cdl_perc'] * cdl_states_merge['Area Total (Acres)']
 
-    # Replace missing yield values from USDA irrigation data with United States averages
-    keys = ['Yield Irrigated', 'Yield Non-Irrigated']
+    # Replace missing yield values from USDA irrigation data with United States averages ('-' and '(Z)' entries with 0)
+    for key in yield_keys:
+        yield_code = cdl_states_merge[key + CODE_SUFFIX].to_numpy()
+        yield_us, _, _ = coded_lookup(irrigation, key, cdl_states_merge['map_irrigation'], 'United States (2013)')
+        cdl_states_merge[key] = np.where(np.isin(yield_code, [CODE_DASH, CODE_Z]), 0,
+                                         np.where(np.isin(yield_code, [CODE_D, CODE_NA_PAREN, CODE_EMPTY]), yield_us, cdl_states_merge[key]))
 
-    for key in keys:
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '-', 0, cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '(D)', irrigation_select[(irrigation_select['Geography']=='United States (2013)')][key], cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '(NA)', irrigation_select[(irrigation_select['Geography']=='United States (2013)')][key], cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '(Z)', 0, cdl_states_merge[key])
-        cdl_states_merge[key] = np.where(cdl_states_merge[key] == '', irrigation_select[(irrigation_select['Geography']=='United States (2013)')][key], cdl_states_merge[key])
+    cdl_states_all = cdl_states_merge.drop(columns=map_columns)
 
-    # Concatenate tables into one consolidated table for all crops
-    if first:
-        cdl_states_all = cdl_states_merge
-        first = False
-    else:
-        cdl_states_all = pd.concat([cdl_states_all, cdl_states_merge])
+    # Join Siebert irrigation data to main table
+    cdl_states_all = CellTable(siebert).join(cdl_states_all, ['aei_pct', 'aeigw_pct', 'aeisw_pct'])
 
-# Join Siebert irrigation data to main table
-cdl_states_all = pd.merge(cdl_states_all, siebert[['NLDAS_ID', 'aei_pct', 'aeigw_pct', 'aeisw_pct']],
-                            left_on='NLDAS_ID', right_on='NLDAS_ID', how='left')
+    # (0 NIR values are replaced in Step 6, see allocate_irrigation)
+    return cdl_states_all
 
-# Replace 0 NIR values with 0.1 (to account for potential inconsistency between observed sw irrigated area and NIR)
-cdl_states_all.loc[cdl_states_all['Irrigation (acre-ft/acre)'] == 0, 'Irrigation (acre-ft/acre)'] = 0.1
 
 #### Step X - Identify cells for cropped areas are greater than available area and proportionally re-distribute to other cells in the state
-cdl_states_all['area_irrigated_corrected'] = 0
-cdl_states_all['area_nonirrigated_corrected'] = 0
-
-first_state = True
-
-for state in cdl_states_all.State.unique():
-
-    # if pd.isnull(state) or state=='UT' or state=='ID' or state=='MT' or state=='AZ' or state == 'CA':
-    #     continue
-
-    if state != 'AR':
-        continue
-
-    if first_state == True:
-        cdl_states_all_subset = cdl_states_all
-
-    aggregation_functions = {'area_irrigated': 'sum','area_nonirrigated': 'sum'}
-    cdl_states_test_area = cdl_states_all.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
-    cdl_states_test_area['total_area_sqft'] = (cdl_states_test_area['area_irrigated'] + cdl_states_test_area['area_nonirrigated'])*43560
-    cdl_states_total_temp = cdl_states_total.reset_index()
-    cdl_states_total_temp = pd.merge(cdl_states_total_temp, cdl_states_test_area,left_on='NLDAS_ID',right_on='NLDAS_ID',how='left')
-    cdl_states_total_temp['crop_divide_avail'] = cdl_states_total_temp['total_area_sqft'] / cdl_states_total_temp['avail'] # identify those cells with crop area greater than available land area
-    cdl_states_total_temp = pd.merge(cdl_states_total_temp, nldas_lookup[['NLDAS_ID', 'State', 'State_Name']], on='NLDAS_ID', how='left') # join table above with state designations
-
-    cdl_states_total_subset = cdl_states_total_temp[(cdl_states_total_temp.State == state)]
-
-    loop_no = 0
-    while cdl_states_total_subset.crop_divide_avail.max() > 1:
-
-        loop_no += 1
-
-        cdl_states_total_subset = cdl_states_total_temp[(cdl_states_total_temp.State==state)] # subset state (eventually incorporate into loop)
-
-        print(state)
-        print(loop_no)
-        print(cdl_states_total_subset.crop_divide_avail.max())
-        print('# of cells that are overallocated')
-        print(len(cdl_states_total_subset[(cdl_states_total_subset.crop_divide_avail > 1)].index))
-
-        if(loop_no > 50):
-            break
-
-        if loop_no == 1:
-            cdl_states_all_subset = cdl_states_all[(cdl_states_all.State == state)]  # subset main CDL table by state
-            cdl_states_all_subset['area_irrigated_corrected'] = cdl_states_all_subset['area_irrigated']
-            cdl_states_all_subset['area_nonirrigated_corrected'] = cdl_states_all_subset['area_nonirrigated']
-        if loop_no != 1:
-            cdl_states_all_subset = cdl_states_all_subset.drop(['avail','crop_divide_avail'], axis=1)
-        cdl_states_all_subset = pd.merge(cdl_states_all_subset, cdl_states_total_subset[['NLDAS_ID','avail','crop_divide_avail']], left_on='NLDAS_ID',right_on='NLDAS_ID',how='left') # join excess crop areas to main CDL table
-
-        cdl_states_all_subset['area_irrigated_excess'] = np.where(cdl_states_all_subset['crop_divide_avail'] > 1, # calculate excess area_irrigated and area_nonirrigated for re-distribution
-            cdl_states_all_subset['area_irrigated_corrected'] - (cdl_states_all_subset['area_irrigated_corrected'] / cdl_states_all_subset['crop_divide_avail'].where(cdl_states_all_subset.crop_divide_avail !=0, np.nan)), 0)
-        cdl_states_all_subset['area_irrigated_excess'] = cdl_states_all_subset['area_irrigated_excess'].fillna(0)
-        cdl_states_all_subset['area_nonirrigated_excess'] = np.where(cdl_states_all_subset['crop_divide_avail'] > 1, # calculate excess area_irrigated and area_nonirrigated for re-distribution
-            cdl_states_all_subset['area_nonirrigated_corrected'] - (cdl_states_all_subset['area_nonirrigated_corrected'] / cdl_states_all_subset['crop_divide_avail'].where(cdl_states_all_subset.crop_divide_avail !=0, np.nan)), 0)
-        cdl_states_all_subset['area_nonirrigated_excess'] = cdl_states_all_subset['area_nonirrigated_excess'].fillna(0)
-
-        cdl_states_all_subset['area_irrigated_wcushion'] = np.where(cdl_states_all_subset['crop_divide_avail'] < 1, cdl_states_all_subset['area_irrigated_corrected'], 0)
-        cdl_states_all_subset['area_nonirrigated_wcushion'] = np.where(cdl_states_all_subset['crop_divide_avail'] < 1, cdl_states_all_subset['area_nonirrigated_corrected'], 0)
-
-        # determine total crop area that needs to be re-distributed
-        aggregation_functions = {'area_irrigated_excess': 'sum','area_nonirrigated_excess': 'sum', 'area_irrigated_wcushion': 'sum', 'area_nonirrigated_wcushion': 'sum'}
-        crop_redistribute = cdl_states_all_subset.groupby(['GCAM_name'], as_index=False).aggregate(aggregation_functions)
-        crop_redistribute = crop_redistribute.rename(columns={'area_irrigated_excess': 'area_irrigated_excess_sum', 'area_nonirrigated_excess': 'area_nonirrigated_excess_sum',
-                                                              'area_irrigated_wcushion':'area_irrigated_wcushion_sum', 'area_nonirrigated_wcushion':'area_nonirrigated_wcushion_sum'})
-        if loop_no != 1:
-            cdl_states_all_subset = cdl_states_all_subset.drop(['area_irrigated_excess_sum', 'area_nonirrigated_excess_sum', 'area_irrigated_wcushion_sum', 'area_nonirrigated_wcushion_sum'], axis=1)
-        cdl_states_all_subset = pd.merge(cdl_states_all_subset, crop_redistribute, left_on='GCAM_name', right_on='GCAM_name', how='left')
-
-        # re-distribute crop areas by proportion (!JY do this on a crop by crop basis? -- i.e., determine available area by crop... )
-        cdl_states_all_subset['area_irrigated_corrected_temp'] = 0 # calculate area to add to cells with a cushion, and area to subtract from cells with an excess
-        cdl_states_all_subset.loc[(cdl_states_all_subset['crop_divide_avail'] == 1), 'area_irrigated_corrected_temp'] = cdl_states_all_subset['area_irrigated_corrected']
-        cdl_states_all_subset.loc[(cdl_states_all_subset['crop_divide_avail']<1), 'area_irrigated_corrected_temp'] = \
-            cdl_states_all_subset['area_irrigated_corrected'] + (cdl_states_all_subset['area_irrigated_excess_sum'] * cdl_states_all_subset['area_irrigated_corrected'] /
-            cdl_states_all_subset['area_irrigated_wcushion_sum'].where(cdl_states_all_subset.area_irrigated_wcushion_sum !=0, np.nan))
-        cdl_states_all_subset.loc[(cdl_states_all_subset['crop_divide_avail']>1) & (cdl_states_all_subset['crop_divide_avail'] != 0), 'area_irrigated_corrected_temp'] = \
-            cdl_states_all_subset['area_irrigated_corrected'] / cdl_states_all_subset['crop_divide_avail'].where(cdl_states_all_subset.crop_divide_avail !=0, np.nan)
-        cdl_states_all_subset['area_irrigated_corrected_temp'] = cdl_states_all_subset['area_irrigated_corrected_temp'].fillna(0)
-
-        cdl_states_all_subset['area_nonirrigated_corrected_temp'] = 0 # calculate area to add to cells with a cushion, and area to subtract from cells with an excess
-        cdl_states_all_subset.loc[(cdl_states_all_subset['crop_divide_avail'] == 1), 'area_nonirrigated_corrected_temp'] = cdl_states_all_subset['area_nonirrigated_corrected']
-        cdl_states_all_subset.loc[(cdl_states_all_subset['crop_divide_avail']<1), 'area_nonirrigated_corrected_temp'] = \
-            cdl_states_all_subset['area_nonirrigated_corrected'] + (cdl_states_all_subset['area_nonirrigated_excess_sum'] * cdl_states_all_subset['area_nonirrigated_corrected'] /
-            cdl_states_all_subset['area_nonirrigated_wcushion_sum'].where(cdl_states_all_subset.area_nonirrigated_wcushion_sum !=0, np.nan))
-        cdl_states_all_subset.loc[(cdl_states_all_subset['crop_divide_avail']>1) & (cdl_states_all_subset['crop_divide_avail'] != 0), 'area_nonirrigated_corrected_temp'] = \
-            cdl_states_all_subset['area_nonirrigated_corrected'] / cdl_states_all_subset['crop_divide_avail'].where(cdl_states_all_subset.crop_divide_avail !=0, np.nan)
-        cdl_states_all_subset['area_nonirrigated_corrected_temp'] = cdl_states_all_subset['area_nonirrigated_corrected_temp'].fillna(0)
-
-        # replace corrected areas in main table
-        # if loop_no != 1:
-        #     cdl_states_all = cdl_states_all.drop(['area_irrigated_corrected_temp','area_nonirrigated_corrected_temp'], axis=1)
-        # cdl_states_all= pd.merge(cdl_states_all, cdl_states_all_subset[['NLDAS_ID', 'GCAM_name','area_irrigated_corrected_temp','area_nonirrigated_corrected_temp']], left_on=['NLDAS_ID', 'GCAM_name'], right_on=['NLDAS_ID','GCAM_name'], how='left')
-        cdl_states_all_subset['area_irrigated_corrected'] = cdl_states_all_subset['area_irrigated_corrected_temp']
-        cdl_states_all_subset['area_nonirrigated_corrected'] = cdl_states_all_subset['area_nonirrigated_corrected_temp']
-
-        #Re-check whether cropped areas greater than available land area
-        aggregation_functions = {'area_irrigated': 'sum','area_nonirrigated': 'sum','area_irrigated_corrected': 'sum','area_nonirrigated_corrected': 'sum'}
-        cdl_states_test_area = cdl_states_all_subset.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
-        cdl_states_test_area['total_area_sqft'] = (cdl_states_test_area['area_irrigated_corrected'] + cdl_states_test_area['area_nonirrigated_corrected'])*43560
-        cdl_states_total_temp = cdl_states_total.reset_index()
-        cdl_states_total_temp = pd.merge(cdl_states_total, cdl_states_test_area,left_on='NLDAS_ID',right_on='NLDAS_ID',how='left')
-        cdl_states_total_temp['crop_divide_avail'] = cdl_states_total_temp['total_area_sqft'] / cdl_states_total_temp['avail'] # identify those cells with crop area greater than available land area
-        cdl_states_total_temp = pd.merge(cdl_states_total_temp, nldas_lookup[['NLDAS_ID', 'State', 'State_Name']], on='NLDAS_ID', how='left') # join table above with state designations
-
-
-    if first_state:
-        cdl_states_all_replace = cdl_states_all_subset
-        first_state = False
+def redistribute_overallocation(cdl_states_all, cdl_states_total, method='proportional', tolerance=1e-9, max_iter=50,
+                                workers=1):
+    # Irrigated and non-irrigated crop areas of every state are redistributed at once on dense cell x crop arrays, either
+    # iteratively in proportion to the crop areas of cells with spare land (method='proportional', see
+    # wmabm_tables.redistribute_proportional) or in one solve of a transportation problem (method='lp', see
+    # wmabm_tables.redistribute_lp). States are independent and can be split across worker processes (workers > 1) with
+    # identical results. Each row is scaled by the factor applied to its cell and crop, and keeps the number of iterations
+    # its state needed in 'redistribution_iterations'.
+    cdl_states_all = cdl_states_all.copy()
+    areas = ['area_irrigated', 'area_nonirrigated']
+
+    # Cells in NLDAS_ID order and crops in order of appearance, so that the kernel sums the areas of each cell and of
+    # each state and crop in the order of the rows of the table, as the groupby sums of the Step X loop do
+    cell_pos, cells = pd.factorize(cdl_states_all['NLDAS_ID'], sort=True)
+    crop_pos, crops = pd.factorize(cdl_states_all['GCAM_name'])
+    row_area = cdl_states_all[areas].fillna(0).to_numpy(dtype=float).T
+    area = np.zeros((len(areas), len(cells), len(crops)))
+    for i in range(len(areas)):
+        np.add.at(area[i], (cell_pos, crop_pos), row_area[i])
+    present = np.zeros((len(cells), len(crops)), dtype=bool)
+    present[cell_pos, crop_pos] = True
+
+    capacity = cdl_states_total['avail'].reindex(cells).to_numpy(dtype=float)  # available land area in sq ft
+    cell_state = cdl_states_all['State'].groupby(cell_pos).first().reindex(range(len(cells)))
+    group, states = pd.factorize(cell_state)
+
+    if method == 'proportional':
+        kernel, kwargs = redistribute_proportional, {'tolerance': tolerance, 'max_iter': max_iter, 'scale': 43560,
+                                                     'present': present}
+    elif method == 'lp':
+        kernel, kwargs = redistribute_lp, {'tolerance': tolerance, 'scale': 43560, 'present': present}
     else:
-        cdl_states_all_replace = pd.concat([cdl_states_all_replace, cdl_states_all_subset])
+        raise ValueError('unknown redistribution method: ' + method)
+    corrected, iterations, max_before, max_after = redistribute_parallel(kernel, area, capacity, group, len(states),
+                                                                        workers=workers, **kwargs)
+    # Cropped cells without an available area (no NotAvailable row in the CDL table) cannot be balanced and lose their
+    # crops. States with more cropped than available area cannot be balanced by either method: the proportional method
+    # drops the excess it cannot place, the LP leaves it in the overallocated cells.
+    cropped = area.sum(axis=(0, 2))
+    in_state = group >= 0
+    no_capacity = np.isnan(capacity) & (cropped > 0) & in_state
+    no_capacity_cells = np.bincount(group[no_capacity], minlength=len(states))
+    no_capacity_acres = np.bincount(group[no_capacity], weights=cropped[no_capacity], minlength=len(states))
+    state_cropped = np.bincount(group[in_state], weights=cropped[in_state], minlength=len(states))
+    state_avail = np.bincount(group[in_state], weights=np.nan_to_num(capacity[in_state]) / 43560, minlength=len(states))
+    for i, state in enumerate(states):
+        if iterations[i] > 0:
+            line = (state + ': ' + str(iterations[i]) + ' iterations, max cropped / available area ' + str(max_before[i]) +
+                    ' -> ' + str(max_after[i]) + ', ' + str(no_capacity_cells[i]) + ' cells without available area (' +
+                    str(no_capacity_acres[i]) + ' acres removed)')
+            if state_cropped[i] > state_avail[i] * (1 + tolerance):
+                line += ', insufficient available area (' + str(state_cropped[i]) + ' acres cropped, ' + str(state_avail[i]) + ' available)'
+            print(line)
+
+    # Rows of the same cell and crop share its corrected area in proportion to their area (a single row gets all of it),
+    # or equally where the cell had none of that type and crop (area shipped there by the LP)
+    rows = np.bincount(cell_pos * len(crops) + crop_pos, minlength=len(cells) * len(crops)).reshape(len(cells), len(crops))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = np.where(area[:, cell_pos, crop_pos] != 0, row_area / area[:, cell_pos, crop_pos], 1 / rows[cell_pos, crop_pos])
+    state_iterations = np.where(group >= 0, iterations[group], 0)[cell_pos]
+    processed = state_iterations > 0
+    for i, col in enumerate(areas):
+        cdl_states_all[col + '_corrected'] = np.where(processed, corrected[i, cell_pos, crop_pos] * share[i], cdl_states_all[col])
+    cdl_states_all['redistribution_iterations'] = state_iterations
+    return cdl_states_all
+
+
+def summarize_redistribution(cdl_states_all_replace, cdl_states_total, tolerance=1e-9):
+    # Iterations of each state and its overallocation (cropped area in excess of available area, acres) before and after
+    # the redistribution of Step X, the cropped cells of the redistributed states that were emptied because they have no
+    # available area (NaN avail), and whether the state has more cropped than available area (insufficient_capacity)
+    table = cdl_states_all_replace
+    cells = pd.DataFrame({'before': table['area_irrigated'].fillna(0) + table['area_nonirrigated'].fillna(0),
+                          'after': table['area_irrigated_corrected'] + table['area_nonirrigated_corrected']}).groupby(table['NLDAS_ID']).sum()
+    avail_acre = cdl_states_total['avail'].reindex(cells.index) / 43560
+    cells['State'] = table.groupby('NLDAS_ID')['State'].first()
+    cells['iterations'] = table.groupby('NLDAS_ID')['redistribution_iterations'].first()
+    cells['max_ratio_before'] = cells['before'] * 43560 / cdl_states_total['avail'].reindex(cells.index)  # as in Step X
+    cells['max_ratio_after'] = cells['after'] * 43560 / cdl_states_total['avail'].reindex(cells.index)
+    cells['excess_before'] = (cells['before'] - avail_acre).clip(lower=0)
+    cells['excess_after'] = (cells['after'] - avail_acre).clip(lower=0)
+    cells['overallocated_cells'] = cells['max_ratio_after'] > 1 + tolerance
+    cells['nan_capacity_cells'] = avail_acre.isnull() & (cells['before'] > 0) & (cells['iterations'] > 0)
+    cells['nan_capacity_acres'] = cells['before'].where(cells['nan_capacity_cells'], 0)
+    states = cells.groupby('State', observed=True)[['before']].sum()
+    states['avail'] = avail_acre.groupby(cells['State'], observed=True).sum()
+    aggregation_functions = {'iterations': 'max', 'max_ratio_before': 'max', 'max_ratio_after': 'max', 'excess_before': 'sum',
+                             'excess_after': 'sum', 'overallocated_cells': 'sum', 'nan_capacity_cells': 'sum',
+                             'nan_capacity_acres': 'sum'}
+    summary = cells.groupby('State', observed=True).aggregate(aggregation_functions)
+    summary['insufficient_capacity'] = states['before'] > states['avail'] * (1 + tolerance)
+    return summary.reset_index()
+
 
 #!JY restart here! Institute loop (excess areas are still really large, need to check Rice and MiscCrop assignments)
 
 #### Step 6 - Allocate irrigation to groundwater and surface water using statewide averages (!JY: data sources to make better assumptions?)
-cdl_states_all['siebert_total_irr_area'] = cdl_states_all['cdl_perc'] * cdl_states_all['Area Total (Acres)'] * cdl_states_all['aei_pct'] / 100.0
-cdl_states_all['siebert_total_irr_area_scaled'] = 0
-for state in cdl_states_all.State_Name.unique():
-    for crop in cdl_states_all.GCAM_name.unique():
-        sum_crops = cdl_states_all[(cdl_states_all.State_Name==state) & (cdl_states_all.GCAM_name==crop)].siebert_total_irr_area.sum()
-        if sum_crops != 0:
-            scaling_factor = cdl_states_all[(cdl_states_all.State_Name==state) & (cdl_states_all.GCAM_name==crop)]['Area Irrigated (Acres)'].mean() / sum_crops
-        else:
-            scaling_factor = 0
-        cdl_states_all.loc[(cdl_states_all.State_Name==state) & (cdl_states_all.GCAM_name==crop), 'siebert_total_irr_area_scaled'] = cdl_states_all['siebert_total_irr_area'] * scaling_factor
-
-
-# JY RESTART HERE - MAKE SURE AREAS ADD UP TO TOTAL IRRIGATED AREA
-cdl_states_all['area_irrigated_gw'] = cdl_states_all['siebert_total_irr_area_scaled'] * cdl_states_all['aeigw_pct'] / 100.0
-cdl_states_all['area_irrigated_sw'] = cdl_states_all['siebert_total_irr_area_scaled'] * cdl_states_all['aeisw_pct'] / 100.0
-cdl_states_all['area_irrigated'] = cdl_states_all['area_irrigated_gw'] + cdl_states_all['area_irrigated_sw']
-
-# cdl_states_all = pd.merge(cdl_states_all, water_perc[['State','Groundwater','SW Total', 'GW cost', 'SW cost adj']],left_on='State_Name', right_on='State',how='left')
-cdl_states_all = pd.merge(cdl_states_all, water_perc[['State','gw_cost_est_$_acft','sw_cost_est_$_acft']],left_on='State_Name', right_on='State',how='left')
-# cdl_states_all['area_irrigated_gw'] = cdl_states_all['area_irrigated'] * cdl_states_all['Groundwater']
-# cdl_states_all['area_irrigated_sw'] = cdl_states_all['area_irrigated'] * cdl_states_all['SW Total']
-cdl_states_all['gw_irrigation_vol'] = cdl_states_all['area_irrigated_gw'] * cdl_states_all['Irrigation (acre-ft/acre)'] # GW irrigation volume in acre-ft
-cdl_states_all['sw_irrigation_vol'] = cdl_states_all['area_irrigated_sw'] * cdl_states_all['Irrigation (acre-ft/acre)'] # SW irrigation volume in acre-ft
+def calc_siebert_irr_area(cdl_states_all):
+    # Irrigated area of each cell and crop implied by the Siebert area equipped for irrigation
+    return cdl_states_all['cdl_perc'] * cdl_states_all['Area Total (Acres)'] * cdl_states_all['aei_pct'] / 100.0
 
 
-#### Step 7 - Check profit calculations and make adjustments
-# Calculate perceived costs (i.e., exclude opportunity costs)
-cdl_states_all['perceived_cost'] = cdl_states_all['total costs'] - cdl_states_all['opplabor'] - cdl_states_all['oppland']
-
-# For negative profits, adjust total land cost to assume profit is zero
-cdl_states_all['profit'] = (cdl_states_all['yield']*cdl_states_all['price']) - cdl_states_all['perceived_cost']
-# !JY: consider adding 10 percent to below?
-# cdl_states_all['perceived_cost_adj'] = np.where(cdl_states_all['profit'] < 1, cdl_states_all['perceived_cost'] + cdl_states_all['profit'] - 1, cdl_states_all['perceived_cost'])
-# cdl_states_all['profit_adj'] = (cdl_states_all['yield']*cdl_states_all['price']) - cdl_states_all['perceived_cost_adj']
-
-# !JY: alternate version, min is 10 percent profit margin
-cdl_states_all['perceived_cost_adj'] = np.where(cdl_states_all['profit'] < (cdl_states_all['perceived_cost'] * .10), (cdl_states_all['yield'] * cdl_states_all['price']) / 1.1, cdl_states_all['perceived_cost'])
-cdl_states_all['profit_adj'] = (cdl_states_all['yield']*cdl_states_all['price']) - cdl_states_all['perceived_cost_adj']
-
-# Estimate gw and sw costs (in $/acre)
-cdl_states_all['gw_cost_est_$_acre'] = cdl_states_all['gw_cost_est_$_acft'] * cdl_states_all['Irrigation (acre-ft/acre)']
-cdl_states_all['sw_cost_est_$_acre'] = cdl_states_all['sw_cost_est_$_acft'] * cdl_states_all['Irrigation (acre-ft/acre)']
-# Adjust gw and sw costs when greater than total perceived costs (to 90 percent of total perceived costs)
-cdl_states_all['gw_cost_est_$_acre_adj'] = np.where(cdl_states_all['gw_cost_est_$_acre'] >= cdl_states_all['perceived_cost_adj'], cdl_states_all['perceived_cost_adj'] * .90, cdl_states_all['gw_cost_est_$_acre'])
-cdl_states_all['sw_cost_est_$_acre_adj'] = np.where(cdl_states_all['sw_cost_est_$_acre'] >= cdl_states_all['perceived_cost_adj'], cdl_states_all['perceived_cost_adj'] * .90, cdl_states_all['sw_cost_est_$_acre'])
-cdl_states_all['gw_cost_est_$_acft_adj'] = cdl_states_all['gw_cost_est_$_acre_adj'] / cdl_states_all['Irrigation (acre-ft/acre)']
-cdl_states_all['sw_cost_est_$_acft_adj'] = cdl_states_all['sw_cost_est_$_acre_adj'] / cdl_states_all['Irrigation (acre-ft/acre)']
-# cdl_states_all['gw_irrigation_vol'] = cdl_states_all.gw_irrigation_vol.astype(float)
-# cdl_states_all['sw_irrigation_vol'] = cdl_states_all.sw_irrigation_vol.astype(float)
-# cdl_states_all['total_irrigation_vol'] = cdl_states_all['gw_irrigation_vol'] + cdl_states_all['sw_irrigation_vol']
-# cdl_states_all['total_irrigation_water_cost_$'] = (cdl_states_all['gw_cost_est_$_acre_adj'] * cdl_states_all['gw_irrigation_vol']) + (cdl_states_all['sw_cost_est_$_acre_adj'] * cdl_states_all['sw_irrigation_vol'])
-# cdl_states_all['total_irrigation_water_cost_$'] = cdl_states_all['total_irrigation_water_cost_$'].astype(float)
-# cdl_states_all['avg_w_cost_est_$_acre'] = cdl_states_all['total_irrigation_water_cost_$'].div(cdl_states_all['total_irrigation_vol'])
-# cdl_states_all['avg_w_cost_est_$_acre'] = np.where(np.isnan(cdl_states_all['avg_w_cost_est_$_acre']), (cdl_states_all['gw_cost_est_$_acre_adj'] + cdl_states_all['sw_cost_est_$_acre_adj'])/2.0,
-#                                                    cdl_states_all['avg_w_cost_est_$_acre'])
-
-# Estimate land-only costs (in $/acre)
-# cdl_states_all['land_only_costs'] = cdl_states_all['perceived_cost_adj'] - cdl_states_all['avg_w_cost_est_$_acre']
-cdl_states_all['land_only_costs'] = np.where(cdl_states_all['gw_cost_est_$_acre_adj'] > cdl_states_all['sw_cost_est_$_acre_adj'], cdl_states_all['perceived_cost_adj'] - cdl_states_all['gw_cost_est_$_acre_adj'],
-                                             cdl_states_all['perceived_cost_adj'] - cdl_states_all['sw_cost_est_$_acre_adj'])
-
-
-# cdl_states_all['land_only_costs'] = cdl_states_all['perceived_cost_adj'] - cdl_states_all['GW cost'] - cdl_states_all['SW cost adj']
-#
-# # For GW + SW costs greater than total costs, assume statewide average value of (GW + SW) / total
-# states_adj = cdl_states_all[(cdl_states_all['land_only_costs'] < 0)]
-# cdl_states_all['gw cost perc'] = cdl_states_all['GW cost'] / cdl_states_all['perceived_cost_adj']
-# cdl_states_all['sw cost perc'] = cdl_states_all['SW cost adj'] / cdl_states_all['perceived_cost_adj']
-# states_list = states_adj.State_Name.unique()
-# cdl_states_all['GW cost adj'] = 99999
-# cdl_states_all['SW cost adj 2'] = 99999
-# states_perc = []
-#
-# for state in states_list:
-#     gw_cost_perc_df = cdl_states_all[(cdl_states_all['State_Name']==state) & (cdl_states_all['land_only_costs']>=0)]['GW cost'] / cdl_states_all[(cdl_states_all['State_Name']==state) & (cdl_states_all['land_only_costs']>=0)]['perceived_cost_adj']
-#     sw_cost_perc_df = cdl_states_all[(cdl_states_all['State_Name']==state) & (cdl_states_all['land_only_costs']>=0)]['SW cost adj'] / cdl_states_all[(cdl_states_all['State_Name']==state) & (cdl_states_all['land_only_costs']>=0)]['perceived_cost_adj']
-#     gw_cost_perc = gw_cost_perc_df.mean()
-#     sw_cost_perc = sw_cost_perc_df.mean()
-#     if gw_cost_perc + sw_cost_perc > 1:
-#         print(state)
-#     cdl_states_all.loc[(cdl_states_all['land_only_costs']<0) & (cdl_states_all['State_Name']==state), 'GW cost adj'] = gw_cost_perc * cdl_states_all['perceived_cost_adj']
-#     cdl_states_all.loc[(cdl_states_all['land_only_costs']<0) & (cdl_states_all['State_Name']==state), 'SW cost adj 2'] = sw_cost_perc * cdl_states_all['perceived_cost_adj']
-#
-# cdl_states_all.loc[(cdl_states_all['GW cost adj']==99999), 'GW cost adj'] = cdl_states_all['GW cost']
-# cdl_states_all.loc[(cdl_states_all['SW cost adj 2']==99999), 'SW cost adj 2'] = cdl_states_all['SW cost adj']
-#
-# cdl_states_all['land_only_costs'] = cdl_states_all['perceived_cost_adj'] - cdl_states_all['GW cost adj'] - cdl_states_all['SW cost adj 2']
-#
-# cdl_states_all['profit_test'] = (cdl_states_all['yield']*cdl_states_all['price']) - cdl_states_all['land_only_costs'] - cdl_states_all['GW cost adj'] - cdl_states_all['SW cost adj 2']
+def calc_siebert_scaling(cdl_states_all):
+    # Scaling factor of each state and crop that makes the Siebert irrigated areas add up to the USDA irrigated area. The
+    # factors are kept as their own table so that they can be checked (see siebert_scaling_factors.csv)
+    cdl_states_all = cdl_states_all.copy()
+    cdl_states_all['siebert_total_irr_area'] = calc_siebert_irr_area(cdl_states_all)
+    return siebert_scaling_factors(cdl_states_all)
+
 
+def irrigated_areas(cdl_states_all, water_perc, siebert_scaling):
+    # Groundwater and surface water irrigated areas of each cell and crop, with the water costs of the state
+    cdl_states_all = cdl_states_all.copy()
 
+    cdl_states_all['siebert_total_irr_area'] = calc_siebert_irr_area(cdl_states_all)
+    cdl_states_all['siebert_total_irr_area_scaled'] = apply_scaling_factors(cdl_states_all, siebert_scaling)
 
+    # JY RESTART HERE - MAKE SURE AREAS ADD UP TO TOTAL IRRIGATED AREA
+    cdl_states_all['area_irrigated_gw'] = cdl_states_all['siebert_total_irr_area_scaled'] * cdl_states_all['aeigw_pct'] / 100.0
+    cdl_states_all['area_irrigated_sw'] = cdl_states_all['siebert_total_irr_area_scaled'] * cdl_states_all['aeisw_pct'] / 100.0
+    cdl_states_all['area_irrigated'] = cdl_states_all['area_irrigated_gw'] + cdl_states_all['area_irrigated_sw']
 
+    # cdl_states_all = pd.merge(cdl_states_all, water_perc[['State','Groundwater','SW Total', 'GW cost', 'SW cost adj']],left_on='State_Name', right_on='State',how='left')
+    cdl_states_all = pd.merge(cdl_states_all, water_perc[['State','gw_cost_est_$_acft','sw_cost_est_$_acft']],left_on='State_Name', right_on='State',how='left')
+    # cdl_states_all['area_irrigated_gw'] = cdl_states_all['area_irrigated'] * cdl_states_all['Groundwater']
+    # cdl_states_all['area_irrigated_sw'] = cdl_states_all['area_irrigated'] * cdl_states_all['SW Total']
+    return cdl_states_all
+
+
+def allocate_irrigation(cdl_states_all, water_perc, siebert_scaling, nir_floor=0.1):
+    cdl_states_all = irrigated_areas(cdl_states_all, water_perc, siebert_scaling)
+
+    # Replace 0 NIR values with nir_floor (to account for potential inconsistency between observed sw irrigated area and NIR)
+    cdl_states_all['Irrigation (acre-ft/acre)'] = floor_nir(cdl_states_all['Irrigation (acre-ft/acre)'].to_numpy(dtype=float), nir_floor)
+    cdl_states_all['gw_irrigation_vol'] = cdl_states_all['area_irrigated_gw'] * cdl_states_all['Irrigation (acre-ft/acre)'] # GW irrigation volume in acre-ft
+    cdl_states_all['sw_irrigation_vol'] = cdl_states_all['area_irrigated_sw'] * cdl_states_all['Irrigation (acre-ft/acre)'] # SW irrigation volume in acre-ft
+    return cdl_states_all
+
+
+#### Step 7 - Check profit calculations and make adjustments
+
+# Columns set by the cost rules (wmabm_tables.irrigation_costs), in table order
+COST_COLUMNS = ['perceived_cost_adj', 'profit_adj', 'gw_cost_est_$_acre', 'sw_cost_est_$_acre', 'gw_cost_est_$_acre_adj',
+                'sw_cost_est_$_acre_adj', 'gw_cost_est_$_acft_adj', 'sw_cost_est_$_acft_adj', 'land_only_costs']
+
+def adjust_costs(cdl_states_all, min_margin=0.10, water_cost_cap=0.90):
+    cdl_states_all = cdl_states_all.copy()
+
+    # Calculate perceived costs (i.e., exclude opportunity costs)
+    cdl_states_all['perceived_cost'] = cdl_states_all['total costs'] - cdl_states_all['opplabor'] - cdl_states_all['oppland']
+
+    # For negative profits, adjust total land cost to assume profit is zero
+    cdl_states_all['profit'] = (cdl_states_all['yield']*cdl_states_all['price']) - cdl_states_all['perceived_cost']
+    # !JY: consider adding 10 percent to below?
+    # cdl_states_all['perceived_cost_adj'] = np.where(cdl_states_all['profit'] < 1, cdl_states_all['perceived_cost'] + cdl_states_all['profit'] - 1, cdl_states_all['perceived_cost'])
+    # cdl_states_all['profit_adj'] = (cdl_states_all['yield']*cdl_states_all['price']) - cdl_states_all['perceived_cost_adj']
+
+    # !JY: alternate version, min is min_margin (10 percent) profit margin. Estimate gw and sw costs (in $/acre) and
+    # adjust them when greater than total perceived costs (to water_cost_cap, 90 percent, of total perceived costs). Estimate
+    # land-only costs (in $/acre). See wmabm_tables.irrigation_costs
+    costs = irrigation_costs(cdl_states_all['yield'] * cdl_states_all['price'], cdl_states_all['perceived_cost'],
+                             cdl_states_all['Irrigation (acre-ft/acre)'], cdl_states_all['gw_cost_est_$_acft'],
+                             cdl_states_all['sw_cost_est_$_acft'], min_margin=min_margin, water_cost_cap=water_cost_cap)
+    for col in COST_COLUMNS:
+        cdl_states_all[col] = costs[col]
+    # cdl_states_all['gw_irrigation_vol'] = cdl_states_all.gw_irrigation_vol.astype(float)
+    # cdl_states_all['sw_irrigation_vol'] = cdl_states_all.sw_irrigation_vol.astype(float)
+    # cdl_states_all['total_irrigation_vol'] = cdl_states_all['gw_irrigation_vol'] + cdl_states_all['sw_irrigation_vol']
+    # cdl_states_all['total_irrigation_water_cost_$'] = (cdl_states_all['gw_cost_est_$_acre_adj'] * cdl_states_all['gw_irrigation_vol']) + (cdl_states_all['sw_cost_est_$_acre_adj'] * cdl_states_all['sw_irrigation_vol'])
+    # cdl_states_all['total_irrigation_water_cost_$'] = cdl_states_all['total_irrigation_water_cost_$'].astype(float)
+    # cdl_states_all['avg_w_cost_est_$_acre'] = cdl_states_all['total_irrigation_water_cost_$'].div(cdl_states_all['total_irrigation_vol'])
+    # cdl_states_all['avg_w_cost_est_$_acre'] = np.where(np.isnan(cdl_states_all['avg_w_cost_est_$_acre']), (cdl_states_all['gw_cost_est_$_acre_adj'] + cdl_states_all['sw_cost_est_$_acre_adj'])/2.0,
+    #                                                    cdl_states_all['avg_w_cost_est_$_acre'])
+
+    # cdl_states_all['land_only_costs'] = cdl_states_all['perceived_cost_adj'] - cdl_states_all['avg_w_cost_est_$_acre']
+
+
+    # cdl_states_all['land_only_costs'] = cdl_states_all['perceived_cost_adj'] - cdl_states_all['GW cost'] - cdl_states_all['SW cost adj']
+    #
+    # # For GW + SW costs greater than total costs, assume statewide average value of (GW + SW) / total
+    # states_adj = cdl_states_all[(cdl_states_all['land_only_costs'] < 0)]
+    # cdl_states_all['gw cost perc'] = cdl_states_all['GW cost'] / cdl_states_all['perceived_cost_adj']
+    # cdl_states_all['sw cost perc'] = cdl_states_all['SW cost adj'] / cdl_states_all['perceived_cost_adj']
+    # states_list = states_adj.State_Name.unique()
+    # cdl_states_all['GW cost adj'] = 99999
+    # cdl_states_all['SW cost adj 2'] = 99999
+    # states_perc = []
+    #
+    # for state in states_list:
+    #     gw_cost_perc_df = cdl_states_all[(cdl_states_all['State_Name']==state) & (cdl_states_all['land_only_costs']>=0)]['GW cost'] / cdl_states_all[(cdl_states_all['State_Name']==state) & (cdl_states_all['land_only_costs']>=0)]['perceived_cost_adj']
+    #     sw_cost_perc_df = cdl_states_all[(cdl_states_all['State_Name']==state) & (cdl_states_all['land_only_costs']>=0)]['SW cost adj'] / cdl_states_all[(cdl_states_all['State_Name']==state) & (cdl_states_all['land_only_costs']>=0)]['perceived_cost_adj']
+    #     gw_cost_perc = gw_cost_perc_df.mean()
+    #     sw_cost_perc = sw_cost_perc_df.mean()
+    #     if gw_cost_perc + sw_cost_perc > 1:
+    #         print(state)
+    #     cdl_states_all.loc[(cdl_states_all['land_only_costs']<0) & (cdl_states_all['State_Name']==state), 'GW cost adj'] = gw_cost_perc * cdl_states_all['perceived_cost_adj']
+    #     cdl_states_all.loc[(cdl_states_all['land_only_costs']<0) & (cdl_states_all['State_Name']==state), 'SW cost adj 2'] = sw_cost_perc * cdl_states_all['perceived_cost_adj']
+    #
+    # cdl_states_all.loc[(cdl_states_all['GW cost adj']==99999), 'GW cost adj'] = cdl_states_all['GW cost']
+    # cdl_states_all.loc[(cdl_states_all['SW cost adj 2']==99999), 'SW cost adj 2'] = cdl_states_all['SW cost adj']
+    #
+    # cdl_states_all['land_only_costs'] = cdl_states_all['perceived_cost_adj'] - cdl_states_all['GW cost adj'] - cdl_states_all['SW cost adj 2']
+    #
+    # cdl_states_all['profit_test'] = (cdl_states_all['yield']*cdl_states_all['price']) - cdl_states_all['land_only_costs'] - cdl_states_all['GW cost adj'] - cdl_states_all['SW cost adj 2']
+
+    return cdl_states_all
+
+
+# Parameters of the Step 6 / 7 rules that can be varied by scenario (see sweep_scenarios), with their default values
+SCENARIO_PARAMETERS = {'nir_floor': 0.1, 'min_margin': 0.10, 'water_cost_cap': 0.90}
+
+
+def scenario_table(scenarios):
+    # Scenarios as a table with one column per SCENARIO_PARAMETERS entry (default value where missing) and a 'scenario'
+    # name column (scenario_000, scenario_001, ... where missing). scenarios is a table of parameter values, one row per
+    # scenario, or a dict of parameter -> list of values, which is expanded to every combination of the values.
+    if isinstance(scenarios, dict):
+        scenarios = pd.MultiIndex.from_product(list(scenarios.values()), names=list(scenarios)).to_frame(index=False)
+    scenarios = scenarios.reset_index(drop=True)
+    unknown = set(scenarios.columns) - set(SCENARIO_PARAMETERS) - {'scenario'}
+    if unknown:
+        raise ValueError('unknown scenario parameters: ' + ', '.join(sorted(unknown)))
+    for name, default in SCENARIO_PARAMETERS.items():
+        if name not in scenarios:
+            scenarios[name] = default
+    if 'scenario' not in scenarios:
+        scenarios['scenario'] = ['scenario_' + str(i).zfill(3) for i in range(len(scenarios))]
+    return scenarios[['scenario'] + list(SCENARIO_PARAMETERS)]
+
+
+def sweep_scenarios(cdl_states_all, water_perc, siebert_scaling, scenarios, batch_size=8):
+    # Steps 6 and 7 for each row of scenarios (see scenario_table), yielding (row number, table as returned by
+    # adjust_costs(allocate_irrigation(...), ...)). The parts that do not depend on the scenario parameters are computed
+    # once, and the NIR floor, irrigation volumes, and cost rules of batch_size scenarios at a time are evaluated as one
+    # computation over a leading scenario axis (memory grows with batch_size times the number of rows).
+    base = irrigated_areas(cdl_states_all, water_perc, siebert_scaling)
+    revenue = (base['yield'] * base['price']).to_numpy(dtype=float)
+    perceived_cost = (base['total costs'] - base['opplabor'] - base['oppland']).to_numpy(dtype=float)
+    nir = base['Irrigation (acre-ft/acre)'].to_numpy(dtype=float)
+    area_gw = base['area_irrigated_gw'].to_numpy(dtype=float)
+    area_sw = base['area_irrigated_sw'].to_numpy(dtype=float)
+    gw_cost_acft = base['gw_cost_est_$_acft'].to_numpy(dtype=float)
+    sw_cost_acft = base['sw_cost_est_$_acft'].to_numpy(dtype=float)
+    params = {name: scenarios[name].to_numpy(dtype=float)[:, None] for name in SCENARIO_PARAMETERS}
+
+    for start in range(0, len(scenarios), batch_size):
+        batch = {name: values[start:start + batch_size] for name, values in params.items()}
+        nir_scenarios = floor_nir(nir, batch['nir_floor'])
+        costs = irrigation_costs(revenue, perceived_cost, nir_scenarios, gw_cost_acft, sw_cost_acft,
+                                 min_margin=batch['min_margin'], water_cost_cap=batch['water_cost_cap'])
+        for i in range(len(nir_scenarios)):
+            columns = {'Irrigation (acre-ft/acre)': nir_scenarios[i], 'gw_irrigation_vol': area_gw * nir_scenarios[i],
+                       'sw_irrigation_vol': area_sw * nir_scenarios[i], 'perceived_cost': perceived_cost,
+                       'profit': revenue - perceived_cost}
+            columns.update({col: costs[col][i] for col in COST_COLUMNS})
+            yield start + i, base.assign(**columns)
+
+
+# Quantities of each cell and crop reported by monte_carlo_imputed, and the sum over crops of each cell
+MONTE_CARLO_ROW_COLUMNS = ['area_irrigated', 'gw_irrigation_vol', 'sw_irrigation_vol', 'land_only_costs']
+MONTE_CARLO_CELL_COLUMNS = ['area_irrigated', 'gw_irrigation_vol', 'sw_irrigation_vol']
+
+
+def monte_carlo_imputed(cdl_states_all, water_perc, siebert_scaling, n_samples=100, sigma=0.25, percentiles=(5, 50, 95),
+                        seed=0):
+    # Uncertainty of Steps 6 and 7 due to the USDA entries imputed in Step 5: irrigated and non-irrigated areas that
+    # were not reported (estimated from the CDL state share of the U.S. total) and NIR values that were not reported
+    # (U.S. average or crop minimum), as recorded by the code columns. Each imputed (state, crop) entry is multiplied by
+    # a lognormal factor with mean 1 and log standard deviation sigma, drawn independently per sample, entry, and
+    # variable. All samples are computed at once along a leading sample axis, for the rows with an imputed entry only
+    # (the other rows do not change: the Siebert scaling factors are per state and crop, like the imputed entries).
+    # Returns the percentiles over the samples of MONTE_CARLO_ROW_COLUMNS for each row (columns <quantity>_p<percentile>,
+    # rows without a state are dropped as in Step 8) and of the sums of MONTE_CARLO_CELL_COLUMNS for each NLDAS cell.
+    # The water source shares imputed in Step 3 only affect columns that are not used by Steps 6-8 and are not sampled.
+    cdl_states_all = cdl_states_all.dropna(subset=['State_Name']).reset_index(drop=True)
+    base = adjust_costs(allocate_irrigation(cdl_states_all, water_perc, siebert_scaling))
+
+    area_imputed = {key: ((cdl_states_all[key + CODE_SUFFIX].to_numpy() >= CODE_D) &
+                          cdl_states_all[key].notnull().to_numpy()) for key in area_keys}
+    nir_imputed = cdl_states_all['Irrigation (acre-ft/acre)' + CODE_SUFFIX].to_numpy() != CODE_VALUE
+    rows = np.flatnonzero(area_imputed[area_keys[0]] | area_imputed[area_keys[1]] | nir_imputed)
+    group, _ = pd.MultiIndex.from_frame(cdl_states_all.loc[rows, ['State_Name', 'GCAM_name']]).factorize()
+    n_groups = group.max() + 1 if len(group) else 0
+
+    def column(table, col):
+        return table[col].to_numpy(dtype=float)[rows]
+
+    def group_sum(values):
+        # Sum over the rows of each group, for every sample (one bincount over sample x group bins)
+        bins = (np.arange(n_samples)[:, None] * n_groups + group).ravel()
+        return np.bincount(bins, weights=values.ravel(), minlength=n_samples * n_groups).reshape(n_samples, n_groups)
+
+    # Lognormal factors of the imputed entries (1 for entries that were reported)
+    rng = np.random.default_rng(seed)
+    factors = np.exp(sigma * rng.standard_normal((3, n_samples, n_groups)) - sigma ** 2 / 2)
+    area = {}
+    for i, key in enumerate(area_keys):
+        area[key] = column(cdl_states_all, key) * np.where(area_imputed[key][rows], factors[i][:, group], 1)
+    nir = column(cdl_states_all, 'Irrigation (acre-ft/acre)') * np.where(nir_imputed[rows], factors[2][:, group], 1)
+
+    # Step 6 (see calc_siebert_scaling and allocate_irrigation), with the scaling factors of every sample
+    siebert_irr_area = (column(cdl_states_all, 'cdl_perc') * (area[area_keys[0]] + area[area_keys[1]]) *
+                        column(cdl_states_all, 'aei_pct') / 100.0)
+    irr_area_sum = group_sum(np.nan_to_num(siebert_irr_area))
+    reported = area[area_keys[0]]
+    reported_mean = group_sum(np.nan_to_num(reported)) / group_sum(np.isfinite(reported).astype(float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaling = np.where(irr_area_sum == 0, 0, reported_mean / irr_area_sum)
+    irr_area_scaled = siebert_irr_area * scaling[:, group]
+    samples = {'gw_irrigation_vol': irr_area_scaled * column(cdl_states_all, 'aeigw_pct') / 100.0,
+               'sw_irrigation_vol': irr_area_scaled * column(cdl_states_all, 'aeisw_pct') / 100.0}
+    samples['area_irrigated'] = samples['gw_irrigation_vol'] + samples['sw_irrigation_vol']
+    nir = floor_nir(nir, SCENARIO_PARAMETERS['nir_floor'])
+    samples['gw_irrigation_vol'] = samples['gw_irrigation_vol'] * nir
+    samples['sw_irrigation_vol'] = samples['sw_irrigation_vol'] * nir
+
+    # Step 7 (see adjust_costs)
+    samples['land_only_costs'] = irrigation_costs(column(base, 'yield') * column(base, 'price'), column(base, 'perceived_cost'),
+                                                  nir, column(base, 'gw_cost_est_$_acft'), column(base, 'sw_cost_est_$_acft'),
+                                                  min_margin=SCENARIO_PARAMETERS['min_margin'],
+                                                  water_cost_cap=SCENARIO_PARAMETERS['water_cost_cap'])['land_only_costs']
+
+    row_table = base[['NLDAS_ID', 'GCAM_name', 'State_Name']].copy()
+    row_table['imputed_area'] = area_imputed[area_keys[0]] | area_imputed[area_keys[1]]
+    row_table['imputed_nir'] = nir_imputed
+    cell, cell_ids = pd.factorize(base['NLDAS_ID'])
+    cell_table = pd.DataFrame({'NLDAS_ID': cell_ids})
+    cell_bins = (np.arange(n_samples)[:, None] * len(cell_ids) + cell[rows]).ravel()
+    for col in MONTE_CARLO_ROW_COLUMNS:
+        values = np.broadcast_to(base[col].to_numpy(dtype=float), (len(percentiles), len(base))).copy()
+        values[:, rows] = np.percentile(samples[col], percentiles, axis=0)
+        for p, p_values in zip(percentiles, values):
+            row_table[col + '_p' + str(p)] = p_values
+    for col in MONTE_CARLO_CELL_COLUMNS:
+        # Cell totals of every sample: the rows without imputed entries plus the sampled rows
+        fixed = base[col].to_numpy(dtype=float).copy()
+        fixed[rows] = 0
+        fixed = np.bincount(cell, weights=np.nan_to_num(fixed), minlength=len(cell_ids))
+        sampled = np.bincount(cell_bins, weights=np.nan_to_num(samples[col]).ravel(),
+                              minlength=n_samples * len(cell_ids)).reshape(n_samples, len(cell_ids))
+        for p, p_values in zip(percentiles, np.percentile(fixed + sampled, percentiles, axis=0)):
+            cell_table[col + '_p' + str(p)] = p_values
+    return row_table, cell_table
 
 
 #### Step 8 - Drop nulls, extract relevant columns, and export to csv
-# Drop nulls and fill in missing values (99999s)
-cdl_states_all = cdl_states_all.dropna(subset=['State_Name'])  # Drop rows without associated state name (outside of US domain)
-cdl_states_all.NLDAS_ID.isnull().values.any()
-
-#### Calculate bias-correction surface water factor
-
-# Generate csv file to process into netCDF files for warm-up/baseline MOSART-WM run (see project wm_netcdf/hist_demand_wm_usda.py for processing of csv file)
-aggregation_functions = {'sw_irrigation_vol': 'sum','gw_irrigation_vol': 'sum'}
-sw_irrigation_nldas = cdl_states_all.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
-sw_irrigation_nldas['sw_irrigation_m3s'] = sw_irrigation_nldas['sw_irrigation_vol'] / 25583.64
-# sw_irrigation_nldas[['NLDAS_ID','sw_irrigation_m3s']].to_csv('hist_demand_for_ncdf_nirnon0v2.csv')
-sw_irrigation_nldas[['NLDAS_ID','sw_irrigation_m3s']].to_csv('hist_demand_for_ncdf_nirnon0v3.csv')
-
-# Load in supply availability from historical/baseline WM run (see project wm_netcdf/hist_water_availability_abm.py for processing) (JY: no longer needed, all taken care of in wm_netcdf/hist_water_availability_abm.py
-#hist_supply = pd.read_csv('data/abm_hist_supply_avail.csv')
-hist_supply = pd.read_csv('data/abm_hist_supply_avail_usda.csv')
-sw_irrigation_nldas = pd.merge(sw_irrigation_nldas, hist_supply[['NLDAS_ID', 'WRM_SUPPLY_acreft']], on='NLDAS_ID', how='left') # join table above with state designations
-sw_irrigation_nldas['sw_avail_bias_corr'] = sw_irrigation_nldas['sw_irrigation_vol'] - sw_irrigation_nldas['WRM_SUPPLY_acreft']
-
-
-# Extract only relevant columns
-# cdl_states_final = cdl_states_all[['NLDAS_ID','GCAM_name','CDL_id','value', 'ERS_region', 'State_Name', 'land_only_costs', 'price',
-#                                      'GW cost adj', 'SW cost adj 2', 'yield', 'Yield Irrigated', 'Yield Non-Irrigated', 'area_irrigated', 'area_nonirrigated',
-#                                    'area_irrigated_gw','area_irrigated_sw', 'Irrigation (acre-ft/acre)']]
-
-cdl_states_final = cdl_states_all[['NLDAS_ID','GCAM_name','CDL_id','value', 'ERS_region', 'State_Name', 'land_only_costs', 'price',
-                                   'yield', 'Yield Irrigated', 'Yield Non-Irrigated', 'area_irrigated', 'area_nonirrigated',
-                                   'area_irrigated_gw','area_irrigated_sw', 'Irrigation (acre-ft/acre)','gw_cost_est_$_acft_adj','sw_cost_est_$_acft_adj']]
-
-# Export to CSV
-# cdl_states_final.to_csv('cdl_states_final_20201028.csv')
-# cdl_states_final.to_csv('cdl_states_final_20220223.csv')
-# cdl_states_final.to_csv('cdl_states_final_20220310.csv')
-# cdl_states_final.to_csv('cdl_states_final_20220311.csv')
-cdl_states_final.to_csv('cdl_states_final_20220323.csv')
-
-# Determine water constraint for PMP stage 1 calibration
-cdl_states_all['gw_cost_est_$_acft_adj'] = cdl_states_all['gw_cost_est_$_acft_adj'].astype(float)
-cdl_states_all['sw_cost_est_$_acft_adj'] = cdl_states_all['sw_cost_est_$_acft_adj'].astype(float)
-aggregation_functions = {'gw_cost_est_$_acft_adj': 'mean','sw_cost_est_$_acft_adj': 'mean', 'gw_irrigation_vol': 'sum', 'sw_irrigation_vol': 'sum'}
-calib_water_constraints = cdl_states_all.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
-calib_water_constraints['gw_constraint_calc'] = 9999999999
-calib_water_constraints['sw_constraint_calc'] = 9999999999
-calib_water_constraints.loc[(calib_water_constraints['gw_cost_est_$_acft_adj'] < calib_water_constraints['sw_cost_est_$_acft_adj']), 'gw_constraint_calc'] = calib_water_constraints['gw_irrigation_vol']
-calib_water_constraints.loc[(calib_water_constraints['sw_cost_est_$_acft_adj'] < calib_water_constraints['gw_cost_est_$_acft_adj']), 'sw_constraint_calc'] = calib_water_constraints['sw_irrigation_vol']
-gw_constraint_dict = calib_water_constraints['gw_constraint_calc'].to_dict()
-sw_constraint_dict = calib_water_constraints['sw_constraint_calc'].to_dict()
-with open('gw_calib_constraints_202203319_protocol2.p', 'wb') as handle:
-    pickle.dump(gw_constraint_dict, handle, protocol=2)
-with open('sw_calib_constraints_202203319_protocol2.p', 'wb') as handle:
-    pickle.dump(sw_constraint_dict, handle, protocol=2)
-
-# alternate version
-aggregation_functions = {'gw_irrigation_vol': 'sum', 'sw_irrigation_vol': 'sum'}
-calib_water_constraints = cdl_states_all.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
-calib_water_constraints['gw_constraint_calc'] = calib_water_constraints['gw_irrigation_vol']
-calib_water_constraints['sw_constraint_calc'] = calib_water_constraints['sw_irrigation_vol']
-gw_constraint_dict = calib_water_constraints['gw_constraint_calc'].to_dict()
-sw_constraint_dict = calib_water_constraints['sw_constraint_calc'].to_dict()
-with open('gw_calib_constraints_20220401_protocol2.p', 'wb') as handle:
-    pickle.dump(gw_constraint_dict, handle, protocol=2)
-with open('sw_calib_constraints_20220401_protocol2.p', 'wb') as handle:
-    pickle.dump(sw_constraint_dict, handle, protocol=2)
-
-# Determine land constraint for PMP stage 1 calibration
-cdl_states_total['avail_acre'] = cdl_states_total['avail'] / 43560
-aggregation_functions = {'area_irrigated_gw': 'sum','area_nonirrigated': 'sum','area_irrigated_sw': 'sum','area_irrigated': 'sum'}
-cdl_states_irr_area_sw = cdl_states_final.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
-cdl_states_total = pd.merge(cdl_states_total, cdl_states_irr_area_sw, on='NLDAS_ID', how='left')
-#cdl_states_total['avail_acre_minus_nonirr_irrgw'] = cdl_states_total['avail_acre'] - cdl_states_total['area_irrigated_gw'] - cdl_states_total['area_nonirrigated']
-cdl_states_total['avail_acre_minus_nonirr_irrgw'] = cdl_states_total['avail_acre'] - cdl_states_total['area_nonirrigated'] # JY revised revision to include GW
-#cdl_states_total['max_land_constr'] = cdl_states_total[["avail_acre_minus_nonirr_irrgw", "area_irrigated_sw"]].max(axis=1)
-cdl_states_total['max_land_constr'] = cdl_states_total[["avail_acre_minus_nonirr_irrgw", "area_irrigated"]].max(axis=1) # JY revised revision to include GW
-cdl_states_total['max_land_constr'] = cdl_states_total['max_land_constr'] * 1000  # All land areas in PMP multiplied by 1000 for precision/rounding
-max_land_constr = cdl_states_total[['NLDAS_ID','max_land_constr']]
-max_land_constr = max_land_constr.dropna()
-#max_land_constr.to_csv('max_land_constr_20201102.csv')
-#max_land_constr.to_csv('max_land_constr_20220223.csv')
-max_land_constr.to_csv('max_land_constr_20220307.csv')
-
-temp = max_land_constr.reset_index()
-temp_dict = temp['max_land_constr'].to_dict()
-import pickle
-with open('max_land_constr_20220307_protocol2.p', 'wb') as handle:
-    pickle.dump(temp_dict, handle, protocol=2)
\ No newline at end of file
+def export_outputs(cdl_states_all, cdl_states_total, siebert_scaling, redistribution_report, output_dir='.', netcdf=False):
+    # Write the output tables and calibration constraints to output_dir and return the final crop table. With netcdf=True
+    # the historical surface water demand is also written on the NLDAS grid (hist_demand_nirnon0v3.nc, requires netCDF4)
+    cdl_states_total = cdl_states_total.copy()
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Iterations and residual overallocation by state (QA of Step X)
+    redistribution_report.to_csv(os.path.join(output_dir, 'redistribution_report.csv'), index=False)
+
+    # Siebert scaling factors by state and crop (QA of Step 6)
+    siebert_scaling.to_csv(os.path.join(output_dir, 'siebert_scaling_factors.csv'), index=False)
+
+    # Drop nulls and fill in missing values (99999s)
+    cdl_states_all = cdl_states_all.dropna(subset=['State_Name'])  # Drop rows without associated state name (outside of US domain)
+    cdl_states_all.NLDAS_ID.isnull().values.any()
+
+    #### Calculate bias-correction surface water factor
+
+    # Generate csv file to process into netCDF files for warm-up/baseline MOSART-WM run (see project wm_netcdf/hist_demand_wm_usda.py for processing of csv file)
+    aggregation_functions = {'sw_irrigation_vol': 'sum','gw_irrigation_vol': 'sum'}
+    sw_irrigation_nldas = cdl_states_all.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
+    sw_irrigation_nldas['sw_irrigation_m3s'] = sw_irrigation_nldas['sw_irrigation_vol'] / 25583.64
+    # sw_irrigation_nldas[['NLDAS_ID','sw_irrigation_m3s']].to_csv('hist_demand_for_ncdf_nirnon0v2.csv')
+    sw_irrigation_nldas[['NLDAS_ID','sw_irrigation_m3s']].to_csv(os.path.join(output_dir, 'hist_demand_for_ncdf_nirnon0v3.csv'))
+    if netcdf:
+        write_nldas_netcdf(os.path.join(output_dir, 'hist_demand_nirnon0v3.nc'), sw_irrigation_nldas['NLDAS_ID'],
+                           sw_irrigation_nldas['sw_irrigation_m3s'], 'sw_irrigation_m3s', units='m3/s',
+                           long_name='historical surface water irrigation demand')
+
+    # Load in supply availability from historical/baseline WM run (see project wm_netcdf/hist_water_availability_abm.py for processing) (JY: no longer needed, all taken care of in wm_netcdf/hist_water_availability_abm.py
+    #hist_supply = pd.read_csv('data/abm_hist_supply_avail.csv')
+    hist_supply = pd.read_csv('data/abm_hist_supply_avail_usda.csv')
+    sw_irrigation_nldas = CellTable(hist_supply).join(sw_irrigation_nldas, ['WRM_SUPPLY_acreft']) # join table above with state designations
+    sw_irrigation_nldas['sw_avail_bias_corr'] = sw_irrigation_nldas['sw_irrigation_vol'] - sw_irrigation_nldas['WRM_SUPPLY_acreft']
+
+
+    # Extract only relevant columns
+    # cdl_states_final = cdl_states_all[['NLDAS_ID','GCAM_name','CDL_id','value', 'ERS_region', 'State_Name', 'land_only_costs', 'price',
+    #                                      'GW cost adj', 'SW cost adj 2', 'yield', 'Yield Irrigated', 'Yield Non-Irrigated', 'area_irrigated', 'area_nonirrigated',
+    #                                    'area_irrigated_gw','area_irrigated_sw', 'Irrigation (acre-ft/acre)']]
+
+    cdl_states_final = cdl_states_all[['NLDAS_ID','GCAM_name','CDL_id','value', 'ERS_region', 'State_Name', 'land_only_costs', 'price',
+                                       'yield', 'Yield Irrigated', 'Yield Non-Irrigated', 'area_irrigated', 'area_nonirrigated',
+                                       'area_irrigated_gw','area_irrigated_sw', 'Irrigation (acre-ft/acre)','gw_cost_est_$_acft_adj','sw_cost_est_$_acft_adj']]
+
+    # Export to CSV
+    # cdl_states_final.to_csv('cdl_states_final_20201028.csv')
+    # cdl_states_final.to_csv('cdl_states_final_20220223.csv')
+    # cdl_states_final.to_csv('cdl_states_final_20220310.csv')
+    # cdl_states_final.to_csv('cdl_states_final_20220311.csv')
+    cdl_states_final.to_csv(os.path.join(output_dir, 'cdl_states_final_20220323.csv'))
+
+    # Determine water constraint for PMP stage 1 calibration
+    cdl_states_all['gw_cost_est_$_acft_adj'] = cdl_states_all['gw_cost_est_$_acft_adj'].astype(float)
+    cdl_states_all['sw_cost_est_$_acft_adj'] = cdl_states_all['sw_cost_est_$_acft_adj'].astype(float)
+    aggregation_functions = {'gw_cost_est_$_acft_adj': 'mean','sw_cost_est_$_acft_adj': 'mean', 'gw_irrigation_vol': 'sum', 'sw_irrigation_vol': 'sum'}
+    calib_water_constraints = cdl_states_all.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
+    calib_water_constraints['gw_constraint_calc'] = 9999999999.0  # float, so that the volumes can be set below
+    calib_water_constraints['sw_constraint_calc'] = 9999999999.0
+    calib_water_constraints.loc[(calib_water_constraints['gw_cost_est_$_acft_adj'] < calib_water_constraints['sw_cost_est_$_acft_adj']), 'gw_constraint_calc'] = calib_water_constraints['gw_irrigation_vol']
+    calib_water_constraints.loc[(calib_water_constraints['sw_cost_est_$_acft_adj'] < calib_water_constraints['gw_cost_est_$_acft_adj']), 'sw_constraint_calc'] = calib_water_constraints['sw_irrigation_vol']
+    gw_constraint_dict = calib_water_constraints['gw_constraint_calc'].to_dict()
+    sw_constraint_dict = calib_water_constraints['sw_constraint_calc'].to_dict()
+    with open(os.path.join(output_dir, 'gw_calib_constraints_202203319_protocol2.p'), 'wb') as handle:
+        pickle.dump(gw_constraint_dict, handle, protocol=2)
+    with open(os.path.join(output_dir, 'sw_calib_constraints_202203319_protocol2.p'), 'wb') as handle:
+        pickle.dump(sw_constraint_dict, handle, protocol=2)
+    # Same constraints as memory-mappable arrays by NLDAS_ID (see wmabm_constraints.py)
+    write_constraint_array(os.path.join(output_dir, 'gw_calib_constraints_202203319.npy'),
+                           calib_water_constraints['NLDAS_ID'], calib_water_constraints['gw_constraint_calc'])
+    write_constraint_array(os.path.join(output_dir, 'sw_calib_constraints_202203319.npy'),
+                           calib_water_constraints['NLDAS_ID'], calib_water_constraints['sw_constraint_calc'])
+
+    # alternate version
+    aggregation_functions = {'gw_irrigation_vol': 'sum', 'sw_irrigation_vol': 'sum'}
+    calib_water_constraints = cdl_states_all.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
+    calib_water_constraints['gw_constraint_calc'] = calib_water_constraints['gw_irrigation_vol']
+    calib_water_constraints['sw_constraint_calc'] = calib_water_constraints['sw_irrigation_vol']
+    gw_constraint_dict = calib_water_constraints['gw_constraint_calc'].to_dict()
+    sw_constraint_dict = calib_water_constraints['sw_constraint_calc'].to_dict()
+    with open(os.path.join(output_dir, 'gw_calib_constraints_20220401_protocol2.p'), 'wb') as handle:
+        pickle.dump(gw_constraint_dict, handle, protocol=2)
+    with open(os.path.join(output_dir, 'sw_calib_constraints_20220401_protocol2.p'), 'wb') as handle:
+        pickle.dump(sw_constraint_dict, handle, protocol=2)
+    write_constraint_array(os.path.join(output_dir, 'gw_calib_constraints_20220401.npy'),
+                           calib_water_constraints['NLDAS_ID'], calib_water_constraints['gw_constraint_calc'])
+    write_constraint_array(os.path.join(output_dir, 'sw_calib_constraints_20220401.npy'),
+                           calib_water_constraints['NLDAS_ID'], calib_water_constraints['sw_constraint_calc'])
+
+    # Determine land constraint for PMP stage 1 calibration
+    cdl_states_total['avail_acre'] = cdl_states_total['avail'] / 43560
+    aggregation_functions = {'area_irrigated_gw': 'sum','area_nonirrigated': 'sum','area_irrigated_sw': 'sum','area_irrigated': 'sum'}
+    cdl_states_irr_area_sw = cdl_states_final.groupby(['NLDAS_ID'], as_index=False).aggregate(aggregation_functions)
+    cdl_states_total = CellTable(cdl_states_irr_area_sw).join(cdl_states_total.reset_index(), list(aggregation_functions))
+    #cdl_states_total['avail_acre_minus_nonirr_irrgw'] = cdl_states_total['avail_acre'] - cdl_states_total['area_irrigated_gw'] - cdl_states_total['area_nonirrigated']
+    cdl_states_total['avail_acre_minus_nonirr_irrgw'] = cdl_states_total['avail_acre'] - cdl_states_total['area_nonirrigated'] # JY revised revision to include GW
+    #cdl_states_total['max_land_constr'] = cdl_states_total[["avail_acre_minus_nonirr_irrgw", "area_irrigated_sw"]].max(axis=1)
+    cdl_states_total['max_land_constr'] = cdl_states_total[["avail_acre_minus_nonirr_irrgw", "area_irrigated"]].max(axis=1) # JY revised revision to include GW
+    cdl_states_total['max_land_constr'] = cdl_states_total['max_land_constr'] * 1000  # All land areas in PMP multiplied by 1000 for precision/rounding
+    max_land_constr = cdl_states_total[['NLDAS_ID','max_land_constr']]
+    max_land_constr = max_land_constr.dropna()
+    #max_land_constr.to_csv('max_land_constr_20201102.csv')
+    #max_land_constr.to_csv('max_land_constr_20220223.csv')
+    max_land_constr.to_csv(os.path.join(output_dir, 'max_land_constr_20220307.csv'))
+
+    temp = max_land_constr.reset_index()
+    temp_dict = temp['max_land_constr'].to_dict()
+    with open(os.path.join(output_dir, 'max_land_constr_20220307_protocol2.p'), 'wb') as handle:
+        pickle.dump(temp_dict, handle, protocol=2)
+    write_constraint_array(os.path.join(output_dir, 'max_land_constr_20220307.npy'), temp['NLDAS_ID'],
+                           temp['max_land_constr'])
+    return cdl_states_final
+
+
+# Outputs compared with a reference run by the drift report of the compact dtypes (see main)
+DRIFT_FILES = ['cdl_states_final_20220323.csv', 'hist_demand_for_ncdf_nirnon0v3.csv', 'max_land_constr_20220307.csv']
+
+
+def compact_table(name, table, report, float32=False):
+    # Table with compact dtypes (categorical strings, int32 ids, and float32 areas if float32, see
+    # wmabm_tables.compact_dtypes), measured as stage compact_<name> with its footprint before and after
+    with report.stage('compact_' + name, [table]) as record:
+        record['memory_mb_before'] = memory_mb(table)
+        table = compact_dtypes(table, float32=AREA_COLUMNS if float32 else ())
+        record['memory_mb_after'] = memory_mb(table)
+        record['rows_out'] = len(table)
+    print(name + ': ' + str(round(record['memory_mb_before'], 1)) + ' MB -> ' + str(round(record['memory_mb_after'], 1)) + ' MB')
+    return table
+
+
+def main(cache_dir=CACHE_DIR, years=(2010,), redistribution_method='proportional', redistribution_tolerance=1e-9,
+         redistribution_max_iter=50, workers=1, report_path='run_report', trace_memory=False, netcdf=False, scenarios=None,
+         scenario_batch_size=8, monte_carlo_samples=0, monte_carlo_sigma=0.25, monte_carlo_seed=0, compact=False,
+         float32=False, drift_reference=None):
+    # Run all stages for each base year in years. The inputs and the stages that do not depend on the year are loaded /
+    # run once and shared by all years. With a single year the outputs are written to the working directory, with
+    # several years to one directory per year plus a combined cdl_states_final_20220323_all_years.csv with a year column.
+    # Each stage is measured (wall and CPU time, peak memory, row counts) and the measurements are written to
+    # <report_path>.json and <report_path>.csv (see wmabm_instrument.RunReport). If scenarios are given (see
+    # scenario_table), Steps 6-8 are also run for each scenario, with the outputs written to scenarios/<scenario name>.
+    # With monte_carlo_samples > 0, the percentiles of the Step 6 / 7 results over samples of the imputed USDA entries are
+    # written to monte_carlo_rows.csv and monte_carlo_cells.csv (see monte_carlo_imputed). With compact=True the CDL
+    # tables are kept with compact dtypes (float32 areas if float32) and their footprint is added to the run report; if
+    # drift_reference is the output directory of a run with the default dtypes, the differences of the outputs from it are
+    # written to dtype_drift.csv.
+    report = RunReport(trace_memory=trace_memory)
+    try:
+        inputs = load_inputs(cache_dir=cache_dir)
+        nir = run_stage('nir', prepare_nir, {'nir': inputs['nir'], 'irrigation': inputs['irrigation']}, cache_dir=cache_dir,
+                        report=report)
+        irrigation = run_stage('irrigation', prepare_irrigation, {'nir': inputs['nir'], 'irrigation': inputs['irrigation']},
+                               cache_dir=cache_dir, report=report)
+        water_perc = run_stage('water_perc', process_water_perc,
+                               {'water_perc': inputs['water_perc'], 'water_cost': inputs['water_cost']}, cache_dir=cache_dir,
+                               report=report)
+        cdl_states = run_stage('cdl_states', join_cdl_states,
+                               {'cdl': inputs['cdl'], 'nldas_lookup': inputs['nldas_lookup']}, cache_dir=cache_dir, report=report)
+        if compact:
+            cdl_states = compact_table('cdl_states', cdl_states, report, float32=float32)
+
+        if scenarios is not None:
+            scenarios = scenario_table(scenarios)
+
+        cdl_states_final_years = []
+        for year in years:
+            suffix = '_' + str(year)
+            output_dir = '.' if len(years) == 1 else str(year)
+            cdl_states_total = run_stage('cdl_states_total' + suffix, calc_cdl_states_total, {'cdl_states': cdl_states},
+                                         params={'year': year}, cache_dir=cache_dir, report=report)
+            budget_table_lookup = run_stage('budget_table_lookup' + suffix, build_budget_table_lookup,
+                                            {'budget': inputs['budget']}, params={'year': year}, cache_dir=cache_dir,
+                                            report=report)
+            cdl_states_all = run_stage('cdl_states_all' + suffix, join_crop_tables,
+                                       {'cdl_states': cdl_states, 'budget_table_lookup': budget_table_lookup, 'nir': nir,
+                                        'irrigation': irrigation, 'siebert': inputs['siebert']},
+                                       params={'year': year, 'crop_name_map': crop_name_map, 'usda_unassigned': usda_unassigned},
+                                       cache_dir=cache_dir, report=report)
+            if compact:
+                cdl_states_all = compact_table('cdl_states_all' + suffix, cdl_states_all, report, float32=float32)
+            cdl_states_all_replace = run_stage('cdl_states_all_replace' + suffix, redistribute_overallocation,
+                                               {'cdl_states_all': cdl_states_all, 'cdl_states_total': cdl_states_total},
+                                               params={'method': redistribution_method, 'tolerance': redistribution_tolerance,
+                                                       'max_iter': redistribution_max_iter, 'workers': workers},
+                                               cache_dir=cache_dir, report=report)
+            with report.stage('redistribution_report' + suffix, [cdl_states_all_replace]) as record:
+                redistribution_report = summarize_redistribution(cdl_states_all_replace, cdl_states_total,
+                                                                 tolerance=redistribution_tolerance)
+                record['rows_out'] = len(redistribution_report)
+            siebert_scaling = run_stage('siebert_scaling' + suffix, calc_siebert_scaling, {'cdl_states_all': cdl_states_all},
+                                        cache_dir=cache_dir, report=report)
+            if scenarios is not None:
+                with report.stage('scenarios' + suffix, [cdl_states_all]) as record:
+                    os.makedirs(os.path.join(output_dir, 'scenarios'), exist_ok=True)
+                    scenarios.to_csv(os.path.join(output_dir, 'scenarios', 'scenarios.csv'), index=False)
+                    for i, scenario_states in sweep_scenarios(cdl_states_all, water_perc, siebert_scaling, scenarios,
+                                                              batch_size=scenario_batch_size):
+                        export_outputs(scenario_states, cdl_states_total, siebert_scaling, redistribution_report,
+                                       output_dir=os.path.join(output_dir, 'scenarios', scenarios['scenario'][i]),
+                                       netcdf=netcdf)
+                    record['rows_out'] = len(scenarios)
+            if monte_carlo_samples > 0:
+                with report.stage('monte_carlo' + suffix, [cdl_states_all]) as record:
+                    row_table, cell_table = monte_carlo_imputed(cdl_states_all, water_perc, siebert_scaling,
+                                                                n_samples=monte_carlo_samples, sigma=monte_carlo_sigma,
+                                                                seed=monte_carlo_seed)
+                    os.makedirs(output_dir, exist_ok=True)
+                    row_table.to_csv(os.path.join(output_dir, 'monte_carlo_rows.csv'), index=False)
+                    cell_table.to_csv(os.path.join(output_dir, 'monte_carlo_cells.csv'), index=False)
+                    record['rows_out'] = len(row_table)
+            cdl_states_all = run_stage('cdl_states_irr' + suffix, allocate_irrigation,
+                                       {'cdl_states_all': cdl_states_all, 'water_perc': water_perc,
+                                        'siebert_scaling': siebert_scaling}, cache_dir=cache_dir, report=report)
+            cdl_states_all = run_stage('cdl_states_cost' + suffix, adjust_costs, {'cdl_states_all': cdl_states_all},
+                                       cache_dir=cache_dir, report=report)
+            with report.stage('export_outputs' + suffix, [cdl_states_all, cdl_states_total]):
+                cdl_states_final = export_outputs(cdl_states_all, cdl_states_total, siebert_scaling, redistribution_report,
+                                                  output_dir=output_dir, netcdf=netcdf)
+            if drift_reference is not None:
+                drift = output_drift(os.path.join(drift_reference, output_dir), output_dir, DRIFT_FILES)
+                drift.to_csv(os.path.join(output_dir, 'dtype_drift.csv'), index=False)
+                print('largest relative difference from ' + drift_reference + ': ' + str(drift['max_rel_diff'].max()))
+            cdl_states_final_years.append(cdl_states_final.assign(year=year))
+
+        if len(years) > 1:
+            pd.concat(cdl_states_final_years).to_csv('cdl_states_final_20220323_all_years.csv')
+    finally:
+        report.write(report_path)  # also when a stage fails, with the stages run so far
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process input data tables for MOSART-WM-ABM')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='directory for stage checkpoints')
+    parser.add_argument('--no-cache', action='store_true', help='recompute every stage without reading or writing checkpoints')
+    parser.add_argument('--years', nargs='+', type=int, default=[2010],
+                        help='base years (CDL year for crop and available areas, budget year for costs), e.g. 2008 ... 2017')
+    parser.add_argument('--redistribution-method', choices=['proportional', 'lp'], default='proportional',
+                        help='iterative proportional redistribution or one-shot transportation problem (requires scipy)')
+    parser.add_argument('--redistribution-tolerance', type=float, default=1e-9,
+                        help='cells within tolerance of a cropped / available area of 1 are neither scaled down nor grown, and a state stops once every cell is at most 1 + tolerance')
+    parser.add_argument('--redistribution-max-iter', type=int, default=50, help='maximum redistribution iterations per state')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for the redistribution of Step X')
+    parser.add_argument('--report', default='run_report', help='path (without extension) of the json / csv run report')
+    parser.add_argument('--trace-memory', action='store_true', help='trace the peak memory of each stage (tracemalloc, slower)')
+    parser.add_argument('--netcdf', action='store_true',
+                        help='also write the historical demand on the NLDAS grid as NetCDF (requires netCDF4)')
+    parser.add_argument('--scenarios', help='csv file of Step 6 / 7 rule parameters (nir_floor, min_margin, water_cost_cap), '
+                                            'one scenario per row, to run in addition to the default rules')
+    parser.add_argument('--scenario-grid', nargs='+', metavar='PARAMETER=VALUES',
+                        help='scenarios as every combination of comma separated parameter values, e.g. min_margin=0,0.1,0.2')
+    parser.add_argument('--scenario-batch-size', type=int, default=8, help='scenarios evaluated together in one pass')
+    parser.add_argument('--monte-carlo', type=int, default=0, metavar='SAMPLES',
+                        help='number of samples of the imputed USDA areas and NIR values for the uncertainty percentiles')
+    parser.add_argument('--monte-carlo-sigma', type=float, default=0.25,
+                        help='log standard deviation of the lognormal factors applied to imputed entries')
+    parser.add_argument('--monte-carlo-seed', type=int, default=0, help='random seed of the Monte Carlo samples')
+    parser.add_argument('--compact', action='store_true',
+                        help='keep the CDL tables with categorical strings and int32 ids (footprint in the run report)')
+    parser.add_argument('--float32', action='store_true', help='with --compact, also store the area columns as float32')
+    parser.add_argument('--drift-reference', help='output directory of a run with the default dtypes to compare the '
+                                                  'outputs with (written to dtype_drift.csv)')
+    args = parser.parse_args()
+    scenarios = None
+    if args.scenarios:
+        scenarios = pd.read_csv(args.scenarios)
+    elif args.scenario_grid:
+        scenarios = {name: [float(v) for v in values.split(',')]
+                     for name, values in (entry.split('=') for entry in args.scenario_grid)}
+    main(cache_dir=None if args.no_cache else args.cache_dir, years=args.years, redistribution_method=args.redistribution_method,
+         redistribution_tolerance=args.redistribution_tolerance, redistribution_max_iter=args.redistribution_max_iter,
+         workers=args.workers, report_path=args.report, trace_memory=args.trace_memory, netcdf=args.netcdf,
+         scenarios=scenarios, scenario_batch_size=args.scenario_batch_size, monte_carlo_samples=args.monte_carlo,
+         monte_carlo_sigma=args.monte_carlo_sigma, monte_carlo_seed=args.monte_carlo_seed, compact=args.compact,
+         float32=args.float32, drift_reference=args.drift_reference)
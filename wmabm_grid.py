@@ -0,0 +1,112 @@
+# The 1/8 degree NLDAS grid of MOSART-WM-ABM (464 columns x 224 rows over the conterminous US). NLDAS_ID numbers the
+# cells from 1 row by row, starting at the south-west corner with longitude increasing fastest. Per-cell tables keyed by
+# NLDAS_ID are placed on the (lat, lon) grid by computing the row and column of every id at once, and written as
+# compressed NetCDF4 variables (requires the netCDF4 package, only imported when writing). Per-cell attribute tables
+# (state and region lookup, Siebert shares, historical supply, ...) are joined to other tables through CellTable, which
+# addresses their rows directly by NLDAS_ID instead of hashing the keys as pd.merge does.
+
+import numpy as np
+import pandas as pd
+
+NLDAS_NX = 464
+NLDAS_NY = 224
+NLDAS_RES = 0.125
+NLDAS_LON0 = -124.9375  # center of the first column
+NLDAS_LAT0 = 25.0625  # center of the first row
+
+
+def nldas_lon_lat():
+    # Cell center longitudes (NLDAS_NX) and latitudes (NLDAS_NY) of the grid
+    return NLDAS_LON0 + NLDAS_RES * np.arange(NLDAS_NX), NLDAS_LAT0 + NLDAS_RES * np.arange(NLDAS_NY)
+
+
+def nldas_row_col(nldas_id):
+    # Row (latitude) and column (longitude) index of each NLDAS_ID
+    nldas_id = np.asarray(nldas_id, dtype=np.int64)
+    if len(nldas_id) and (nldas_id.min() < 1 or nldas_id.max() > NLDAS_NX * NLDAS_NY):
+        raise ValueError('NLDAS_ID outside of the ' + str(NLDAS_NX) + ' x ' + str(NLDAS_NY) + ' grid')
+    return np.divmod(nldas_id - 1, NLDAS_NX)
+
+
+def nldas_cell_id(lon, lat):
+    # NLDAS_ID of the cell containing each (lon, lat) point, 0 for points outside of the grid
+    col = np.floor((np.asarray(lon) - NLDAS_LON0) / NLDAS_RES + 0.5)
+    row = np.floor((np.asarray(lat) - NLDAS_LAT0) / NLDAS_RES + 0.5)
+    inside = (col >= 0) & (col < NLDAS_NX) & (row >= 0) & (row < NLDAS_NY)
+    return np.where(inside, np.where(inside, row, 0) * NLDAS_NX + np.where(inside, col, 0) + 1, 0).astype(np.int64)
+
+
+def to_nldas_grid(nldas_id, values, fill_value=np.nan):
+    # NLDAS_NY x NLDAS_NX array with values at the cells of nldas_id and fill_value elsewhere
+    row, col = nldas_row_col(nldas_id)
+    grid = np.full((NLDAS_NY, NLDAS_NX), fill_value, dtype=float)
+    grid[row, col] = values
+    return grid
+
+
+def write_nldas_netcdf(path, nldas_id, values, name, units='', long_name='', fill_value=-9999.0, chunks=(56, 116),
+                       complevel=4):
+    # Write values of the cells in nldas_id as the (lat, lon) variable name of a NetCDF4 file, chunked in chunks
+    # (lat, lon) blocks and zlib compressed. Cells without a value are set to fill_value.
+    from netCDF4 import Dataset
+
+    lon, lat = nldas_lon_lat()
+    grid = to_nldas_grid(nldas_id, values, fill_value=fill_value)
+    with Dataset(path, 'w', format='NETCDF4') as nc:
+        nc.createDimension('lat', NLDAS_NY)
+        nc.createDimension('lon', NLDAS_NX)
+        lat_var = nc.createVariable('lat', 'f8', ('lat',))
+        lat_var.units = 'degrees_north'
+        lat_var.long_name = 'latitude'
+        lat_var[:] = lat
+        lon_var = nc.createVariable('lon', 'f8', ('lon',))
+        lon_var.units = 'degrees_east'
+        lon_var.long_name = 'longitude'
+        lon_var[:] = lon
+        var = nc.createVariable(name, 'f8', ('lat', 'lon'), zlib=True, complevel=complevel, chunksizes=chunks,
+                                fill_value=fill_value)
+        var.units = units
+        var.long_name = long_name
+        var[:] = grid
+
+
+class CellTable:
+    # A table with one row per NLDAS_ID (on column) and a dense array holding the row of each NLDAS_ID (-1 for ids not
+    # in the table), so that the rows of any list of ids are gathered by indexing. Duplicated ids raise a ValueError,
+    # unless duplicates='first' (the first row of each id is used).
+    def __init__(self, table, on='NLDAS_ID', duplicates='raise'):
+        ids = table[on].to_numpy()
+        if len(ids) and (pd.isnull(ids).any() or ids.min() < 0):
+            raise ValueError(on + ' must be non-negative integers')
+        unique_ids, first_rows = np.unique(ids.astype(np.int64), return_index=True)
+        if duplicates == 'raise' and len(unique_ids) != len(ids):
+            raise ValueError(on + ' is not unique')
+        self.table = table
+        self.on = on
+        self.rows = np.full(unique_ids[-1] + 1 if len(ids) else 0, -1, dtype=np.int64)
+        self.rows[unique_ids] = first_rows
+
+    def positions(self, nldas_id):
+        # Row of the table for each id (-1 where the id is missing, null, or not in the table)
+        ids = np.asarray(nldas_id, dtype=float)
+        valid = np.isfinite(ids) & (ids >= 0) & (ids < len(self.rows))
+        return np.where(valid, self.rows[np.where(valid, ids, 0).astype(np.int64)], -1)
+
+    def gather(self, nldas_id, columns):
+        # Values of columns for each id, with NaN for ids not in the table (integer columns then become float as in a
+        # left merge)
+        pos = self.positions(nldas_id)
+        values = {}
+        for col in columns:
+            column = self.table[col]
+            array = column.array if isinstance(column.dtype, pd.api.extensions.ExtensionDtype) else column.to_numpy()
+            values[col] = pd.api.extensions.take(array, pos, allow_fill=True)
+        return values
+
+    def join(self, df, columns):
+        # Same result as pd.merge(df, table[[on] + columns], on=on, how='left') (rows of df in order, new RangeIndex)
+        overlap = set(columns) & set(df.columns)
+        if overlap:
+            raise ValueError('columns already in the table: ' + ', '.join(sorted(overlap)))
+        joined = df.reset_index(drop=True)
+        return joined.assign(**self.gather(joined[self.on], columns))
@@ -0,0 +1,126 @@
+# Lightweight run report for the processing scripts. Each stage (a Step section of wmabm_data_process_HESS.py or a year
+# of the cdl_processing.py loop) records its wall time, CPU time, peak traced memory (tracemalloc), peak resident memory
+# of the process, and input/output row counts. The report is written as <path>.json and <path>.csv at the end of a run.
+# Times, resident memory, and row counts are cheap enough to leave on in every run. Memory tracing slows down code that
+# allocates many small objects (parsing the Excel workbooks takes several times longer) and is only enabled with
+# trace_memory=True. memory_mb and output_drift measure the footprint of tables and the differences of outputs between
+# two runs (e.g., with the compact dtypes of wmabm_tables.compact_dtypes and with the default dtypes).
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak resident memory is not recorded
+    resource = None
+
+
+def peak_rss_mb():
+    # Peak resident memory of this process so far (ru_maxrss is in kB on Linux and in bytes on macOS)
+    if resource is None:
+        return np.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def count_rows(tables):
+    # Total rows of a dataframe, or of a list / dict of dataframes (other objects count as 0)
+    if isinstance(tables, dict):
+        tables = list(tables.values())
+    if not isinstance(tables, (list, tuple)):
+        tables = [tables]
+    return sum(len(t) for t in tables if isinstance(t, pd.DataFrame))
+
+
+def memory_mb(df):
+    # Memory used by a dataframe, including the Python objects of object columns
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+def output_drift(reference_dir, output_dir, files):
+    # Largest absolute and relative differences of the numeric columns of the csv files in output_dir from the same
+    # files in reference_dir (e.g., outputs of a run with the default dtypes), one row per file and column. Rows are
+    # compared in order; files that are missing or have a different number of rows get a row with a note.
+    records = []
+    for name in files:
+        paths = [os.path.join(reference_dir, name), os.path.join(output_dir, name)]
+        if not all(os.path.exists(path) for path in paths):
+            records.append({'file': name, 'note': 'missing'})
+            continue
+        reference, output = (pd.read_csv(path) for path in paths)
+        if len(reference) != len(output):
+            records.append({'file': name, 'note': 'rows differ: ' + str(len(reference)) + ' / ' + str(len(output))})
+            continue
+        for col in reference.columns.intersection(output.columns):
+            if not (pd.api.types.is_numeric_dtype(reference[col]) and pd.api.types.is_numeric_dtype(output[col])):
+                continue
+            a = reference[col].to_numpy(dtype=float)
+            b = output[col].to_numpy(dtype=float)
+            diff = np.abs(a - b)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                relative = np.where(a != 0, diff / np.abs(a), np.where(diff == 0, 0, np.inf))
+            nan_mismatch = int((np.isnan(a) != np.isnan(b)).sum())
+            records.append({'file': name, 'column': col, 'max_abs_diff': np.nanmax(diff, initial=0),
+                            'max_rel_diff': np.nanmax(relative, initial=0), 'nan_mismatch': nan_mismatch, 'note': ''})
+    return pd.DataFrame(records, columns=['file', 'column', 'max_abs_diff', 'max_rel_diff', 'nan_mismatch', 'note'])
+
+
+class RunReport:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.start = time.perf_counter()
+        self.stages = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, inputs=None):
+        # Measure the block as one stage. The yielded record can be updated inside the block (e.g., record['rows_out'] =
+        # len(result), or any other field to report). If the block raises, the error is recorded in 'error'.
+        record = {'stage': name, 'rows_in': count_rows(inputs) if inputs is not None else np.nan, 'rows_out': np.nan}
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            traced_start = tracemalloc.get_traced_memory()[0]
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        except Exception as exc:
+            record['error'] = type(exc).__name__ + ': ' + str(exc)
+            raise
+        finally:
+            record['wall_s'] = time.perf_counter() - wall_start
+            record['cpu_s'] = time.process_time() - cpu_start
+            if self.trace_memory:
+                record['peak_traced_mb'] = (tracemalloc.get_traced_memory()[1] - traced_start) / 1024 ** 2
+            else:
+                record['peak_traced_mb'] = np.nan
+            record['peak_rss_mb'] = peak_rss_mb()
+            self.stages.append(record)
+            print('stage ' + name + ': ' + str(round(record['wall_s'], 2)) + ' s')
+
+    def table(self):
+        # One row per stage, in the order the stages finished
+        columns = ['stage', 'wall_s', 'cpu_s', 'peak_traced_mb', 'peak_rss_mb', 'rows_in', 'rows_out']
+        table = pd.DataFrame(self.stages, columns=columns + sorted({k for s in self.stages for k in s} - set(columns)))
+        table[['rows_in', 'rows_out']] = table[['rows_in', 'rows_out']].astype('Int64')
+        return table
+
+    def write(self, path):
+        # Write <path>.json (run metadata and stages) and <path>.csv (stages only)
+        table = self.table()
+        table.to_csv(path + '.csv', index=False)
+        report = {'started': self.started, 'wall_s': time.perf_counter() - self.start, 'python': sys.version.split()[0],
+                  'pandas': pd.__version__, 'numpy': np.__version__, 'trace_memory': self.trace_memory,
+                  'stages': json.loads(table.to_json(orient='records'))}
+        with open(path + '.json', 'w') as handle:
+            json.dump(report, handle, indent=2)
@@ -0,0 +1,413 @@
+# Vectorized table routines used by the processing stages in wmabm_data_process_HESS.py. Each routine replaces a
+# row-by-row loop of the original script with whole-column operations and returns the same values.
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+BUDGET_MISSING = 99999  # temporary value for budget items missing at the region and U.S. total level
+
+# Codes for the USDA survey entries, stored next to each normalized column as '<column> code' (uint8). Codes are ordered
+# so that entries reported as zero ('-', '(Z)') sort below entries that were not reported and have to be estimated
+# (code >= CODE_D).
+CODE_VALUE = 0  # numeric value reported
+CODE_DASH = 1  # '-', zero / no acreage reported
+CODE_Z = 2  # '(Z)', less than half of the unit shown
+CODE_D = 3  # '(D)', withheld to avoid disclosing data for individual farms
+CODE_NA_PAREN = 4  # '(NA)', not available
+CODE_NA = 5  # 'NA', not available (used in supplemental rows)
+CODE_EMPTY = 6  # '', blank entry
+CODE_NULL = 7  # null / no matching row
+CODE_OTHER = 8  # any other non-numeric entry
+SENTINEL_CODES = {'-': CODE_DASH, '(Z)': CODE_Z, '(D)': CODE_D, '(NA)': CODE_NA_PAREN, 'NA': CODE_NA, '': CODE_EMPTY}
+CODE_SUFFIX = ' code'
+
+
+def resolve_budget_items(budget, items, columns, base_year=2010, us_region='U.S. total', substitutions=None):
+    # Extract one value per (crop, region, item) from the USDA budget table for all crops and regions at once. For each
+    # item the first matching row is used, searching in order:
+    #   1. the region in base_year
+    #   2. the region in the most recent year with any data for the crop/region
+    #   3. the U.S. total in base_year
+    #   4. the U.S. total in the most recent year with any data for the crop
+    # and BUDGET_MISSING if none of the above exist. substitutions maps (crop, item) to the item name used for that
+    # crop (e.g., Beets report 'Season-average price' instead of 'Price').
+    substitutions = substitutions or {}
+    crops = budget['Commodity'].unique()
+    regions = budget['Region'].unique()
+
+    # Index of the first row for each (Commodity, Region, Year, Item) and of the latest year for each (Commodity, Region)
+    keys = ['Commodity', 'Region', 'Year', 'Item']
+    first_rows = budget.drop_duplicates(subset=keys, keep='first')
+    value_index = pd.MultiIndex.from_frame(first_rows[keys])
+    values = first_rows['Value'].to_numpy(dtype=float)
+    year_max = budget.groupby(['Commodity', 'Region'], sort=False)['Year'].max()
+
+    # Every (crop, region, item) combination, in the same order as the original nested loops
+    n_crops, n_regions, n_items = len(crops), len(regions), len(items)
+    crop = np.repeat(crops, n_regions * n_items)
+    region = np.tile(np.repeat(regions, n_items), n_crops)
+    item = np.tile(np.asarray(items, dtype=object), n_crops * n_regions)
+    for (sub_crop, sub_item), new_item in substitutions.items():
+        item = np.where((crop == sub_crop) & (item == sub_item), new_item, item)
+    us = np.full(len(crop), us_region, dtype=object)
+
+    def latest_year(crop_keys, region_keys):
+        pos = year_max.index.get_indexer(pd.MultiIndex.from_arrays([crop_keys, region_keys]))
+        return np.where(pos >= 0, year_max.to_numpy()[pos], -1)  # -1 never matches a survey year
+
+    candidates = [(region, np.full(len(crop), base_year)),
+                  (region, latest_year(crop, region)),
+                  (us, np.full(len(crop), base_year)),
+                  (us, latest_year(crop, us))]
+
+    resolved = np.full(len(crop), float(BUDGET_MISSING))
+    found = np.zeros(len(crop), dtype=bool)
+    for region_keys, year_keys in candidates:
+        pos = value_index.get_indexer(pd.MultiIndex.from_arrays([crop, region_keys, year_keys, item]))
+        hit = (pos >= 0) & ~found
+        resolved[hit] = values[pos[hit]]
+        found |= hit
+
+    table = pd.DataFrame(resolved.reshape(n_crops * n_regions, n_items), columns=columns[2:])
+    table.insert(0, columns[0], np.repeat(crops, n_regions))
+    table.insert(1, columns[1], np.tile(regions, n_crops))
+    return table
+
+
+def impute_water_source_shares(water_perc, sources=('Groundwater', 'SW (Farm)', 'SW (off-farm)'), total='Total',
+                               geography='State', national='United States', code='D', by=None):
+    # Convert irrigation water totals by source into shares of the total for every row at once. Entries equal to code
+    # (no information / did not report) are filled by splitting the unreported remainder of the row total among the
+    # missing sources in proportion to the national shares. The national shares are taken from the row whose geography
+    # is national, either once for the whole table or, if by is given (e.g., a survey year column), once per group.
+    water_perc = water_perc.copy()
+    sources = list(sources)
+    missing = water_perc[sources].eq(code).to_numpy()
+    values = water_perc[sources].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    row_total = water_perc[total].to_numpy(dtype=float)[:, None]
+
+    national_rows = (water_perc[geography] == national).to_numpy()
+    national_shares = values[national_rows] / row_total[national_rows]
+    if by is None:
+        national_shares = np.broadcast_to(national_shares[:1], values.shape)
+    else:
+        group_pos = pd.Index(water_perc.loc[national_rows, by]).get_indexer(water_perc[by])
+        national_shares = np.where(group_pos[:, None] >= 0, national_shares[group_pos], np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sum_perc = np.where(missing, national_shares, 0).sum(axis=1, keepdims=True)
+        remainder = row_total - np.where(missing, 0, values).sum(axis=1, keepdims=True)
+        imputed = national_shares / sum_perc * remainder / row_total
+        shares = np.where(missing, imputed, values / row_total)
+
+    for i, source in enumerate(sources):
+        water_perc[source] = shares[:, i]
+    return water_perc
+
+
+def normalize_sentinels(df, columns):
+    # Convert USDA survey columns holding numbers and sentinel strings ('-', '(Z)', '(D)', '(NA)', 'NA', '') into float64
+    # columns plus a uint8 '<column> code' column recording which sentinel was present (see CODE_* above). Sentinel and
+    # null entries become NaN in the value column.
+    df = df.copy()
+    sentinels = pd.Index(list(SENTINEL_CODES))
+    sentinel_codes = np.array(list(SENTINEL_CODES.values()), dtype=np.uint8)
+    for col in columns:
+        raw = df[col]
+        numeric = pd.to_numeric(raw, errors='coerce').to_numpy(dtype=float)
+        pos = sentinels.get_indexer(raw)
+        codes = np.where(pos >= 0, sentinel_codes[pos],
+                         np.where(raw.isnull(), CODE_NULL, np.where(np.isnan(numeric), CODE_OTHER, CODE_VALUE)))
+        df[col] = np.where(codes == CODE_VALUE, numeric, np.nan)
+        df[col + CODE_SUFFIX] = codes.astype(np.uint8)
+    return df
+
+
+def code_columns(columns):
+    # Value columns followed by their code columns, for selecting normalized columns from a table
+    return list(columns) + [col + CODE_SUFFIX for col in columns]
+
+
+def fill_unmatched_codes(df, columns):
+    # Rows without a match in a left join have null codes; record them as CODE_NULL
+    for col in columns:
+        df[col + CODE_SUFFIX] = df[col + CODE_SUFFIX].fillna(CODE_NULL).astype(np.uint8)
+    return df
+
+
+def coded_lookup(table, col, crops, geography, crop_col='Crop', geography_col='Geography'):
+    # (values, codes, found) of the first row of table for each entry of crops at the given geography. Where no such row
+    # exists, found is False, the value is nan, and the code is CODE_NULL.
+    first_rows = table.drop_duplicates(subset=[crop_col, geography_col], keep='first')
+    index = pd.MultiIndex.from_frame(first_rows[[crop_col, geography_col]])
+    crops = np.asarray(crops, dtype=object)
+    pos = index.get_indexer(pd.MultiIndex.from_arrays([crops, np.full(len(crops), geography, dtype=object)]))
+    found = pos >= 0
+    values = np.where(found, first_rows[col].to_numpy(dtype=float)[pos], np.nan)
+    codes = np.where(found, first_rows[col + CODE_SUFFIX].to_numpy()[pos], CODE_NULL).astype(np.uint8)
+    return values, codes, found
+
+
+def area_shares(df, value='value', crop='GCAM_name', state='State_Name'):
+    # Cropped area proportions for all crops and states at once, aligned with the rows of df:
+    #   cdl_perc   - share of the row in the crop area of its state (cell cropped area / State cropped area)
+    #   total_cdl  - crop area of the state
+    #   state_perc - share of the state in the crop area of all states (State cropped area / U.S. cropped area)
+    # States with zero crop area get a cdl_perc of 0, and rows without a state get zero proportions.
+    values = df[value]
+    total_cdl = values.groupby([df[crop], df[state]]).transform('sum').fillna(0)
+    crop_total = values.where(df[state].notnull(), 0).groupby(df[crop]).transform('sum')
+    cdl_perc = np.where(total_cdl != 0, values / total_cdl.where(total_cdl != 0, 1), 0)
+    return pd.DataFrame({'cdl_perc': cdl_perc, 'total_cdl': total_cdl, 'state_perc': total_cdl / crop_total},
+                        index=df.index)
+
+
+def siebert_scaling_factors(df, irr_area='siebert_total_irr_area', reported='Area Irrigated (Acres)', state='State_Name',
+                            crop='GCAM_name'):
+    # Factors that scale the Siebert irrigated area of each state and crop to the irrigated area reported by USDA for
+    # that state and crop ('Area Irrigated (Acres)', repeated on every row). One row per (state, crop) present in df,
+    # with the Siebert area sum, the reported area, and the scaling factor (0 where the Siebert area sums to 0).
+    factors = df.groupby([state, crop], sort=False, observed=True).agg(siebert_irr_area_sum=(irr_area, 'sum'),
+                                                                       area_irrigated_reported=(reported, 'mean')).reset_index()
+    sum_crops = factors['siebert_irr_area_sum']
+    factors['scaling_factor'] = np.where(sum_crops != 0, factors['area_irrigated_reported'] / sum_crops.where(sum_crops != 0, 1), 0)
+    return factors
+
+
+def apply_scaling_factors(df, factors, irr_area='siebert_total_irr_area', state='State_Name', crop='GCAM_name'):
+    # Scale irr_area of each row of df by the factor of its (state, crop); rows without a factor (e.g., no state) get 0
+    pos = pd.MultiIndex.from_frame(factors[[state, crop]]).get_indexer(pd.MultiIndex.from_frame(df[[state, crop]]))
+    scaling_factor = factors['scaling_factor'].to_numpy(dtype=float)
+    return np.where(pos >= 0, df[irr_area].to_numpy(dtype=float) * scaling_factor[pos], 0)
+
+
+def ordered_sums(values, labels, n_labels):
+    # Sums of the columns of values (types x entries) by label (0 to n_labels - 1), adding the entries of each label in
+    # order with the compensated summation of pandas' groupby sum
+    sums = pd.DataFrame(values.T).groupby(labels).sum()
+    return sums.reindex(range(n_labels), fill_value=0).to_numpy().T
+
+
+def redistribute_proportional(area, capacity, group, n_groups, tolerance=1e-9, max_iter=50, scale=1.0, present=None):
+    # Move crop area out of overallocated cells (cropped area greater than capacity) into cells with spare capacity in
+    # the same group (state), for every group at once. area holds one or more area types (e.g., irrigated and
+    # non-irrigated) as an array of shape (types, cells, crops); group is the group number of each cell (-1 for none).
+    # Each iteration:
+    #   - cells with ratio (cropped / capacity) > 1 + tolerance are scaled down to capacity, and the removed (excess) area
+    #     of each crop and type is summed over the group
+    #   - cells with ratio < 1 - tolerance (cushion) receive the excess of each crop in proportion to their area of that crop
+    #   - cells within tolerance of a ratio of 1 are left as they are
+    #   - cells with an unknown ratio (no capacity) are set to 0
+    # Groups iterate until their largest ratio is at most 1 + tolerance or max_iter iterations have run. Returns the
+    # corrected area, the number of iterations of each group, and the largest ratio of each group before and after.
+    #
+    # capacity is in units of area * scale (e.g., area in acres, capacity in sq ft, and scale=43560). present (cells x
+    # crops, default all) marks the (cell, crop) entries that are rows of the Step X tables. Sums over the present entries
+    # of each cell (crops in order) and of each group and crop (cells in order) are taken in the order of the groupby sums
+    # of the Step X loop. Cells scaled down to capacity end up a rounding error above or below a ratio of 1; the tolerance
+    # band keeps them out of both the excess and the cushion of the next iteration (the Step X loop of
+    # working/wmabm_data_process_temp.py uses 1.001 for the same reason), so rounding does not decide where area moves.
+    area = np.nan_to_num(np.array(area, dtype=float))
+    n_types, n_cells, n_crops = area.shape
+    present = np.ones((n_cells, n_crops), dtype=bool) if present is None else np.asarray(present, dtype=bool)
+    has_group = group >= 0
+    cell_group = group[has_group]
+    cell, crop = np.nonzero(present)  # entries by cell, then crop
+    in_group = group[cell] >= 0
+    group_crop = group[cell[in_group]] * n_crops + crop[in_group]
+
+    def cell_ratio():
+        cropped = ordered_sums(area[:, cell, crop], cell, n_cells)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.add.reduce(cropped, axis=0) * scale / capacity
+
+    def group_sum(values):
+        # (types, cells, crops) array holding the sum over the group of each cell, for each crop
+        sums = ordered_sums(values[:, cell[in_group], crop[in_group]], group_crop, n_groups * n_crops)
+        out = np.zeros((n_types, n_cells, n_crops))
+        out[:, has_group] = sums.reshape(n_types, n_groups, n_crops)[:, cell_group]
+        return out
+
+    def group_max(ratio):
+        out = np.full(n_groups, -np.inf)
+        np.fmax.at(out, cell_group, ratio[has_group])
+        return out
+
+    ratio = cell_ratio()
+    max_before = group_max(ratio)
+    iterations = np.zeros(n_groups, dtype=int)
+    active = max_before > 1 + tolerance
+    while active.any():
+        cell_active = np.zeros(n_cells, dtype=bool)
+        cell_active[has_group] = active[cell_group]
+        over = (ratio > 1 + tolerance)[None, :, None]
+        under = (ratio < 1 - tolerance)[None, :, None]
+        settled = (np.abs(ratio - 1) <= tolerance)[None, :, None]
+        r = ratio[None, :, None]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            excess_sum = group_sum(np.where(over, area - area / r, 0))
+            cushion_sum = group_sum(np.where(under, area, 0))
+            grown = np.where(cushion_sum != 0, area + excess_sum * area / cushion_sum, 0)
+            corrected = np.where(settled, area, np.where(under, grown, np.where(over, area / r, 0)))
+        area = np.where(cell_active[None, :, None], corrected, area)
+
+        ratio = cell_ratio()
+        iterations[active] += 1
+        active &= (group_max(ratio) > 1 + tolerance) & (iterations < max_iter)
+    return area, iterations, max_before, group_max(ratio)
+
+
+def redistribute_lp(area, capacity, group, n_groups, tolerance=1e-9, scale=1.0, present=None):
+    # One-shot alternative to redistribute_proportional that solves the redistribution of each overallocated group as a
+    # capacitated transportation problem (scipy.optimize.linprog). Overallocated cells (ratio > 1 + tolerance) are scaled
+    # down to capacity as in the proportional method, and the removed area of each (type, crop) is shipped to any cell of
+    # the group with spare capacity (capacity - cropped area, ratio < 1 - tolerance) that has an entry for the crop in
+    # present (see redistribute_proportional). Shipping costs 1 - (share of the
+    # crop in the receiving cell), so that cells already growing a crop are filled first, and those dominated by it before
+    # the others. Area that does not fit anywhere (the group has less spare than excess capacity) stays in the cells it
+    # came from, which are then still overallocated (max ratio after > 1 + tolerance). Same arguments and return values as
+    # redistribute_proportional (with 1 iteration for each group that was solved).
+    from scipy.optimize import linprog
+    from scipy.sparse import coo_matrix
+
+    area = np.nan_to_num(np.array(area, dtype=float))
+    n_types, n_cells, n_crops = area.shape
+    present = np.ones((n_cells, n_crops), dtype=bool) if present is None else np.asarray(present, dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = area.sum(axis=2).sum(axis=0) * scale / capacity
+
+    def group_max(ratio):
+        out = np.full(n_groups, -np.inf)
+        np.fmax.at(out, group[group >= 0], ratio[group >= 0])
+        return out
+
+    max_before = group_max(ratio)
+    iterations = np.zeros(n_groups, dtype=int)
+    for g in np.flatnonzero(max_before > 1 + tolerance):
+        cells = np.flatnonzero(group == g)
+        r = ratio[cells][None, :, None]
+        cell_area = area[:, cells]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            kept = np.where(r > 1 + tolerance, cell_area / r, np.where(r <= 1 + tolerance, cell_area, 0))
+        excess_cells = np.where(r > 1 + tolerance, cell_area - kept, 0)  # excess of each source cell
+        excess = excess_cells.sum(axis=1).ravel()  # supply of each (type, crop)
+
+        # Routes from each (type, crop) with excess to every cell with spare capacity and an entry for the crop
+        total = cell_area.sum(axis=(0, 2))
+        spare = np.where(r[0, :, 0] < 1 - tolerance, capacity[cells] / scale - total, 0)
+        share = cell_area.sum(axis=0) / np.where(total != 0, total, 1)[:, None]  # (cells, crops)
+        supply_pos, j = np.nonzero((excess > 0)[:, None] & (spare > 0)[None, :])
+        c = supply_pos % n_crops
+        route = present[cells[j], c]
+        supply_pos, j, c = supply_pos[route], j[route], c[route]
+        n_routes, n_supply = len(j), n_types * n_crops
+
+        # Variables: one per route, then one slack per (type, crop) for excess that cannot be placed
+        cost = np.concatenate([1 - share[j, c], np.full(n_supply, 2.0)])
+        rows = np.concatenate([supply_pos, np.arange(n_supply)])
+        a_eq = coo_matrix((np.ones(n_routes + n_supply), (rows, np.arange(n_routes + n_supply))), shape=(n_supply, n_routes + n_supply))
+        a_ub = coo_matrix((np.ones(n_routes), (j, np.arange(n_routes))), shape=(len(cells), n_routes + n_supply))
+        result = linprog(cost, A_ub=a_ub.tocsr(), b_ub=spare, A_eq=a_eq.tocsr(), b_eq=excess, bounds=(0, None), method='highs')
+        if result.status != 0:
+            raise RuntimeError('redistribution LP failed for group ' + str(g) + ': ' + result.message)
+
+        shipped = np.zeros_like(cell_area)
+        np.add.at(shipped, (supply_pos // n_crops, j, c), result.x[:n_routes])
+        unplaced_share = np.where(excess > 0, result.x[n_routes:] / np.where(excess > 0, excess, 1), 0).reshape(n_types, n_crops)
+        area[:, cells] = kept + shipped + excess_cells * unplaced_share[:, None, :]
+        iterations[g] = 1
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = area.sum(axis=2).sum(axis=0) * scale / capacity
+    return area, iterations, max_before, group_max(ratio)
+
+
+def redistribute_parallel(func, area, capacity, group, n_groups, workers=1, **kwargs):
+    # Run a redistribution kernel (redistribute_proportional or redistribute_lp) with the groups split across worker
+    # processes. Groups are independent, so each worker gets the cells of every workers-th group (in group order) and the
+    # results are written back by group, which makes the output identical to a single call regardless of scheduling.
+    # A present mask in kwargs (see redistribute_proportional) is split by cell with the areas.
+    if workers <= 1 or n_groups <= 1:
+        return func(area, capacity, group, n_groups, **kwargs)
+
+    area = np.array(area, dtype=float)
+    present = kwargs.pop('present', None)
+    chunks = [np.arange(start, n_groups, workers) for start in range(min(workers, n_groups))]
+    jobs = []
+    for chunk in chunks:
+        local_group = np.full(n_groups, -1)
+        local_group[chunk] = np.arange(len(chunk))
+        cells = np.flatnonzero(np.isin(group, chunk))
+        job_kwargs = kwargs if present is None else dict(kwargs, present=present[cells])
+        jobs.append((cells, (area[:, cells], capacity[cells], local_group[group[cells]], len(chunk)), job_kwargs))
+
+    corrected = np.nan_to_num(area)
+    iterations = np.zeros(n_groups, dtype=int)
+    max_before = np.full(n_groups, -np.inf)
+    max_after = np.full(n_groups, -np.inf)
+    with ProcessPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [executor.submit(func, *args, **job_kwargs) for cells, args, job_kwargs in jobs]
+        for chunk, (cells, args, job_kwargs), future in zip(chunks, jobs, futures):
+            chunk_area, chunk_iterations, chunk_before, chunk_after = future.result()
+            corrected[:, cells] = chunk_area
+            iterations[chunk] = chunk_iterations
+            max_before[chunk] = chunk_before
+            max_after[chunk] = chunk_after
+    return corrected, iterations, max_before, max_after
+
+
+def floor_nir(nir, nir_floor=0.1):
+    # NIR (acre-ft/acre) with zero entries replaced by nir_floor. nir_floor is a scalar or an (n_scenarios, 1) array, in
+    # which case the result has one row per scenario
+    return np.where(nir == 0, nir_floor, nir)
+
+
+def irrigation_costs(revenue, perceived_cost, nir, gw_cost_acft, sw_cost_acft, min_margin=0.10, water_cost_cap=0.90):
+    # Step 7 cost rules for all rows at once. Perceived costs are lowered so that the profit margin is at least
+    # min_margin, groundwater and surface water costs per acre are capped at water_cost_cap times the perceived cost, and
+    # the land-only cost is the perceived cost minus the larger water cost. The rule parameters (and nir) can be (n_scenarios,
+    # 1) arrays to evaluate several scenarios in one pass, the results then have one row per scenario.
+    profit = revenue - perceived_cost
+    perceived_cost_adj = np.where(profit < perceived_cost * min_margin, revenue / (1 + min_margin), perceived_cost)
+    costs = {'perceived_cost_adj': perceived_cost_adj, 'profit_adj': revenue - perceived_cost_adj}
+    for source, cost_acft in [('gw', gw_cost_acft), ('sw', sw_cost_acft)]:
+        cost_acre = cost_acft * nir
+        cost_acre_adj = np.where(cost_acre >= perceived_cost_adj, perceived_cost_adj * water_cost_cap, cost_acre)
+        costs[source + '_cost_est_$_acre'] = cost_acre
+        costs[source + '_cost_est_$_acre_adj'] = cost_acre_adj
+        costs[source + '_cost_est_$_acft_adj'] = cost_acre_adj / nir
+    costs['land_only_costs'] = np.where(costs['gw_cost_est_$_acre_adj'] > costs['sw_cost_est_$_acre_adj'],
+                                        perceived_cost_adj - costs['gw_cost_est_$_acre_adj'],
+                                        perceived_cost_adj - costs['sw_cost_est_$_acre_adj'])
+    return costs
+
+
+# Columns stored by compact_dtypes as pandas Categoricals (string labels repeated on every row), as int32 (integer ids),
+# and, optionally, as float32 (areas)
+CATEGORY_COLUMNS = ['GCAM_name', 'State', 'State_Name', 'ERS_region', 'Geography', 'Geography_x', 'Geography_y', 'region']
+INT32_COLUMNS = ['NLDAS_ID', 'CDL_id', 'GCAM_id', 'variable', 'year']
+AREA_COLUMNS = ['value', 'Area Irrigated (Acres)', 'Area Non-Irrigated (Acres)', 'Area Total (Acres)', 'area_irrigated',
+                'area_nonirrigated', 'area_total']
+
+
+def compact_dtypes(df, category=CATEGORY_COLUMNS, int32=INT32_COLUMNS, float32=()):
+    # Memory-lean copy of a table. Columns of category are converted to Categoricals, columns of int32 to int32 where
+    # every value is an integer within the int32 range (columns with nulls or fractions are left as they are), and
+    # columns of float32 to float32. Columns that are not in df are skipped.
+    df = df.copy()
+    for col in category:
+        if col in df and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    for col in int32:
+        if col in df and pd.api.types.is_numeric_dtype(df[col]):
+            values = df[col].to_numpy(dtype=float)
+            if (np.isfinite(values).all() and (values == np.round(values)).all() and
+                    (len(values) == 0 or np.abs(values).max() <= np.iinfo(np.int32).max)):
+                df[col] = df[col].astype(np.int32)
+    for col in float32:
+        if col in df:
+            df[col] = df[col].astype(np.float32)
+    return df